@@ -0,0 +1,209 @@
+# -*- coding: UTF-8 -*-
+
+"""Run benchmarks
+
+    python -m benchmarks forward --concurrency 64 --duration 10 -o result.json
+    python -m benchmarks download --size 64 --segments 1,4,8 --rate 10
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import easywsl
+from easywsl import downloader
+from easywsl import forward
+
+from . import download
+from . import forwarder
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return "%.2f%s" % (size, unit)
+        size /= 1024
+    return "%.2fGB" % size
+
+
+def print_results(results):
+    for scenario, result in results.items():
+        if scenario == "throughput":
+            text = "%s/s" % format_size(result["bytes_per_second"])
+        elif scenario == "requests":
+            text = "%.0f req/s p50=%.3fms p99=%.3fms" % (
+                result["requests_per_second"],
+                result["latency_p50"] * 1000,
+                result["latency_p99"] * 1000,
+            )
+        elif scenario == "connections":
+            text = "%.0f conn/s errors=%d" % (
+                result["connections_per_second"],
+                result["errors"],
+            )
+        else:
+            text = "%s per connection" % format_size(result["bytes_per_connection"])
+        print("%-12s %s" % (scenario, text))
+
+
+def save_report(path, benchmark, config, results):
+    report = {
+        "benchmark": benchmark,
+        "version": easywsl.VERSION,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "results": results,
+    }
+    with open(path, "w") as fp:
+        json.dump(report, fp, indent=2)
+
+
+def benchmark_download(args):
+    segments_list = [int(it) for it in args.segments.split(",")]
+    results = download.run_benchmark(
+        args.size * 1024 * 1024,
+        segments_list,
+        int(args.rate * 1024 * 1024),
+        not args.no_range,
+        args.chunk_size * 1024,
+    )
+    for name, result in results.items():
+        print(
+            "%-12s %s/s %.2fs"
+            % (name, format_size(result["bytes_per_second"]), result["elapsed"])
+        )
+    if args.output:
+        config = {
+            "size": args.size,
+            "segments": segments_list,
+            "rate": args.rate,
+            "range": not args.no_range,
+            "chunk_size": args.chunk_size,
+        }
+        save_report(args.output, "download", config, results)
+
+
+def benchmark_forward(args):
+    options = {
+        "engine": args.engine,
+        "pool_min": args.pool_min,
+    }
+    if args.buffer_size:
+        options["buffer_size"] = args.buffer_size
+    scenarios = args.scenarios.split(",") if args.scenarios else forwarder.SCENARIOS
+    for scenario in scenarios:
+        if scenario not in forwarder.SCENARIOS:
+            raise RuntimeError("Unknown scenario %s" % scenario)
+    results = forwarder.run_benchmark(
+        scenarios,
+        options,
+        args.workers,
+        args.concurrency,
+        args.duration,
+        args.chunk_size,
+        args.message_size,
+        args.idle_connections,
+        args.client_processes,
+    )
+    print_results(results)
+    if args.output:
+        config = dict(
+            options,
+            workers=args.workers,
+            concurrency=args.concurrency,
+            duration=args.duration,
+            chunk_size=args.chunk_size,
+            message_size=args.message_size,
+            idle_connections=args.idle_connections,
+            client_processes=args.client_processes,
+        )
+        save_report(args.output, "forward", config, results)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="benchmarks", description="Benchmarks of easywsl."
+    )
+    subparsers = parser.add_subparsers(dest="Sub command")
+    parser_forward = subparsers.add_parser("forward")
+    parser_forward.add_argument(
+        "--scenarios",
+        help="scenarios to run(separated by ,), default is %s"
+        % ",".join(forwarder.SCENARIOS),
+    )
+    parser_forward.add_argument(
+        "--engine", choices=forward.ENGINES, default="protocol", help="relay engine"
+    )
+    parser_forward.add_argument(
+        "--pool-min", type=int, default=0, help="upstream pool size"
+    )
+    parser_forward.add_argument("--buffer-size", type=int, help="relay buffer size")
+    parser_forward.add_argument(
+        "--workers", type=int, default=1, help="forwarder worker processes"
+    )
+    parser_forward.add_argument(
+        "-c", "--concurrency", type=int, default=32, help="concurrent connections"
+    )
+    parser_forward.add_argument(
+        "-d", "--duration", type=float, default=5, help="seconds of each scenario"
+    )
+    parser_forward.add_argument(
+        "--chunk-size", type=int, default=64 * 1024, help="write size of throughput"
+    )
+    parser_forward.add_argument(
+        "--message-size", type=int, default=128, help="message size of requests"
+    )
+    parser_forward.add_argument(
+        "--idle-connections",
+        type=int,
+        default=1000,
+        help="connections opened to measure memory",
+    )
+    parser_forward.add_argument(
+        "--client-processes", type=int, default=1, help="load generator processes"
+    )
+    parser_forward.add_argument("-o", "--output", help="path of json result file")
+    parser_forward.set_defaults(func=benchmark_forward)
+
+    parser_download = subparsers.add_parser("download")
+    parser_download.add_argument("--size", type=int, default=64, help="file size in MB")
+    parser_download.add_argument(
+        "--segments",
+        default="1,4,8",
+        help="segments counts to compare(separated by ,)",
+    )
+    parser_download.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="bandwidth of each connection in MB/s, 0 for unlimited",
+    )
+    parser_download.add_argument(
+        "--no-range",
+        default=False,
+        action="store_true",
+        help="server does not support range requests",
+    )
+    parser_download.add_argument(
+        "--chunk-size",
+        type=int,
+        default=downloader.CHUNK_SIZE // 1024,
+        help="KB read from each connection at once",
+    )
+    parser_download.add_argument("-o", "--output", help="path of json result file")
+    parser_download.set_defaults(func=benchmark_download)
+
+    args = sys.argv[1:]
+    if not args:
+        parser.print_help()
+        return 0
+    args = parser.parse_args(args)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+# -*- coding: UTF-8 -*-
+
+"""Benchmark of downloader
+
+Files are served by a local http.server supporting Range requests, the
+bandwidth of each connection can be limited to simulate servers throttling
+single connections, which is where parallel segments help.
+"""
+
+import http.server
+import os
+import re
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import zlib
+
+from easywsl import downloader
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serve `server.data` at any path, with Range support if
+    `server.support_range` is set"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        data = self.server.data
+        if self.headers.get("If-None-Match") == self.server.etag:
+            self.send_response(304)
+            self.send_header("ETag", self.server.etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start, end = 0, len(data) - 1
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match and self.server.support_range:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), end)
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes %d-%d/%d" % (start, end, len(data))
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", self.server.etag)
+        self.end_headers()
+        self.send_body(memoryview(data)[start : end + 1])
+
+    def send_body(self, view):
+        rate = self.server.rate
+        chunk_size = 64 * 1024
+        time0 = time.time()
+        sent = 0
+        try:
+            for offset in range(0, len(view), chunk_size):
+                self.wfile.write(view[offset : offset + chunk_size])
+                sent += len(view[offset : offset + chunk_size])
+                if rate:
+                    delay = sent / rate - (time.time() - time0)
+                    if delay > 0:
+                        time.sleep(delay)
+        except ConnectionError:
+            pass
+
+
+class RangeServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, data, rate=0, support_range=True):
+        super(RangeServer, self).__init__(("127.0.0.1", 0), RangeRequestHandler)
+        self.data = data
+        self.rate = rate
+        self.support_range = support_range
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self.etag = '"%08x"' % zlib.crc32(data)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/image.appx" % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+
+def run_benchmark(
+    size,
+    segments_list,
+    rate=0,
+    support_range=True,
+    chunk_size=downloader.CHUNK_SIZE,
+):
+    """Download a file of `size` bytes with each segments count
+
+    :param rate: bytes per second of each connection, 0 for unlimited
+    """
+    data = os.urandom(size)
+    server = RangeServer(data, rate, support_range)
+    server.start()
+    temp_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for segments in segments_list:
+            save_path = os.path.join(temp_dir, "image-%d.appx" % segments)
+            time0 = time.time()
+            downloader.Downloader(
+                server.url, save_path, segments, progress=False, chunk_size=chunk_size
+            ).download()
+            elapsed = time.time() - time0
+            with open(save_path, "rb") as fp:
+                if fp.read() != data:
+                    raise RuntimeError("Downloaded file is corrupted")
+            results["segments-%d" % segments] = {
+                "bytes": size,
+                "elapsed": elapsed,
+                "bytes_per_second": size / elapsed,
+            }
+            os.remove(save_path)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(temp_dir)
+    return results
@@ -0,0 +1,272 @@
+# -*- coding: UTF-8 -*-
+
+"""Benchmark of port forwarder
+
+Upstream servers, forwarder and load generators run in separate processes,
+the forwarder listens on 127.0.0.2 and forwards to 127.0.0.1 with the same
+port, just like forwarding from wsl address to windows localhost.
+"""
+
+import asyncio
+import gc
+import hashlib
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+from easywsl import forward
+from easywsl import worker
+
+from . import servers
+
+SCENARIOS = ("throughput", "requests", "connections", "idle-memory")
+
+
+def run_forwarder(queue, address, ports, options, workers):
+    # Exit normally on terminate, so that daemon workers are terminated too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if workers > 1:
+        forwards = [dict(options, address=address, port=port) for port in ports]
+        worker.WorkerSupervisor(forwards, workers).start()
+        # Wait for workers listening
+        loop.run_until_complete(asyncio.sleep(1))
+    else:
+        for port in ports:
+            forwarder = forward.PortForwarder(address, port, **options)
+            loop.run_until_complete(forwarder.serve())
+    queue.put(os.getpid())
+    loop.run_forever()
+
+
+def get_process_tree(pid):
+    pids = [pid]
+    for it in pids:
+        task_dir = "/proc/%d/task" % it
+        if not os.path.isdir(task_dir):
+            continue
+        for tid in os.listdir(task_dir):
+            with open(os.path.join(task_dir, tid, "children")) as fp:
+                pids.extend(int(child) for child in fp.read().split())
+    return pids
+
+
+def get_memory_usage(pid):
+    """Resident memory of process and its children in bytes, linux only"""
+    total = 0
+    for it in get_process_tree(pid):
+        try:
+            with open("/proc/%d/status" % it) as fp:
+                for line in fp:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    index = min(int(len(values) * percent / 100), len(values) - 1)
+    return values[index]
+
+
+async def bulk_client(address, port, deadline, chunk_size):
+    reader, writer = await asyncio.open_connection(address, port)
+    # Random data sent from shifting offsets, so that reordered or reused
+    # buffers are caught by the digest returned by the sink server
+    data = os.urandom(chunk_size * 2)
+    hasher = hashlib.sha256()
+    sent = 0
+    while time.time() < deadline:
+        offset = sent % chunk_size
+        chunk = data[offset : offset + chunk_size]
+        hasher.update(chunk)
+        writer.write(chunk)
+        sent += len(chunk) + 1
+        await writer.drain()
+    writer.write_eof()
+    line = await reader.readline()
+    writer.close()
+    if not line:
+        raise RuntimeError("Connection closed by sink server")
+    size, digest = line.decode().split()
+    if digest != hasher.hexdigest():
+        raise RuntimeError("Data corrupted by forwarder")
+    return {"bytes": int(size)}
+
+
+async def request_client(address, port, deadline, message_size):
+    reader, writer = await asyncio.open_connection(address, port)
+    message = b"x" * message_size
+    latencies = []
+    while time.time() < deadline:
+        time0 = time.perf_counter()
+        writer.write(message)
+        await reader.readexactly(message_size)
+        latencies.append(time.perf_counter() - time0)
+    writer.close()
+    return {"latencies": latencies}
+
+
+async def connect_client(address, port, deadline):
+    count = errors = 0
+    while time.time() < deadline:
+        try:
+            reader, writer = await asyncio.open_connection(address, port)
+            writer.write(b"x")
+            await reader.readexactly(1)
+            writer.close()
+        except (OSError, asyncio.IncompleteReadError):
+            errors += 1
+        else:
+            count += 1
+    return {"connections": count, "errors": errors}
+
+
+def run_clients(args):
+    """Run `concurrency` clients of a scenario in current process"""
+    scenario, address, port, concurrency, deadline, size = args
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if scenario == "throughput":
+        coros = [bulk_client(address, port, deadline, size) for _ in range(concurrency)]
+    elif scenario == "requests":
+        coros = [
+            request_client(address, port, deadline, size) for _ in range(concurrency)
+        ]
+    else:
+        coros = [connect_client(address, port, deadline) for _ in range(concurrency)]
+    results = loop.run_until_complete(asyncio.gather(*coros))
+    loop.close()
+    return results
+
+
+def run_load(scenario, address, port, concurrency, duration, size, processes):
+    processes = max(min(processes, concurrency), 1)
+    # Leave some time to start client processes
+    deadline = time.time() + duration + 0.5
+    tasks = []
+    for index in range(processes):
+        count = concurrency // processes + (index < concurrency % processes)
+        tasks.append((scenario, address, port, count, deadline, size))
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(run_clients, tasks)
+    return [it for result in results for it in result]
+
+
+async def open_idle_connections(address, port, count):
+    connections = []
+    for _ in range(count):
+        reader, writer = await asyncio.open_connection(address, port)
+        # Make sure the upstream connection is established
+        writer.write(b"x")
+        await reader.readexactly(1)
+        connections.append((reader, writer))
+    return connections
+
+
+def measure_idle_memory(address, port, count, forwarder_pid):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    gc.collect()
+    before = get_memory_usage(forwarder_pid)
+    connections = loop.run_until_complete(open_idle_connections(address, port, count))
+    time.sleep(0.5)
+    after = get_memory_usage(forwarder_pid)
+    for _, writer in connections:
+        writer.close()
+    loop.run_until_complete(asyncio.sleep(0.1))
+    loop.close()
+    return {
+        "connections": count,
+        "rss_before": before,
+        "rss_after": after,
+        "bytes_per_connection": (after - before) / count,
+    }
+
+
+def run_benchmark(
+    scenarios=SCENARIOS,
+    options=None,
+    workers=1,
+    concurrency=32,
+    duration=5,
+    chunk_size=64 * 1024,
+    message_size=128,
+    idle_connections=1000,
+    client_processes=1,
+    address="127.0.0.2",
+):
+    """Run benchmark scenarios and return results as dict"""
+    options = options or {}
+    queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(
+        target=servers.run_servers, args=(queue,), daemon=True
+    )
+    server_process.start()
+    ports = queue.get(timeout=10)
+    forwarder_process = multiprocessing.Process(
+        target=run_forwarder,
+        args=(queue, address, list(ports.values()), options, workers),
+    )
+    forwarder_process.start()
+    forwarder_pid = queue.get(timeout=30)
+
+    results = {}
+    try:
+        for scenario in scenarios:
+            time0 = time.time()
+            if scenario == "idle-memory":
+                results[scenario] = measure_idle_memory(
+                    address, ports["echo"], idle_connections, forwarder_pid
+                )
+                continue
+            if scenario == "throughput":
+                port, size = ports["sink"], chunk_size
+            else:
+                port, size = ports["echo"], message_size
+            items = run_load(
+                scenario,
+                address,
+                port,
+                concurrency,
+                duration,
+                size,
+                client_processes,
+            )
+            if scenario == "throughput":
+                total = sum(it["bytes"] for it in items)
+                results[scenario] = {
+                    "bytes": total,
+                    "bytes_per_second": total / duration,
+                }
+            elif scenario == "requests":
+                latencies = sorted(
+                    latency for it in items for latency in it["latencies"]
+                )
+                results[scenario] = {
+                    "requests": len(latencies),
+                    "requests_per_second": len(latencies) / duration,
+                    "latency_p50": percentile(latencies, 50),
+                    "latency_p99": percentile(latencies, 99),
+                    "latency_max": latencies[-1] if latencies else 0,
+                }
+            else:
+                count = sum(it["connections"] for it in items)
+                results[scenario] = {
+                    "connections": count,
+                    "errors": sum(it["errors"] for it in items),
+                    "connections_per_second": count / duration,
+                }
+            results[scenario]["elapsed"] = time.time() - time0
+    finally:
+        for process in (forwarder_process, server_process):
+            process.terminate()
+            process.join()
+    return results
@@ -0,0 +1,59 @@
+# -*- coding: UTF-8 -*-
+
+"""Local upstream servers used by benchmarks
+"""
+
+import asyncio
+import hashlib
+
+
+async def handle_echo(reader, writer):
+    try:
+        while True:
+            buffer = await reader.read(65536)
+            if not buffer:
+                break
+            writer.write(buffer)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def handle_sink(reader, writer):
+    """Hash all data and reply received size and sha256 digest after EOF"""
+    size = 0
+    hasher = hashlib.sha256()
+    try:
+        while True:
+            buffer = await reader.read(256 * 1024)
+            if not buffer:
+                break
+            size += len(buffer)
+            hasher.update(buffer)
+        writer.write(b"%d %s\n" % (size, hasher.hexdigest().encode()))
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def run_servers(queue, address="127.0.0.1"):
+    """Start echo and sink servers, put their ports to `queue`"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    echo_server = loop.run_until_complete(
+        asyncio.start_server(handle_echo, address, 0, backlog=4096)
+    )
+    sink_server = loop.run_until_complete(
+        asyncio.start_server(handle_sink, address, 0, backlog=4096)
+    )
+    queue.put(
+        {
+            "echo": echo_server.sockets[0].getsockname()[1],
+            "sink": sink_server.sockets[0].getsockname()[1],
+        }
+    )
+    loop.run_forever()
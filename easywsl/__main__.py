@@ -7,17 +7,19 @@ import argparse
 import asyncio
 import ctypes
 import json
-import logging
 import os
 import platform
 import sys
 import tempfile
-import shutil
+import time
 import urllib.parse
-import zipfile
-from xml.dom import minidom
 
+from . import appx
+from . import cache
+from . import downloader
+from . import facts
 from . import forward
+from . import manager
 from . import utils
 from . import wsl
 
@@ -40,6 +42,12 @@ WSL_IMAGES = {
 }
 
 
+# Pinned digests of images, such as {url: {"sha256": "...", "size": 123}}.
+# Images are verified only if pinned here or given by --sha256, the image
+# hosts do not publish digests to check against.
+WSL_IMAGE_DIGESTS = {}
+
+
 def system(cmdline, workdir=None):
     current_workdir = None
     if workdir:
@@ -99,6 +107,7 @@ def get_current_wsl_dist():
             return dist["name"]
 
 
+@facts.fact("wsl_enabled", facts.DAY)
 def check_wsl_enabled():
     cmdline = "dism /english /online /get-featureinfo /featurename:Microsoft-Windows-Subsystem-Linux"
     stdout = os.popen(cmdline).read()
@@ -135,6 +144,7 @@ def enable_wsl():
         True,
     )
 
+    facts.invalidate("wsl_enabled")
     if returncode != ERROR_SUCCESS_REBOOT_REQUIRED:
         print("[-] Enable WSL failed", file=sys.stderr)
         return -1
@@ -143,69 +153,43 @@ def enable_wsl():
     utils.reboot()
 
 
-def install_wsl_dist(name, install_path):
+def get_image_cache(args):
+    return cache.ImageCache(args.cache_dir, int(args.cache_max_size * 1024 * 1024))
+
+
+def install_wsl_dist(
+    name,
+    install_path,
+    image_cache,
+    lazy=False,
+    extract_workers=appx.DEFAULT_EXTRACT_WORKERS,
+    sha256=None,
+    verify_cache=False,
+):
     image_url = WSL_IMAGES[platform.machine().lower()].get(name)
     if not image_url:
         raise RuntimeError("Linux image %s not found" % name)
-    print("[+] Downloading %s image from %s" % (name, image_url))
-    save_path = tempfile.mkstemp(".img")[1]
-    utils.download(image_url, save_path)
-    print("[+] Image file saved to %s" % save_path)
+    expected = dict(WSL_IMAGE_DIGESTS.get(image_url, {}))
+    if sha256:
+        expected["sha256"] = sha256.lower()
+    if lazy and expected:
+        # Image read lazily can not be verified
+        print("[-] Image has expected digest, download it instead of reading lazily")
+        lazy = False
+    if lazy and not image_cache.lookup(image_url):
+        print("[+] Reading %s image from %s" % (name, image_url))
+        save_path = image_url
+    else:
+        print("[+] Fetching %s image from %s" % (name, image_url))
+        save_path = image_cache.fetch(image_url, expected=expected, verify=verify_cache)
+        print("[+] Image file saved to %s" % save_path)
     install_path = os.path.join(install_path, name.replace(" ", "_"))
     if not os.path.isdir(install_path):
         os.makedirs(install_path)
-    zf = zipfile.ZipFile(save_path, "r")
-    for fname in zf.namelist():
-        print("[+] Extract %s" % (fname))
-        zf.extract(fname, install_path)
-    zf.close()
-
-    manifest_file = os.path.join(install_path, "AppxManifest.xml")
-    if not os.path.isfile(manifest_file):
-        appx_path = None
-        for it in os.listdir(install_path):
-            if it.endswith("_x64.appx"):
-                appx_path = os.path.join(install_path, it)
-                zf = zipfile.ZipFile(appx_path, "r")
-                for fname in zf.namelist():
-                    print("[+] Extract %s" % (fname))
-                    zf.extract(fname, install_path)
-                zf.close()
-                break
-        if not os.path.isfile(manifest_file):
-            raise RuntimeError("Invalid WSL path: %s" % install_path)
-    dom = minidom.parse(manifest_file)
-    app_node = dom.getElementsByTagName("Application")[0]
-    install_exe = app_node.getAttribute("Executable")
-    if not install_exe:
-        raise RuntimeError("Invalid AppxManifest.xml in %s" % install_path)
-    install_exe = os.path.join(install_path, install_exe)
-    if not os.path.isfile(install_exe):
-        for it in os.listdir(install_path):
-            if not it.endswith(".appx"):
-                continue
-            path = os.path.join(install_path, it)
-            if not os.path.isfile(path):
-                continue
-            zf = zipfile.ZipFile(path, "r")
-            for fname in zf.namelist():
-                print("[+] Extract %s from %s" % (fname, it))
-                zf.extract(fname, install_path)
-            zf.close()
-        if not os.path.isfile(install_exe):
-            raise RuntimeError("Install exe %s not found" % install_exe)
-
-    if os.path.dirname(install_exe) != install_path:
-        # copy install file to install path
-        shutil.copy(install_exe, install_path)
-        install_exe = os.path.join(install_path, os.path.basename(install_exe))
+    install_exe = appx.extract_image(save_path, install_path, workers=extract_workers)
 
     print("[+] Run command %s" % install_exe)
     system(install_exe, install_path)
-    try:
-        os.remove(save_path)
-    except PermissionError:
-        print("[-] Remove temp file %s failed, pls delete it manually" % save_path)
 
 
 def uninstall_wsl(args):
@@ -226,7 +210,50 @@ def install_wsl(args):
         return enable_wsl()
     else:
         install_path = args.install_path or r"C:\Linux"
-        install_wsl_dist(args.distribution, install_path)
+        install_wsl_dist(
+            args.distribution,
+            install_path,
+            get_image_cache(args),
+            args.lazy,
+            args.extract_workers,
+            args.sha256,
+            args.verify_cache,
+        )
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return "%.2f%s" % (size, unit)
+        size /= 1024
+    return "%.2fGB" % size
+
+
+def manage_cache(args):
+    image_cache = get_image_cache(args)
+    if args.cache_command == "prune":
+        max_size = None
+        if args.max_size is not None:
+            max_size = int(args.max_size * 1024 * 1024)
+        removed = image_cache.prune(max_size)
+        print("[+] %d images removed from %s" % (len(removed), image_cache.path))
+        return
+    images = image_cache.list()
+    print("Image cache: %s" % image_cache.path)
+    for it in images:
+        print(
+            " %s %10s %s %s"
+            % (
+                it["digest"][:12],
+                format_size(it["size"]),
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(it["last_used"])),
+                it["url"],
+            )
+        )
+    print(
+        "%d images, %s in total"
+        % (len(images), format_size(sum(it["size"] for it in images)))
+    )
 
 
 def set_default_distribution(args):
@@ -245,31 +272,32 @@ def update_wsl_kernel():
     save_path = os.path.join(
         tempfile.mkdtemp(), urllib.parse.unquote(url.split("/")[-1])
     )
-    utils.download(url, save_path)
+    downloader.download(url, save_path)
     system(save_path)
 
 
-def enable_virtual_machine():
+@facts.fact("virtual_machine_enabled", facts.DAY)
+def check_virtual_machine_enabled():
     cmdline = (
         "dism.exe /online /get-featureinfo /featurename:VirtualMachinePlatform /english"
     )
     _, stdout, _ = utils.sync_run_command(cmdline)
-    vm_enabled = False
     for line in stdout.splitlines():
         line = line.strip()
         if ":" not in line:
             continue
         key, value = line.split(":", 1)
         if key.strip() == "State":
-            if value.strip() == "Enabled":
-                vm_enabled = True
-            break
-    else:
-        raise RuntimeError("Get vm feature info failed: %s" % stdout)
-    if not vm_enabled:
+            return value.strip() == "Enabled"
+    raise RuntimeError("Get vm feature info failed: %s" % stdout)
+
+
+def enable_virtual_machine():
+    if not check_virtual_machine_enabled():
         print("[+] Enable feature VirtualMachinePlatform")
         cmdline = "dism.exe /online /enable-feature /featurename:VirtualMachinePlatform /all /norestart"
         utils.sync_run_command(cmdline, True)
+        facts.invalidate("virtual_machine_enabled")
         print("[+] Enable VirtualMachinePlatform success, system needs reboot")
         utils.reboot()
 
@@ -304,22 +332,124 @@ def set_dist_version(args):
     _, stdout, stderr = utils.sync_run_command(cmdline, True)
 
 
+def parse_backends(text):
+    """Parse backends like `host:port,host:port`"""
+    backends = []
+    for it in text.split(","):
+        it = it.strip()
+        if not it:
+            continue
+        host, port = it.rsplit(":", 1)
+        backends.append((host, int(port)))
+    return backends
+
+
+def parse_port_backends(text):
+    """Parse port backends like `80=host:port,host:port;443=host:port`"""
+    result = {}
+    for it in text.split(";"):
+        if not it:
+            continue
+        port, backends = it.split("=", 1)
+        result[int(port)] = parse_backends(backends)
+    return result
+
+
+def control_forward(args):
+    if args.forward_command == "ls":
+        forwards = manager.send_command("ls", args.control_port)
+        for it in forwards:
+            text = "%s:%d/%s" % (it["address"], it["port"], it["protocol"])
+            if "engine" in it:
+                text += " [%s]" % it["engine"]
+            if "workers" in it:
+                text += " workers=%d" % it["workers"]
+            if "sessions" in it:
+                text += " sessions=%d" % it["sessions"]
+            if "pool" in it:
+                text += " pool(hits=%(hits)d misses=%(misses)d idle=%(idle)d)" % (
+                    it["pool"]
+                )
+            print(text)
+            for backend in it.get("backends", []):
+                print(
+                    "    => %s active=%d failures=%d%s"
+                    % (
+                        backend["address"],
+                        backend["active"],
+                        backend["failures"],
+                        " (ejected)" if backend["ejected"] else "",
+                    )
+                )
+        stats = manager.send_command("stats", args.control_port)
+        if stats:
+            print(
+                "connections: active=%(active)d sources=%(sources)d "
+                "rejected=%(rejected)d buffered=%(buffered_bytes)d "
+                "max_buffered=%(max_buffered_bytes)d" % stats
+            )
+    else:
+        protocol = "udp" if args.udp else "tcp"
+        params = {"port": args.port, "protocol": protocol}
+        if getattr(args, "backends", None):
+            params["backends"] = parse_backends(args.backends)
+        manager.send_command(args.forward_command, args.control_port, **params)
+        print(
+            "[+] %s port %d/%s completed"
+            % (args.forward_command.title(), args.port, protocol)
+        )
+
+
 def forward_ports(args):
-    ports = [int(port) for port in args.ports.split(";")]
+    if args.forward_command:
+        return control_forward(args)
+    if not args.password:
+        raise RuntimeError("Password not specified")
+    ports = [int(port) for port in args.ports.split(";") if port]
+    udp_ports = [int(port) for port in args.udp_ports.split(";") if port]
     password = args.password
     wsl_addr = utils.get_wsl_adapter_address()
     utils.logger.info("WSL interface address is %s" % wsl_addr)
     o_wsl = wsl.WSL(password)
-    for port in ports:
-        if not utils.is_port_listening(port, wsl_addr):
-            # Listen on wsl address
-            utils.logger.info(
-                "Forwarding localhost port %d to %s:%d" % (port, wsl_addr, port)
-            )
-            forwarder = forward.PortForwarder(wsl_addr, port)
-            forwarder.start()
-        utils.ensure_add_firewall_rule(port)
-        utils.safe_ensure_future(o_wsl.forward_local_port(port, port, wsl_addr))
+    options = {
+        "engine": args.engine,
+        "high_water": args.high_water,
+        "low_water": args.low_water,
+        "pool_min": args.pool_min,
+        "pool_max": args.pool_max,
+        "pool_idle_timeout": args.pool_idle_timeout,
+        "balance": args.balance,
+        "connect_timeout": args.connect_timeout,
+        "max_failures": args.max_failures,
+        "fail_cooldown": args.fail_cooldown,
+    }
+    udp_options = {
+        "idle_timeout": args.udp_idle_timeout,
+        "max_sessions": args.udp_max_sessions,
+    }
+    limits = {
+        "idle_timeout": args.idle_timeout,
+        "max_lifetime": args.max_lifetime,
+        "max_connections": args.max_connections,
+        "max_connections_per_ip": args.max_connections_per_ip,
+    }
+    forward_manager = manager.ForwardManager(
+        wsl_addr,
+        o_wsl,
+        options,
+        args.workers,
+        args.metrics_port,
+        udp_options,
+        parse_port_backends(args.backends),
+        limits,
+        args.setup_concurrency,
+    )
+    report = utils.run_coroutine(forward_manager.start(ports, udp_ports))
+    if report and all(report.values()):
+        raise RuntimeError("Forward all ports failed")
+    if args.control_port:
+        control_server = manager.ControlServer(forward_manager, args.control_port)
+        utils.run_coroutine(control_server.serve())
     utils.logger.info("Start forwarding service")
     asyncio.get_event_loop().run_forever()
 
@@ -358,7 +488,7 @@ cat ~/.zshrc
         tempfile.mkdtemp(), urllib.parse.unquote(font_url.split("/")[-1])
     )
     print("[+] Download %s" % font_url)
-    utils.download(font_url, save_path)
+    downloader.download(font_url, save_path)
     utils.install_ttf(save_path)
 
     if args.set_default_shell:
@@ -440,7 +570,7 @@ def install_windows_terminal(background_image=None):
         url = it["browser_download_url"]
         filename = url.split("/")[-1]
         save_path = os.path.abspath(filename)
-        utils.download(url, save_path)
+        downloader.download(url, save_path)
         cmdline = 'powershell Add-AppxPackage "%s"' % save_path
         utils.sync_run_command(cmdline, write_to_stdout=True)
         os.remove(save_path)
@@ -537,16 +667,47 @@ def main():
     utils.enable_ansi_code()
     loop = asyncio.ProactorEventLoop()
     asyncio.set_event_loop(loop)
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter("[%(asctime)s][%(levelname)s]%(message)s")
-    handler.setFormatter(formatter)
-    utils.logger.setLevel(logging.DEBUG)
-    utils.logger.propagate = 0
-    utils.logger.addHandler(handler)
+    utils.init_logger()
 
     parser = argparse.ArgumentParser(
         prog="ezwsl", description="Easy deploy wsl cmdline tool."
     )
+    parser.add_argument(
+        "--refresh",
+        help="refresh cached host facts such as windows version and features",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--command-timeout",
+        help="seconds each system command must finish in, default is unlimited",
+        type=float,
+    )
+    parser.add_argument(
+        "--deadline",
+        help="seconds all system commands must finish in, default is unlimited",
+        type=float,
+    )
+
+    parser.add_argument(
+        "--progress",
+        help="progress of downloading and extracting, bar is a line updated in "
+        "place, json is a json object per line, default is bar",
+        choices=downloader.PROGRESS_MODES,
+        default="bar",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="directory of image cache, may be a network share, default is "
+        "%%EZWSL_CACHE_DIR%% or %%LOCALAPPDATA%%\\easywsl\\images",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        help="max MB of cached images, least recently used images are evicted, "
+        "0 for unlimited, default is %d" % (cache.DEFAULT_MAX_SIZE // 1024 // 1024),
+        type=float,
+        default=cache.DEFAULT_MAX_SIZE / 1024 / 1024,
+    )
 
     subparsers = parser.add_subparsers(dest="Sub command")
     parser_info = subparsers.add_parser("ls")
@@ -561,6 +722,29 @@ def main():
         required=True,
     )
     parser_install.add_argument("--install-path", help="path of linux to install")
+    parser_install.add_argument(
+        "--lazy",
+        help="download only needed files of the package matching the architecture "
+        "instead of the whole image, the image is not cached",
+        default=False,
+        action="store_true",
+    )
+    parser_install.add_argument(
+        "--sha256", help="expected sha256 digest of image, overrides pinned digest"
+    )
+    parser_install.add_argument(
+        "--verify-cache",
+        help="hash the cached image again before using it",
+        default=False,
+        action="store_true",
+    )
+    parser_install.add_argument(
+        "--extract-workers",
+        help="threads extracting files of image, default is %d"
+        % appx.DEFAULT_EXTRACT_WORKERS,
+        type=int,
+        default=appx.DEFAULT_EXTRACT_WORKERS,
+    )
     parser_install.set_defaults(func=install_wsl)
 
     parser_uninstall = subparsers.add_parser("uninstall")
@@ -653,12 +837,181 @@ def main():
     parser_forward.add_argument(
         "--ports",
         help="port list forward from windows to wsl2(separated by ;)",
-        required=True,
+        default="",
     )
     parser_forward.add_argument(
-        "-p", "--password", help="current user password", required=True
+        "--udp-ports",
+        help="udp port list forward from windows to wsl2(separated by ;)",
+        default="",
+    )
+    parser_forward.add_argument("-p", "--password", help="current user password")
+    parser_forward.add_argument(
+        "--engine",
+        help="relay engine, default is protocol",
+        choices=forward.ENGINES,
+        default="protocol",
+    )
+    parser_forward.add_argument(
+        "--high-water",
+        help="pause reading when peer buffered bytes exceed this, default is %d"
+        % forward.DEFAULT_HIGH_WATER,
+        type=int,
+        default=forward.DEFAULT_HIGH_WATER,
+    )
+    parser_forward.add_argument(
+        "--low-water",
+        help="resume reading when peer buffered bytes drop below this, default is %d"
+        % forward.DEFAULT_LOW_WATER,
+        type=int,
+        default=forward.DEFAULT_LOW_WATER,
+    )
+    parser_forward.add_argument(
+        "--pool-min",
+        help="pre-established upstream connections per port, default is 0(disabled)",
+        type=int,
+        default=0,
+    )
+    parser_forward.add_argument(
+        "--pool-max",
+        help="max pre-established upstream connections per port, default is 8",
+        type=int,
+        default=8,
+    )
+    parser_forward.add_argument(
+        "--pool-idle-timeout",
+        help="seconds before an idle pooled connection is closed, default is %d"
+        % forward.DEFAULT_POOL_IDLE_TIMEOUT,
+        type=int,
+        default=forward.DEFAULT_POOL_IDLE_TIMEOUT,
+    )
+    parser_forward.add_argument(
+        "--workers",
+        help="number of forwarding worker processes, default is 1",
+        type=int,
+        default=1,
+    )
+    parser_forward.add_argument(
+        "--control-port",
+        help="local port of forwarding control api such as %d, default is 0"
+        "(disabled), commands must carry the token saved to easywsl\\control.json"
+        " of local app data" % manager.DEFAULT_CONTROL_PORT,
+        type=int,
+        default=0,
+    )
+    parser_forward.add_argument(
+        "--metrics-port",
+        help="local port of prometheus metrics endpoint, default is 0(disabled)",
+        type=int,
+        default=0,
+    )
+    parser_forward.add_argument(
+        "--udp-idle-timeout",
+        help="seconds before an idle udp session is closed, default is %d"
+        % forward.DEFAULT_UDP_IDLE_TIMEOUT,
+        type=int,
+        default=forward.DEFAULT_UDP_IDLE_TIMEOUT,
+    )
+    parser_forward.add_argument(
+        "--udp-max-sessions",
+        help="max udp sessions per port, default is %d"
+        % forward.DEFAULT_UDP_MAX_SESSIONS,
+        type=int,
+        default=forward.DEFAULT_UDP_MAX_SESSIONS,
+    )
+    parser_forward.add_argument(
+        "--backends",
+        help="upstream backends of ports, such as 80=127.0.0.1:8080,127.0.0.1:8081;443=127.0.0.1:8443, default is 127.0.0.1 with the same port",
+        default="",
+    )
+    parser_forward.add_argument(
+        "--balance",
+        help="balance policy of backends, default is round-robin",
+        choices=forward.BALANCE_POLICIES,
+        default="round-robin",
+    )
+    parser_forward.add_argument(
+        "--connect-timeout",
+        help="seconds to connect a backend before trying the next, default is %d"
+        % forward.DEFAULT_CONNECT_TIMEOUT,
+        type=float,
+        default=forward.DEFAULT_CONNECT_TIMEOUT,
+    )
+    parser_forward.add_argument(
+        "--max-failures",
+        help="consecutive failures to eject a backend, default is %d"
+        % forward.DEFAULT_MAX_FAILURES,
+        type=int,
+        default=forward.DEFAULT_MAX_FAILURES,
+    )
+    parser_forward.add_argument(
+        "--fail-cooldown",
+        help="seconds an ejected backend is skipped, default is %d"
+        % forward.DEFAULT_FAIL_COOLDOWN,
+        type=int,
+        default=forward.DEFAULT_FAIL_COOLDOWN,
+    )
+    parser_forward.add_argument(
+        "--idle-timeout",
+        help="seconds before an idle tcp connection is closed, default is 0 means never",
+        type=int,
+        default=0,
+    )
+    parser_forward.add_argument(
+        "--max-lifetime",
+        help="max seconds of a tcp connection, default is 0 means unlimited",
+        type=int,
+        default=0,
+    )
+    parser_forward.add_argument(
+        "--max-connections",
+        help="max tcp connections of all ports, default is 0 means unlimited",
+        type=int,
+        default=0,
+    )
+    parser_forward.add_argument(
+        "--max-connections-per-ip",
+        help="max tcp connections from one source ip, default is 0 means unlimited",
+        type=int,
+        default=0,
+    )
+    parser_forward.add_argument(
+        "--setup-concurrency",
+        help="max ports set up at the same time on start, default is %d"
+        % manager.DEFAULT_SETUP_CONCURRENCY,
+        type=int,
+        default=manager.DEFAULT_SETUP_CONCURRENCY,
     )
     parser_forward.set_defaults(func=forward_ports)
+    forward_subparsers = parser_forward.add_subparsers(dest="forward_command")
+    parser_forward_add = forward_subparsers.add_parser("add")
+    parser_forward_add.add_argument(
+        "--port", help="port to forward", type=int, required=True
+    )
+    parser_forward_add.add_argument(
+        "--udp", help="forward udp port", default=False, action="store_true"
+    )
+    parser_forward_add.add_argument(
+        "--backends", help="upstream backends such as 127.0.0.1:8080,127.0.0.1:8081"
+    )
+    parser_forward_remove = forward_subparsers.add_parser("remove")
+    parser_forward_remove.add_argument(
+        "--port", help="port to stop forwarding", type=int, required=True
+    )
+    parser_forward_remove.add_argument(
+        "--udp", help="stop forwarding udp port", default=False, action="store_true"
+    )
+    forward_subparsers.add_parser("ls")
+
+    parser_cache = subparsers.add_parser("cache")
+    parser_cache.set_defaults(func=manage_cache)
+    cache_subparsers = parser_cache.add_subparsers(dest="cache_command")
+    cache_subparsers.add_parser("ls")
+    parser_cache_prune = cache_subparsers.add_parser("prune")
+    parser_cache_prune.add_argument(
+        "--max-size",
+        help="max MB of images to keep, 0 to remove all, default is --cache-max-size",
+        type=float,
+    )
 
     args = sys.argv[1:]
     if not args:
@@ -666,6 +1019,11 @@ def main():
         return 0
 
     args = parser.parse_args(args)
+    if args.refresh:
+        facts.invalidate()
+    utils.default_command_timeout = args.command_timeout
+    downloader.default_progress_mode = args.progress
+    utils.set_deadline(args.deadline)
     args.func(args)
 
 
@@ -0,0 +1,423 @@
+# -*- coding: UTF-8 -*-
+
+"""Extract WSL distribution from Appx packages
+
+Images are either an Appx package, or an Appx bundle containing packages of
+several architectures. Only the package matching the architecture is read,
+and only its manifest, launcher and rootfs are extracted. Packages stored
+uncompressed in a bundle, which is what MakeAppx does, are read in place
+through a window of the bundle file, so no intermediate package is written.
+Images can also be read from url directly, then only the zip directories and
+the extracted members are downloaded.
+"""
+
+import concurrent.futures
+import fnmatch
+import io
+import json
+import os
+import platform
+import struct
+import sys
+import threading
+import time
+import zipfile
+from xml.dom import minidom
+
+from . import downloader
+from . import remote
+from . import utils
+
+BUNDLE_MANIFEST = "AppxMetadata/AppxBundleManifest.xml"
+PACKAGE_MANIFEST = "AppxManifest.xml"
+# Rootfs archives read by distribution launchers
+ROOTFS_NAMES = ("install.tar.gz", "install.tar", "install.tar.xz")
+ARCHITECTURES = {
+    "amd64": "x64",
+    "x86_64": "x64",
+    "arm64": "arm64",
+    "aarch64": "arm64",
+    "x86": "x86",
+}
+COPY_BUFFER_SIZE = 1024 * 1024
+DEFAULT_EXTRACT_WORKERS = 4
+WINDOWS_ILLEGAL_CHARS = str.maketrans(':<>|"?*', "_______")
+
+
+def get_architecture(machine=None):
+    """Appx architecture name of machine, default is current machine"""
+    machine = (machine or platform.machine()).lower()
+    return ARCHITECTURES.get(machine, machine)
+
+
+class FileWindow(io.RawIOBase):
+    """Readonly seekable view of `size` bytes at `offset` of a file object"""
+
+    def __init__(self, fileobj, offset, size):
+        super(FileWindow, self).__init__()
+        self._fileobj = fileobj
+        self._offset = offset
+        self._size = size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("Negative seek position %d" % offset)
+        self._position = offset
+        return offset
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._size - self._position)
+        if size <= 0:
+            return 0
+        self._fileobj.seek(self._offset + self._position)
+        data = self._fileobj.read(size)
+        buffer[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+def get_data_offset(fileobj, info):
+    """Offset of member data in zip file, after the local file header"""
+    fileobj.seek(info.header_offset)
+    header = fileobj.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad local file header of %s" % info.filename)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+
+
+def open_nested_zip(zf, name, fileobj):
+    """Open member `name` of zip file `zf` as zip file
+
+    :param fileobj: another file object of the outer file, not closed with
+                    the returned zip file
+    """
+    info = zf.getinfo(name)
+    if info.compress_type == zipfile.ZIP_STORED:
+        offset = get_data_offset(fileobj, info)
+        return zipfile.ZipFile(FileWindow(fileobj, offset, info.file_size))
+    # Compressed member is decompressed again on each backward seek
+    utils.logger.warning("[Appx] Package %s is compressed in bundle" % name)
+    return zipfile.ZipFile(zf.open(name))
+
+
+def parse_bundle_manifest(data):
+    """Get packages of bundle
+
+    :return: list of dict with type, architecture and filename
+    """
+    dom = minidom.parseString(data)
+    packages = []
+    for node in dom.getElementsByTagName("Package"):
+        packages.append(
+            {
+                "type": node.getAttribute("Type") or "application",
+                "architecture": node.getAttribute("Architecture").lower(),
+                "filename": node.getAttribute("FileName"),
+            }
+        )
+    return packages
+
+
+def select_package(zf, architecture):
+    """Name of package in bundle matching architecture"""
+    candidates = []
+    if BUNDLE_MANIFEST in zf.namelist():
+        packages = parse_bundle_manifest(zf.read(BUNDLE_MANIFEST))
+        candidates = [
+            it["filename"]
+            for it in packages
+            if it["type"] == "application" and it["architecture"] == architecture
+        ]
+        candidates += [
+            it["filename"]
+            for it in packages
+            if it["type"] == "application" and it["architecture"] == "neutral"
+        ]
+    # Bundles without manifest use names like Ubuntu_2004.2020.424.0_x64.appx
+    candidates += fnmatch.filter(zf.namelist(), "*_%s.appx" % architecture)
+    for name in candidates:
+        if name in zf.namelist():
+            return name
+    raise RuntimeError("No %s package found in bundle" % architecture)
+
+
+def get_executable(package):
+    dom = minidom.parseString(package.read(PACKAGE_MANIFEST))
+    nodes = dom.getElementsByTagName("Application")
+    executable = nodes[0].getAttribute("Executable") if nodes else ""
+    if not executable:
+        raise RuntimeError("Invalid %s, executable not found" % PACKAGE_MANIFEST)
+    return executable.replace("\\", "/")
+
+
+def get_save_path(install_path, name):
+    """Path to save member `name` in install_path
+
+    Drive, absolute and `..` components are removed like `ZipFile.extract`
+    does, so members can not be written outside install_path.
+    """
+    path = name.replace("/", os.path.sep)
+    if os.path.altsep:
+        path = path.replace(os.path.altsep, os.path.sep)
+    path = os.path.splitdrive(path)[1]
+    parts = [
+        it
+        for it in path.split(os.path.sep)
+        if it not in ("", os.path.curdir, os.path.pardir)
+    ]
+    if os.path.sep == "\\":
+        # Characters not allowed in windows file names
+        parts = [
+            it.translate(WINDOWS_ILLEGAL_CHARS).rstrip(". ") or "_" for it in parts
+        ]
+    if not parts:
+        raise RuntimeError("Invalid member name %s" % name)
+    install_path = os.path.abspath(install_path)
+    save_path = os.path.abspath(os.path.join(install_path, *parts))
+    if os.path.commonpath([install_path, save_path]) != install_path:
+        raise RuntimeError("Member %s is outside of %s" % (name, install_path))
+    return save_path
+
+
+class ExtractProgress(object):
+    """Aggregate progress of extracting workers, written to stdout at most
+    once per `interval` seconds
+
+    :param mode: progress mode in `downloader.PROGRESS_MODES`, default is
+                 `downloader.default_progress_mode`
+    """
+
+    def __init__(self, total_size, total_files, interval=0.2, output=None, mode=None):
+        self._total_size = total_size
+        self._total_files = total_files
+        self._interval = interval
+        self._mode = mode or downloader.default_progress_mode
+        self._output = output or sys.stdout
+        self._lock = threading.Lock()
+        self._done_size = 0
+        self._done_files = 0
+        self._time0 = time.time()
+        self._last_time = 0
+
+    def update(self, size=0, files=0):
+        with self._lock:
+            self._done_size += size
+            self._done_files += files
+            now = time.time()
+            if now - self._last_time < self._interval:
+                return
+            self._last_time = now
+            self._write()
+
+    def _write(self, event="progress"):
+        if self._mode == "quiet":
+            return
+        percent = 100.0
+        if self._total_size:
+            percent = self._done_size / self._total_size * 100
+        speed = self._done_size / max(time.time() - self._time0, 1e-3)
+        if self._mode == "json":
+            item = {
+                "event": "extract_%s" % event,
+                "done": self._done_size,
+                "total": self._total_size,
+                "files": self._done_files,
+                "total_files": self._total_files,
+                "speed": round(speed, 1),
+            }
+            self._output.write(json.dumps(item) + "\n")
+            self._output.flush()
+            return
+        speed = downloader.format_speed(speed)
+        self._output.write(
+            "\r[+] Extract %.2f%% %d/%d files %s"
+            % (percent, self._done_files, self._total_files, speed)
+        )
+        self._output.flush()
+
+    def finish(self):
+        with self._lock:
+            self._write("done")
+            if self._mode == "bar":
+                self._output.write("\n")
+                self._output.flush()
+
+
+def extract_member(package, info, save_path, progress=None):
+    with package.open(info) as src, open(save_path, "wb") as dst:
+        if info.file_size:
+            # Preallocate so the file is not extended on each write
+            dst.truncate(info.file_size)
+        while True:
+            data = src.read(COPY_BUFFER_SIZE)
+            if not data:
+                break
+            dst.write(data)
+            if progress:
+                progress.update(len(data))
+    if progress:
+        progress.update(files=1)
+
+
+class AppxImage(object):
+    """WSL distribution image of Appx package or bundle
+
+    Each extracting thread opens its own handles of the image.
+
+    :param path: path or url of image file, only needed ranges of url are
+                 downloaded
+    :param architecture: appx architecture of package to extract, default is
+                         architecture of current machine
+    """
+
+    def __init__(self, path, architecture=None):
+        self._path = path
+        self._architecture = architecture or get_architecture()
+        # Handles to close, the latest opened first
+        self._handles = []
+        self._local = threading.local()
+        self._package_name = None
+
+    def _add_handle(self, handle):
+        self._handles.insert(0, handle)
+        return handle
+
+    def _open_file(self):
+        if remote.is_remote_path(self._path):
+            fileobj = remote.RemoteFile(self._path)
+        else:
+            fileobj = open(self._path, "rb")
+        return self._add_handle(fileobj)
+
+    def _open_package(self):
+        zf = self._add_handle(zipfile.ZipFile(self._open_file()))
+        if PACKAGE_MANIFEST in zf.namelist():
+            return zf
+        if self._package_name is None:
+            self._package_name = select_package(zf, self._architecture)
+            utils.logger.info(
+                "[%s] Select package %s" % (self.__class__.__name__, self._package_name)
+            )
+        return self._add_handle(
+            open_nested_zip(zf, self._package_name, self._open_file())
+        )
+
+    @property
+    def _package(self):
+        """Package handle of current thread"""
+        package = getattr(self._local, "package", None)
+        if package is None:
+            package = self._local.package = self._open_package()
+        return package
+
+    def open(self):
+        self._local.package = self._open_package()
+
+    def close(self):
+        for handle in self._handles:
+            handle.close()
+        self._handles = []
+        self._local = threading.local()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_members(self):
+        """Members to extract: manifest, launcher and rootfs
+
+        :return: list of (member name, relative path to save)
+        """
+        names = self._package.namelist()
+        executable = get_executable(self._package)
+        if executable not in names:
+            raise RuntimeError(
+                "Launcher %s not found in %s"
+                % (executable, self._package_name or self._path)
+            )
+        members = [
+            (PACKAGE_MANIFEST, PACKAGE_MANIFEST),
+            # Launcher reads rootfs from its own directory
+            (executable, os.path.basename(executable)),
+        ]
+        rootfs = [it for it in names if it in ROOTFS_NAMES]
+        if rootfs:
+            members += [(it, it) for it in rootfs]
+        else:
+            utils.logger.warning(
+                "[%s] Rootfs not found, extract all files" % self.__class__.__name__
+            )
+            extracted = [it[0] for it in members]
+            members += [
+                (it, it) for it in names if it not in extracted and not it.endswith("/")
+            ]
+        return members
+
+    def extract(self, install_path, workers=DEFAULT_EXTRACT_WORKERS):
+        """Extract distribution to install_path, members are extracted
+        concurrently by `workers` threads
+
+        :return: path of launcher
+        """
+        members = self.get_members()
+        infos = []
+        for name, path in members:
+            save_path = get_save_path(install_path, path)
+            os.makedirs(os.path.dirname(save_path), exist_ok=True)
+            infos.append((self._package.getinfo(name), save_path))
+        # Start large members first so they do not finish last
+        infos.sort(key=lambda it: it[0].file_size, reverse=True)
+        progress = ExtractProgress(sum(it[0].file_size for it in infos), len(infos))
+        with concurrent.futures.ThreadPoolExecutor(
+            max(min(workers, len(infos)), 1)
+        ) as executor:
+            futures = [
+                executor.submit(self._extract_member, info, save_path, progress)
+                for info, save_path in infos
+            ]
+            for future in futures:
+                future.result()
+        progress.finish()
+        fetched = sum(getattr(it, "fetched", 0) for it in self._handles)
+        if fetched:
+            utils.logger.info(
+                "[%s] %d bytes of %s fetched"
+                % (self.__class__.__name__, fetched, self._path)
+            )
+        return get_save_path(install_path, members[1][1])
+
+    def _extract_member(self, info, save_path, progress):
+        utils.logger.debug(
+            "[%s] Extract %s to %s"
+            % (self.__class__.__name__, info.filename, save_path)
+        )
+        extract_member(self._package, info, save_path, progress)
+
+
+def extract_image(
+    path, install_path, architecture=None, workers=DEFAULT_EXTRACT_WORKERS
+):
+    """Extract WSL distribution image to install_path
+
+    :return: path of launcher
+    """
+    with AppxImage(path, architecture) as image:
+        return image.extract(install_path, workers)
@@ -0,0 +1,331 @@
+# -*- coding: UTF-8 -*-
+
+"""Local cache of downloaded images
+
+Images are stored by their content digest, see `downloader.CONTENT_DIGEST`,
+so urls pointing to the same file share one blob. Cached images are trusted
+by their content address and only hashed again if asked, or to check an
+expected sha256 not recorded for them yet. Each url records the ETag and Last-Modified of
+the download, cached images are revalidated with a conditional request and
+only downloaded again if the remote file changed. Least recently used images
+are evicted when the cache grows over `max_size`.
+
+The cache directory may be a network share used by several machines, index
+and blobs are replaced atomically and unfinished downloads are named by host.
+"""
+
+import hashlib
+import json
+import os
+import platform
+import time
+
+from . import downloader
+from . import utils
+
+DEFAULT_MAX_SIZE = 20 * 1024 * 1024 * 1024
+INDEX_VERSION = 2
+
+
+def get_default_cache_dir():
+    path = os.environ.get("EZWSL_CACHE_DIR")
+    if path:
+        return path
+    root = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    return os.path.join(root, "easywsl", "images")
+
+
+class ImageCache(object):
+    """Content addressed image cache
+
+    :param path: cache directory, may be a network share
+    :param max_size: max bytes of cached images, 0 for unlimited
+    """
+
+    def __init__(self, path=None, max_size=DEFAULT_MAX_SIZE):
+        self._path = path or get_default_cache_dir()
+        self._max_size = max_size
+        self._blob_dir = os.path.join(self._path, "blobs")
+        self._temp_dir = os.path.join(self._path, "tmp")
+        self._index_path = os.path.join(self._path, "index.json")
+
+    @property
+    def path(self):
+        return self._path
+
+    def get_blob_path(self, digest):
+        return os.path.join(self._blob_dir, digest)
+
+    def _load_index(self):
+        if os.path.isfile(self._index_path):
+            try:
+                with open(self._index_path) as fp:
+                    index = json.load(fp)
+                if index.get("version") == INDEX_VERSION:
+                    return index["entries"]
+            except (OSError, ValueError, KeyError):
+                utils.logger.warning(
+                    "[%s] Invalid cache index %s ignored"
+                    % (self.__class__.__name__, self._index_path)
+                )
+        return {}
+
+    def _save_index(self, entries):
+        os.makedirs(self._path, exist_ok=True)
+        temp_path = "%s.%s.tmp" % (self._index_path, platform.node())
+        with open(temp_path, "w") as fp:
+            json.dump({"version": INDEX_VERSION, "entries": entries}, fp, indent=2)
+        os.replace(temp_path, self._index_path)
+
+    def _update_entry(self, url, entry):
+        # Reload index as other machines may share the cache
+        entries = self._load_index()
+        if entry:
+            entries[url] = entry
+        else:
+            entries.pop(url, None)
+        self._save_index(entries)
+        return entries
+
+    def lookup(self, url, expected=None):
+        """Cached entry of url
+
+        :param expected: expected digests such as {"sha256": "..."}
+        :return: None if not cached, the blob is missing or does not match
+                 expected size and digest
+        """
+        entry = self._load_index().get(url)
+        if not entry:
+            return None
+        blob_path = self.get_blob_path(entry["digest"])
+        if not os.path.isfile(blob_path):
+            return None
+        if os.path.getsize(blob_path) != entry["size"]:
+            utils.logger.warning(
+                "[%s] Size of cached image %s mismatch"
+                % (self.__class__.__name__, entry["digest"])
+            )
+            return None
+        expected = expected or {}
+        sha256 = entry.get("sha256")
+        if (
+            sha256
+            and expected.get("sha256", sha256).lower() != sha256
+            or expected.get("size", entry["size"]) != entry["size"]
+        ):
+            utils.logger.warning(
+                "[%s] Cached image %s of %s does not match expected digest"
+                % (self.__class__.__name__, entry["digest"], url)
+            )
+            return None
+        return entry
+
+    def verify(self, entry):
+        """Hash cached image of entry, record its sha256 in entry
+
+        :return: False if content of blob does not match its digest
+        """
+        digests = downloader.hash_file(self.get_blob_path(entry["digest"]), ["sha256"])
+        if digests[downloader.CONTENT_DIGEST] != entry["digest"]:
+            return False
+        entry["sha256"] = digests["sha256"]
+        return True
+
+    def _remove_blob(self, digest):
+        try:
+            os.remove(self.get_blob_path(digest))
+        except FileNotFoundError:
+            pass
+        entries = self._load_index()
+        for url, entry in list(entries.items()):
+            if entry["digest"] == digest:
+                entries.pop(url)
+        self._save_index(entries)
+
+    def fetch(
+        self,
+        url,
+        revalidate=True,
+        segments=downloader.DEFAULT_SEGMENTS,
+        expected=None,
+        verify=False,
+    ):
+        """Get local path of url, download it if not cached or changed
+
+        :param revalidate: check whether the cached image is still up to date
+        :param expected: expected digests such as {"sha256": "..."}, images
+                         not matching them are never returned
+        :param verify: hash cached image again, corrupted image is removed
+                       and downloaded again
+        """
+        expected = expected or {}
+        entry = self.lookup(url, expected)
+        if entry and (verify or ("sha256" in expected and "sha256" not in entry)):
+            if not self.verify(entry):
+                utils.logger.warning(
+                    "[%s] Cached image %s is corrupted, remove it"
+                    % (self.__class__.__name__, entry["digest"])
+                )
+                self._remove_blob(entry["digest"])
+                entry = None
+            elif expected.get("sha256", entry["sha256"]).lower() != entry["sha256"]:
+                utils.logger.warning(
+                    "[%s] Cached image %s of %s does not match expected digest"
+                    % (self.__class__.__name__, entry["digest"], url)
+                )
+                entry = None
+        if entry:
+            modified = False
+            if revalidate:
+                try:
+                    modified = downloader.is_modified(
+                        url, entry.get("etag"), entry.get("last_modified")
+                    )
+                except OSError as e:
+                    # Use cached image when offline
+                    utils.logger.warning(
+                        "[%s] Revalidate %s failed: %s"
+                        % (self.__class__.__name__, url, e)
+                    )
+            if not modified:
+                utils.logger.info(
+                    "[%s] Use cached image %s of %s"
+                    % (self.__class__.__name__, entry["digest"], url)
+                )
+                entry["last_used"] = time.time()
+                self._update_entry(url, entry)
+                return self.get_blob_path(entry["digest"])
+            utils.logger.info("[%s] Image %s changed" % (self.__class__.__name__, url))
+        return self._download(url, segments, expected)
+
+    def _download(self, url, segments, expected):
+        os.makedirs(self._blob_dir, exist_ok=True)
+        os.makedirs(self._temp_dir, exist_ok=True)
+        # Unfinished downloads are kept to resume
+        temp_path = os.path.join(
+            self._temp_dir,
+            "%s-%s.img"
+            % (hashlib.sha256(url.encode()).hexdigest()[:16], platform.node()),
+        )
+        image_downloader = downloader.Downloader(
+            url, temp_path, segments, expected=expected
+        )
+        image_downloader.download()
+        digest = image_downloader.digests[downloader.CONTENT_DIGEST]
+        blob_path = self.get_blob_path(digest)
+        if os.path.isfile(blob_path):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, blob_path)
+        now = time.time()
+        entry = {
+            "digest": digest,
+            "size": os.path.getsize(blob_path),
+            "etag": image_downloader.info["etag"],
+            "last_modified": image_downloader.info["last_modified"],
+            "time": now,
+            "last_used": now,
+        }
+        if "sha256" in image_downloader.digests:
+            entry["sha256"] = image_downloader.digests["sha256"]
+        entries = self._update_entry(url, entry)
+        if self._max_size:
+            self._evict(entries, self._max_size, keep=digest)
+        return blob_path
+
+    def list(self):
+        """List of cached images sorted by last used time, latest first
+
+        :return: list of dict with url, digest, size, time and last_used
+        """
+        result = []
+        for url, entry in self._load_index().items():
+            if os.path.isfile(self.get_blob_path(entry["digest"])):
+                result.append(dict(entry, url=url))
+        result.sort(key=lambda it: it["last_used"], reverse=True)
+        return result
+
+    def _get_blobs(self, entries):
+        """Blobs in cache
+
+        :return: dict of digest => {"size", "last_used", "urls"}
+        """
+        blobs = {}
+        if os.path.isdir(self._blob_dir):
+            for digest in os.listdir(self._blob_dir):
+                path = self.get_blob_path(digest)
+                blobs[digest] = {
+                    "size": os.path.getsize(path),
+                    "last_used": os.path.getmtime(path),
+                    "urls": [],
+                }
+        for url, entry in entries.items():
+            blob = blobs.get(entry["digest"])
+            if blob:
+                blob["urls"].append(url)
+                blob["last_used"] = max(blob["last_used"], entry["last_used"])
+        return blobs
+
+    def _evict(self, entries, max_size, keep=None):
+        blobs = self._get_blobs(entries)
+        total_size = sum(it["size"] for it in blobs.values())
+        removed = []
+        for digest, blob in sorted(blobs.items(), key=lambda it: it[1]["last_used"]):
+            if total_size <= max_size:
+                break
+            if digest == keep:
+                continue
+            utils.logger.info(
+                "[%s] Evict image %s of %s"
+                % (self.__class__.__name__, digest, ", ".join(blob["urls"]))
+            )
+            try:
+                os.remove(self.get_blob_path(digest))
+            except FileNotFoundError:
+                pass
+            total_size -= blob["size"]
+            removed.append(digest)
+        if removed:
+            entries = self._load_index()
+            for url, entry in list(entries.items()):
+                if entry["digest"] in removed:
+                    entries.pop(url)
+            self._save_index(entries)
+        return removed
+
+    def prune(self, max_size=None):
+        """Evict least recently used images until cache size is under max_size
+
+        Index entries of missing blobs and unfinished downloads of this
+        machine or older than a day are removed.
+
+        :param max_size: max bytes to keep, default is the cache max size,
+                         0 to remove all images
+        :return: list of removed digests
+        """
+        entries = self._load_index()
+        for url, entry in list(entries.items()):
+            if not os.path.isfile(self.get_blob_path(entry["digest"])):
+                entries.pop(url)
+        self._save_index(entries)
+        self._clean_temp_files()
+        if max_size is None:
+            if not self._max_size:
+                return []
+            max_size = self._max_size
+        return self._evict(entries, max_size)
+
+    def _clean_temp_files(self, max_age=24 * 3600):
+        if not os.path.isdir(self._temp_dir):
+            return
+        suffix = "-%s.img" % platform.node()
+        for it in os.listdir(self._temp_dir):
+            path = os.path.join(self._temp_dir, it)
+            try:
+                if (
+                    it.split(".part")[0].endswith(suffix)
+                    or time.time() - os.path.getmtime(path) > max_age
+                ):
+                    os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,720 @@
+# -*- coding: UTF-8 -*-
+
+"""Download files with parallel ranged requests
+
+The file is split to segments which are downloaded concurrently with HTTP
+Range requests into a preallocated `<save_path>.part` file. Progress is
+saved to `<save_path>.part.json`, so an interrupted download resumes if the
+remote file is not changed. Files of servers not supporting range requests
+are downloaded with one request.
+
+Digests are computed while downloading without reading the file back:
+segments start at `DIGEST_BLOCK_SIZE` boundaries and every connection hashes
+the blocks of its segment as they arrive, the content digest is the sha256
+of the block digests in order, so it does not depend on the number of
+segments. Digests of finished blocks are saved with the progress. Other
+digests such as the plain sha256 are only computed if they are expected:
+bytes following the hashed prefix are hashed as they arrive, bytes of later
+segments are read back from the part file once the prefix reaches them. The
+file is removed without being renamed to `save_path` if its digests do not
+match the expected ones.
+
+Each connection reads into its own reusable buffer. Progress is reported by
+a `ProgressReporter` at most `DEFAULT_PROGRESS_RATE` times per second, as a
+line updated in place, json lines for unattended runs, or nothing.
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from . import utils
+
+DEFAULT_SEGMENTS = 4
+DIGEST_BLOCK_SIZE = 4 * 1024 * 1024
+# Name of the digest of block digests
+CONTENT_DIGEST = "sha256-blocks"
+CHUNK_SIZE = 256 * 1024
+MAX_RETRIES = 5
+STATE_SAVE_INTERVAL = 1
+DEFAULT_TIMEOUT = 30
+DEFAULT_PROGRESS_RATE = 4
+PROGRESS_MODES = ("bar", "json", "quiet")
+
+# Progress mode of downloads with progress enabled
+default_progress_mode = "bar"
+
+
+def get_proxies():
+    proxies = {}
+    for scheme in ("http", "https"):
+        proxy = os.environ.get("%s_proxy" % scheme)
+        if proxy:
+            proxies[scheme] = proxy
+    return proxies
+
+
+def build_opener():
+    proxies = get_proxies()
+    if proxies:
+        return urllib.request.build_opener(urllib.request.ProxyHandler(proxies))
+    return urllib.request.build_opener()
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+    return "%02d:%02d" % (seconds // 60, seconds % 60)
+
+
+def format_speed(speed):
+    unit = "B/s"
+    if speed > 1024:
+        speed /= 1024
+        unit = "KB/s"
+    if speed > 1024:
+        speed /= 1024
+        unit = "MB/s"
+    return "%.2f%s" % (speed, unit)
+
+
+class ProgressReporter(object):
+    """Report progress at most `rate` times per second
+
+    Speed is smoothed with an exponential moving average, ETA is estimated
+    from the smoothed speed.
+
+    :param mode: `bar` writes a line updated in place, `json` writes a json
+                 object per line, `quiet` writes nothing
+    :param smoothing: weight of the latest speed sample
+    """
+
+    def __init__(
+        self,
+        name,
+        total=None,
+        mode="bar",
+        rate=DEFAULT_PROGRESS_RATE,
+        smoothing=0.3,
+        output=None,
+    ):
+        if mode not in PROGRESS_MODES:
+            raise ValueError("Invalid progress mode %s" % mode)
+        self._name = name
+        self._mode = mode
+        self._interval = 1.0 / rate
+        self._smoothing = smoothing
+        self._output = output or sys.stdout
+        self._lock = threading.Lock()
+        self.start(total)
+
+    @property
+    def speed(self):
+        """Smoothed bytes per second"""
+        return self._speed or 0
+
+    def start(self, total=None, done=0):
+        """Start reporting, `done` bytes such as resumed bytes are excluded
+        from speed"""
+        with self._lock:
+            self._total = total
+            self._time0 = self._last_time = time.time()
+            self._done0 = self._last_done = done
+            self._speed = None
+
+    def update(self, done, force=False):
+        """Report `done` bytes if the last report is older than the interval"""
+        now = time.time()
+        if not force and now - self._last_time < self._interval:
+            return
+        with self._lock:
+            elapsed = now - self._last_time
+            if not force and elapsed < self._interval:
+                return
+            if elapsed > 0 and done >= self._last_done:
+                speed = (done - self._last_done) / elapsed
+                if self._speed is None:
+                    self._speed = speed
+                else:
+                    self._speed += self._smoothing * (speed - self._speed)
+            self._last_time = now
+            self._last_done = done
+            self._write("progress", done)
+
+    def _get_eta(self, done):
+        if not self._total or not self._speed:
+            return None
+        return max(self._total - done, 0) / self._speed
+
+    def _write(self, event, done):
+        if self._mode == "quiet":
+            return
+        eta = self._get_eta(done)
+        if self._mode == "json":
+            item = {
+                "event": event,
+                "name": self._name,
+                "done": done,
+                "total": self._total,
+                "speed": round(self.speed, 1),
+                "eta": None if eta is None else round(eta, 1),
+                "elapsed": round(time.time() - self._time0, 1),
+            }
+            self._output.write(json.dumps(item) + "\n")
+        elif self._total:
+            self._output.write(
+                "\r%.2f%% %d/%d %s ETA %s  "
+                % (
+                    done / self._total * 100,
+                    done,
+                    self._total,
+                    format_speed(self.speed),
+                    "--:--" if eta is None else format_duration(eta),
+                )
+            )
+        else:
+            self._output.write("\r%d %s  " % (done, format_speed(self.speed)))
+        self._output.flush()
+
+    def finish(self, done):
+        with self._lock:
+            elapsed = time.time() - self._time0
+            # Report average speed of whole download
+            self._speed = (done - self._done0) / max(elapsed, 1e-3)
+            self._write("done", done)
+            if self._mode == "bar":
+                self._output.write("\n")
+                self._output.flush()
+
+
+class DigestMismatchError(RuntimeError):
+    """Downloaded file does not match the expected size or digest"""
+
+
+class FileHasher(object):
+    """Incremental digests of a file written out of order
+
+    :param algorithms: names of hashlib algorithms
+    """
+
+    def __init__(self, algorithms=("sha256",)):
+        self._hashes = collections.OrderedDict(
+            (name, hashlib.new(name)) for name in algorithms
+        )
+        self._offset = 0
+
+    @property
+    def offset(self):
+        """Bytes hashed from beginning of file"""
+        return self._offset
+
+    def update(self, offset, data):
+        """Hash data written at offset if it follows the hashed bytes
+
+        :return: True if data is hashed
+        """
+        if offset != self._offset:
+            return False
+        for it in self._hashes.values():
+            it.update(data)
+        self._offset += len(data)
+        return True
+
+    def hexdigests(self):
+        return {name: it.hexdigest() for name, it in self._hashes.items()}
+
+
+class BlockHasher(object):
+    """sha256 digests of `DIGEST_BLOCK_SIZE` blocks of data hashed in order
+
+    :param digests: digests of blocks hashed before
+    """
+
+    def __init__(self, digests=()):
+        self.digests = list(digests)
+        self._hash = hashlib.sha256()
+        self._size = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            size = min(len(view), DIGEST_BLOCK_SIZE - self._size)
+            self._hash.update(view[:size])
+            self._size += size
+            view = view[size:]
+            if self._size == DIGEST_BLOCK_SIZE:
+                self.digests.append(self._hash.hexdigest())
+                self._hash = hashlib.sha256()
+                self._size = 0
+
+    def finish(self):
+        """Digests of all blocks, including the last partial block"""
+        if self._size or not self.digests:
+            self.digests.append(self._hash.hexdigest())
+            self._hash = hashlib.sha256()
+            self._size = 0
+        return self.digests
+
+
+def combine_digests(digests):
+    """Content digest of block digests"""
+    hasher = hashlib.sha256()
+    for it in digests:
+        hasher.update(bytes.fromhex(it))
+    return hasher.hexdigest()
+
+
+def hash_file(path, algorithms=()):
+    """Digests of a local file in one pass
+
+    :return: dict such as {CONTENT_DIGEST: "...", "sha256": "..."}
+    """
+    hasher = FileHasher(algorithms)
+    block_hasher = BlockHasher()
+    with open(path, "rb") as fp:
+        while True:
+            data = fp.read(DIGEST_BLOCK_SIZE)
+            if not data:
+                break
+            hasher.update(hasher.offset, data)
+            block_hasher.update(data)
+    digests = hasher.hexdigests()
+    digests[CONTENT_DIGEST] = combine_digests(block_hasher.finish())
+    return digests
+
+
+def verify_digests(digests, expected):
+    """Raise DigestMismatchError if digests do not match expected digests"""
+    for name, value in expected.items():
+        if name in digests and digests[name] != value.lower():
+            raise DigestMismatchError(
+                "%s mismatch, expected %s but got %s" % (name, value, digests[name])
+            )
+
+
+class Segment(object):
+    """Range of file from `start` to `end`(inclusive), `done` bytes are
+    downloaded and hashed by `hasher`"""
+
+    def __init__(self, start, end, done=0):
+        self.start = start
+        self.end = end
+        self.done = done
+        self.hasher = BlockHasher()
+
+    @property
+    def size(self):
+        return self.end - self.start + 1
+
+    @property
+    def completed(self):
+        return self.done >= self.size
+
+
+class Downloader(object):
+    """Download url to save_path
+
+    :param segments: max concurrent range requests
+    :param progress: progress mode in `PROGRESS_MODES`, True for
+                     `default_progress_mode`, False for quiet
+    :param chunk_size: bytes read from connection at once
+    :param expected: expected digests such as {"sha256": "..."}, "size" may
+                     be given to fail before downloading a file of other size
+    """
+
+    def __init__(
+        self,
+        url,
+        save_path,
+        segments=DEFAULT_SEGMENTS,
+        progress=True,
+        timeout=DEFAULT_TIMEOUT,
+        expected=None,
+        chunk_size=CHUNK_SIZE,
+    ):
+        self._url = url
+        self._save_path = save_path
+        self._part_path = save_path + ".part"
+        self._state_path = self._part_path + ".json"
+        self._max_segments = max(segments, 1)
+        if progress is True:
+            progress = default_progress_mode
+        elif not progress:
+            progress = "quiet"
+        self._reporter = ProgressReporter(url, mode=progress)
+        self._chunk_size = chunk_size
+        self._timeout = timeout
+        self._opener = build_opener()
+        self._info = None
+        self._segments = []
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._downloaded = 0
+        self._expected = dict(expected or {})
+        self._expected_size = self._expected.pop("size", None)
+        self._algorithms = [it for it in self._expected if it != CONTENT_DIGEST]
+        # Hasher of expected digests, None if nothing expected
+        self._hasher = None
+        # Block hasher of downloads without segments
+        self._block_hasher = None
+        self._digests = None
+
+    @property
+    def downloaded(self):
+        return self._downloaded
+
+    @property
+    def digests(self):
+        """Hex digests of downloaded file, `CONTENT_DIGEST` and the expected
+        ones, such as {"sha256-blocks": "...", "sha256": "..."}"""
+        return self._digests
+
+    @property
+    def info(self):
+        """Remote file info such as size, etag and last_modified"""
+        return self._info
+
+    def _open(self, url, start=None, end=None):
+        request = urllib.request.Request(url)
+        if start is not None:
+            request.add_header(
+                "Range", "bytes=%d-%s" % (start, "" if end is None else end)
+            )
+        return self._opener.open(request, timeout=self._timeout)
+
+    def _probe(self):
+        """Get remote file info
+
+        :return: (info, response), response is an opened response if range
+                 requests are not supported, otherwise None
+        """
+        response = self._open(self._url, 0, 0)
+        headers = response.headers
+        info = {
+            "url": self._url,
+            "location": response.geturl(),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "size": None,
+        }
+        if response.status == 206:
+            total = headers.get("Content-Range", "").rpartition("/")[2]
+            response.close()
+            if total.isdigit():
+                info["size"] = int(total)
+                return info, None
+            # Size unknown, download with one request
+            response = self._open(self._url)
+        length = response.headers.get("Content-Length")
+        if length and length.isdigit():
+            info["size"] = int(length)
+        return info, response
+
+    def _load_state(self):
+        if not os.path.isfile(self._state_path) or not os.path.isfile(self._part_path):
+            return False
+        try:
+            with open(self._state_path) as fp:
+                state = json.load(fp)
+        except (OSError, ValueError):
+            return False
+        for key in ("url", "size", "etag", "last_modified"):
+            if state.get(key) != self._info[key]:
+                return False
+        if os.path.getsize(self._part_path) != self._info["size"]:
+            return False
+        segments = []
+        try:
+            for start, end, done, digests in state["segments"]:
+                blocks = done // DIGEST_BLOCK_SIZE
+                if start % DIGEST_BLOCK_SIZE or len(digests) < blocks:
+                    return False
+                segment = Segment(start, end, done)
+                # Digests may be saved before `done` is increased
+                segment.hasher = BlockHasher(digests[:blocks])
+                segments.append(segment)
+        except (KeyError, TypeError, ValueError):
+            return False
+        # Only the partial block of each segment is hashed again
+        with open(self._part_path, "rb") as fp:
+            for segment in segments:
+                offset = segment.start + len(segment.hasher.digests) * DIGEST_BLOCK_SIZE
+                fp.seek(offset)
+                segment.hasher.update(fp.read(segment.start + segment.done - offset))
+        self._segments = segments
+        return True
+
+    def _save_state(self):
+        with self._lock:
+            state = dict(
+                self._info,
+                segments=[
+                    [it.start, it.end, it.done, list(it.hasher.digests)]
+                    for it in self._segments
+                ],
+            )
+        temp_path = self._state_path + ".tmp"
+        with open(temp_path, "w") as fp:
+            json.dump(state, fp)
+        os.replace(temp_path, self._state_path)
+
+    def _plan(self):
+        size = self._info["size"]
+        blocks = -(-size // DIGEST_BLOCK_SIZE)
+        count = max(min(self._max_segments, blocks), 1)
+        # Segments start at block boundaries
+        segment_size = -(-blocks // count) * DIGEST_BLOCK_SIZE
+        self._segments = [
+            Segment(start, min(start + segment_size, size) - 1)
+            for start in range(0, size, segment_size)
+        ]
+        with open(self._part_path, "wb") as fp:
+            fp.truncate(size)
+
+    def _write(self, fp, data):
+        view = memoryview(data)
+        while view:
+            view = view[fp.write(view) :]
+
+    def _download_segment(self, segment):
+        url = self._info["location"]
+        buffer = memoryview(bytearray(self._chunk_size))
+        retries = 0
+        while not segment.completed and not self._stopped:
+            try:
+                response = self._open(url, segment.start + segment.done, segment.end)
+                with response, open(self._part_path, "r+b", buffering=0) as fp:
+                    if response.status != 206:
+                        raise RuntimeError("Range request of %s not supported" % url)
+                    fp.seek(segment.start + segment.done)
+                    while not segment.completed and not self._stopped:
+                        size = response.readinto(
+                            buffer[: min(self._chunk_size, segment.size - segment.done)]
+                        )
+                        if not size:
+                            raise ConnectionError("Connection closed by server")
+                        data = buffer[:size]
+                        self._write(fp, data)
+                        segment.hasher.update(data)
+                        with self._lock:
+                            offset = segment.start + segment.done
+                            segment.done += size
+                            self._downloaded += size
+                            if self._hasher:
+                                self._hasher.update(offset, data)
+                        self._reporter.update(self._downloaded)
+                        retries = 0
+            except (OSError, http.client.HTTPException) as e:
+                retries += 1
+                if retries > MAX_RETRIES:
+                    raise
+                utils.logger.warning(
+                    "[%s] Download range %d-%d failed: %s, retry %d"
+                    % (
+                        self.__class__.__name__,
+                        segment.start + segment.done,
+                        segment.end,
+                        e,
+                        retries,
+                    )
+                )
+                time.sleep(min(2**retries, 30))
+
+    def _download_stream(self, response):
+        buffer = memoryview(bytearray(self._chunk_size))
+        retries = 0
+        while True:
+            try:
+                with response, open(self._part_path, "wb", buffering=0) as fp:
+                    while True:
+                        size = response.readinto(buffer)
+                        if not size:
+                            break
+                        data = buffer[:size]
+                        self._write(fp, data)
+                        self._block_hasher.update(data)
+                        if self._hasher:
+                            self._hasher.update(self._downloaded, data)
+                        self._downloaded += size
+                        self._reporter.update(self._downloaded)
+                if self._info["size"] and self._downloaded < self._info["size"]:
+                    raise ConnectionError("Connection closed by server")
+                return
+            except (OSError, http.client.HTTPException) as e:
+                retries += 1
+                if retries > MAX_RETRIES:
+                    raise
+                utils.logger.warning(
+                    "[%s] Download %s failed: %s, retry %d"
+                    % (self.__class__.__name__, self._url, e, retries)
+                )
+                time.sleep(min(2**retries, 30))
+                # Range not supported, download from beginning
+                self._downloaded = 0
+                self._reset_hashers()
+                response = self._open(self._info["location"])
+
+    def _get_downloaded_end(self):
+        """End of downloaded bytes from beginning of file"""
+        for segment in self._segments:
+            if not segment.completed:
+                return segment.start + segment.done
+        return self._info["size"]
+
+    def _hash_downloaded(self, fp):
+        """Hash downloaded bytes which were not hashed by the expected
+        digests when they arrived"""
+        while self._hasher:
+            with self._lock:
+                offset = self._hasher.offset
+                end = self._get_downloaded_end()
+            if offset >= end:
+                return
+            # Writers only write after `end`, so bytes before it are stable
+            fp.seek(offset)
+            data = fp.read(min(end - offset, 4 * self._chunk_size))
+            with self._lock:
+                self._hasher.update(offset, data)
+
+    def _download_segments(self):
+        if self._load_state():
+            self._downloaded = sum(it.done for it in self._segments)
+            utils.logger.info(
+                "[%s] Resume downloading %s from %d bytes"
+                % (self.__class__.__name__, self._url, self._downloaded)
+            )
+            self._reporter.start(self._info["size"], self._downloaded)
+        else:
+            self._plan()
+        segments = [it for it in self._segments if not it.completed]
+        with open(self._part_path, "rb") as fp:
+            if segments:
+                self._download_pending_segments(segments, fp)
+            self._hash_downloaded(fp)
+
+    def _download_pending_segments(self, segments, fp):
+        with concurrent.futures.ThreadPoolExecutor(len(segments)) as executor:
+            futures = [executor.submit(self._download_segment, it) for it in segments]
+            try:
+                while True:
+                    done, _ = concurrent.futures.wait(
+                        futures,
+                        timeout=STATE_SAVE_INTERVAL,
+                        return_when=concurrent.futures.FIRST_EXCEPTION,
+                    )
+                    self._save_state()
+                    self._hash_downloaded(fp)
+                    for future in done:
+                        # Raise error of segment
+                        future.result()
+                    if len(done) == len(futures):
+                        break
+            finally:
+                self._stopped = True
+                self._save_state()
+
+    def _reset_hashers(self):
+        self._hasher = FileHasher(self._algorithms) if self._algorithms else None
+        self._block_hasher = BlockHasher()
+
+    def _verify(self):
+        if self._segments:
+            digests = []
+            for segment in self._segments:
+                digests.extend(segment.hasher.finish())
+        else:
+            digests = self._block_hasher.finish()
+        self._digests = self._hasher.hexdigests() if self._hasher else {}
+        self._digests[CONTENT_DIGEST] = combine_digests(digests)
+        try:
+            if (
+                self._expected_size is not None
+                and self._downloaded != self._expected_size
+            ):
+                raise DigestMismatchError(
+                    "Size of %s mismatch, expected %d but got %d"
+                    % (self._url, self._expected_size, self._downloaded)
+                )
+            verify_digests(self._digests, self._expected)
+        except DigestMismatchError:
+            # Do not resume from corrupted file
+            for path in (self._part_path, self._state_path):
+                if os.path.isfile(path):
+                    os.remove(path)
+            raise
+
+    def download(self):
+        self._reset_hashers()
+        self._info, response = self._probe()
+        self._reporter.start(self._info["size"])
+        if self._expected_size is not None and self._info["size"] not in (
+            None,
+            self._expected_size,
+        ):
+            if response:
+                response.close()
+            raise DigestMismatchError(
+                "Size of %s mismatch, expected %d but got %d"
+                % (self._url, self._expected_size, self._info["size"])
+            )
+        if response:
+            utils.logger.debug(
+                "[%s] Range request of %s not supported"
+                % (self.__class__.__name__, self._url)
+            )
+            self._download_stream(response)
+        elif self._info["size"] == 0:
+            open(self._part_path, "wb").close()
+        else:
+            self._download_segments()
+        self._reporter.finish(self._downloaded)
+        self._verify()
+        os.replace(self._part_path, self._save_path)
+        if os.path.isfile(self._state_path):
+            os.remove(self._state_path)
+
+
+def is_modified(url, etag=None, last_modified=None, timeout=DEFAULT_TIMEOUT):
+    """Revalidate remote file with a conditional request
+
+    :return: True if the validators do not match the remote file
+    """
+    if not etag and not last_modified:
+        return True
+    request = urllib.request.Request(url, headers={"Range": "bytes=0-0"})
+    if etag:
+        request.add_header("If-None-Match", etag)
+    if last_modified:
+        request.add_header("If-Modified-Since", last_modified)
+    try:
+        response = build_opener().open(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return False
+        raise
+    with response:
+        # Servers may ignore conditional headers
+        if etag and response.headers.get("ETag"):
+            return response.headers["ETag"] != etag
+        if last_modified and response.headers.get("Last-Modified"):
+            return response.headers["Last-Modified"] != last_modified
+        return True
+
+
+def download(url, save_path, segments=DEFAULT_SEGMENTS, progress=True, expected=None):
+    """Download url to save_path
+
+    :return: hex digests of downloaded file
+    """
+    downloader = Downloader(url, save_path, segments, progress, expected=expected)
+    downloader.download()
+    return downloader.digests
@@ -0,0 +1,113 @@
+# -*- coding: UTF-8 -*-
+
+"""Cache of host facts
+
+Host probes such as WMI and DISM queries are slow, their results are
+memoized in the process and, if the fact has a ttl, saved to a json file so
+following commands can reuse them. Commands changing the host should
+invalidate related facts.
+"""
+
+import functools
+import json
+import os
+import time
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+
+def get_default_cache_path():
+    root = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    return os.path.join(root, "easywsl", "facts.json")
+
+
+class FactCache(object):
+    """Facts memoized in process and persisted to a json file
+
+    :param path: path of json file, None to keep facts in memory only
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+        self._memo = {}
+        # name => {"value": value, "time": time saved}
+        self._saved = None
+
+    def _load(self):
+        if self._saved is None:
+            self._saved = {}
+            if self._path and os.path.isfile(self._path):
+                try:
+                    with open(self._path) as fp:
+                        self._saved = json.load(fp)
+                except (OSError, ValueError):
+                    # Broken cache is ignored and overwritten
+                    pass
+        return self._saved
+
+    def _save(self):
+        if not self._path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            temp_path = self._path + ".tmp"
+            with open(temp_path, "w") as fp:
+                json.dump(self._saved, fp)
+            os.replace(temp_path, self._path)
+        except OSError:
+            pass
+
+    def get(self, name, probe, ttl=0):
+        """Get fact, call `probe` if it is not cached or expired
+
+        :param ttl: seconds the fact is kept in the json file, 0 to memoize
+                    in process only
+        """
+        if name in self._memo:
+            return self._memo[name]
+        if ttl:
+            item = self._load().get(name)
+            if item and 0 <= time.time() - item["time"] < ttl:
+                self._memo[name] = item["value"]
+                return item["value"]
+        value = probe()
+        self._memo[name] = value
+        if ttl:
+            self._load()[name] = {"value": value, "time": time.time()}
+            self._save()
+        return value
+
+    def invalidate(self, *names):
+        """Drop facts, all facts are dropped if no name specified"""
+        saved = self._load()
+        if not names:
+            names = set(self._memo) | set(saved)
+        changed = False
+        for name in names:
+            self._memo.pop(name, None)
+            if saved.pop(name, None) is not None:
+                changed = True
+        if changed:
+            self._save()
+
+
+default_cache = FactCache(get_default_cache_path())
+
+
+def fact(name, ttl=0):
+    """Decorator caching result of a function without arguments as fact"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper():
+            return default_cache.get(name, func, ttl)
+
+        return wrapper
+
+    return decorator
+
+
+def invalidate(*names):
+    default_cache.invalidate(*names)
@@ -0,0 +1,201 @@
+# -*- coding: UTF-8 -*-
+
+"""Windows firewall rules of forwarded ports
+
+All inbound rules are listed with one netsh call and rules created by
+EasyWSL are indexed by port and protocol, the index is cached for the whole
+run. Missing rules of many ports are created with one netsh call per
+`MAX_PORTS_PER_RULE` ports.
+"""
+
+import asyncio
+import ctypes
+
+from . import utils
+
+RULE_PREFIX = "EasyWSL"
+MAX_PORTS_PER_RULE = 100
+
+# Field names of english and chinese windows
+FIELDS = {
+    "Rule Name": "name",
+    "规则名称": "name",
+    "Enabled": "enabled",
+    "已启用": "enabled",
+    "Direction": "direction",
+    "方向": "direction",
+    "Protocol": "protocol",
+    "协议": "protocol",
+    "LocalPort": "local_port",
+    "本地端口": "local_port",
+    "Action": "action",
+    "操作": "action",
+}
+ENABLED_VALUES = ("Yes", "是")
+INBOUND_VALUES = ("In", "入")
+ALLOW_VALUES = ("Allow", "允许")
+ANY_VALUES = ("Any", "任何")
+
+
+def get_rule_name(ports, protocol="tcp"):
+    """Name of rule allowing ports, ports is a port or a netsh port list"""
+    if protocol == "tcp":
+        return "%s %s" % (RULE_PREFIX, ports)
+    return "%s %s %s" % (RULE_PREFIX, protocol.upper(), ports)
+
+
+def parse_rules(text):
+    """Parse output of `netsh advfirewall firewall show rule verbose`
+
+    :return: list of dict, keys are values of `FIELDS`
+    """
+    rules = []
+    rule = None
+    for line in text.splitlines():
+        line = line.replace("：", ":", 1)
+        if ":" not in line:
+            continue
+        key, value = line.split(":", 1)
+        field = FIELDS.get(key.strip())
+        if not field:
+            continue
+        value = value.strip()
+        if field == "name":
+            rule = {"name": value}
+            rules.append(rule)
+        elif rule is not None:
+            rule[field] = value
+    return rules
+
+
+def parse_ports(text):
+    """Parse netsh port list such as 80,8000-8010 to list of (start, end)"""
+    result = []
+    for item in text.split(","):
+        item = item.strip()
+        if item in ANY_VALUES:
+            return [(0, 65535)]
+        start, _, end = item.partition("-")
+        try:
+            result.append((int(start), int(end or start)))
+        except ValueError:
+            continue
+    return result
+
+
+def format_ports(ports):
+    """Format ports to netsh port list, continuous ports are merged to range"""
+    ranges = []
+    for port in sorted(set(ports)):
+        if ranges and port == ranges[-1][1] + 1:
+            ranges[-1][1] = port
+        else:
+            ranges.append([port, port])
+    return ",".join(
+        "%d" % start if start == end else "%d-%d" % (start, end)
+        for start, end in ranges
+    )
+
+
+class FirewallRuleIndex(object):
+    """Enabled inbound allow rules created by EasyWSL"""
+
+    def __init__(self, rules=()):
+        # (port, protocol) => rule name
+        self._ports = {}
+        # (start, end, protocol, rule name)
+        self._ranges = []
+        for rule in rules:
+            self.add(rule)
+
+    def add(self, rule):
+        if not rule.get("name", "").startswith(RULE_PREFIX):
+            return
+        if (
+            rule.get("enabled") not in ENABLED_VALUES
+            or rule.get("direction") not in INBOUND_VALUES
+            or rule.get("action") not in ALLOW_VALUES
+        ):
+            return
+        protocol = rule.get("protocol", "").lower()
+        for start, end in parse_ports(rule.get("local_port", "")):
+            if start == end:
+                self._ports[(start, protocol)] = rule["name"]
+            else:
+                self._ranges.append((start, end, protocol, rule["name"]))
+
+    def find(self, port, protocol="tcp"):
+        """Name of rule allowing port, None if not allowed"""
+        name = self._ports.get((port, protocol))
+        if name:
+            return name
+        for start, end, rule_protocol, name in self._ranges:
+            if rule_protocol == protocol and start <= port <= end:
+                return name
+        return None
+
+    def __len__(self):
+        return len(self._ports) + len(self._ranges)
+
+
+_rule_index = None
+_rule_index_lock = None
+
+
+async def get_rule_index(refresh=False):
+    global _rule_index, _rule_index_lock
+    if _rule_index_lock is None:
+        _rule_index_lock = asyncio.Lock()
+    async with _rule_index_lock:
+        if _rule_index is None or refresh:
+            _, stdout, _ = await utils.run_command(
+                "netsh advfirewall firewall show rule name=all dir=in verbose"
+            )
+            _rule_index = FirewallRuleIndex(parse_rules(stdout))
+            utils.logger.debug("[Firewall] %d EasyWSL rules found" % len(_rule_index))
+    return _rule_index
+
+
+async def add_rules(ports, protocol="tcp"):
+    """Create rules allowing inbound ports"""
+    if not ctypes.windll.shell32.IsUserAnAdmin():
+        raise RuntimeError("Add firewall rule needs run as administrator")
+    index = await get_rule_index()
+    ports = sorted(set(ports))
+    for offset in range(0, len(ports), MAX_PORTS_PER_RULE):
+        local_port = format_ports(ports[offset : offset + MAX_PORTS_PER_RULE])
+        rule = {
+            "name": get_rule_name(local_port, protocol),
+            "enabled": "Yes",
+            "direction": "In",
+            "protocol": protocol.upper(),
+            "local_port": local_port,
+            "action": "Allow",
+        }
+        return_code, stdout, _ = await utils.run_command(
+            'netsh advfirewall firewall add rule name="%s" dir=in action=allow protocol=%s localport=%s'
+            % (rule["name"], rule["protocol"], local_port)
+        )
+        if return_code:
+            raise RuntimeError(
+                "Add firewall rule %s failed: %s" % (rule["name"], stdout.strip())
+            )
+        index.add(rule)
+
+
+async def ensure_rules(ports, protocol="tcp"):
+    """Create rules of ports not allowed yet
+
+    :return: list of ports whose rules are created
+    """
+    if not ports:
+        return []
+    index = await get_rule_index()
+    missing = [port for port in ports if not index.find(port, protocol)]
+    if missing:
+        utils.logger.info(
+            "[Firewall] Add rule of %s ports %s"
+            % (protocol.upper(), format_ports(missing))
+        )
+        await add_rules(missing, protocol)
+    return missing
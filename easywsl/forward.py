@@ -5,41 +5,1126 @@
 """
 
 import asyncio
+import bisect
+import collections
+import hashlib
+import time
 
+from . import metrics
 from . import utils
 
+ENGINES = ("protocol", "stream")
+DEFAULT_BUFFER_SIZE = 64 * 1024
+DEFAULT_HIGH_WATER = 256 * 1024
+DEFAULT_LOW_WATER = 64 * 1024
+DEFAULT_POOL_IDLE_TIMEOUT = 60
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_MAX_FAILURES = 3
+DEFAULT_FAIL_COOLDOWN = 30
+BALANCE_POLICIES = ("round-robin", "least-connections", "hash")
+DEFAULT_UDP_IDLE_TIMEOUT = 60
+DEFAULT_UDP_MAX_SESSIONS = 1024
+
+# BufferedProtocol is only available since python 3.7, fallback to
+# data_received on older versions
+BufferedProtocol = getattr(asyncio, "BufferedProtocol", asyncio.Protocol)
+
+
+class RelayProtocol(BufferedProtocol):
+    """One side of a relayed connection
+
+    Data is read into a preallocated buffer and passed to the peer transport
+    as memoryview. Since python 3.12 transports keep the memoryview of data
+    they can not send immediately instead of copying it, so the buffer is
+    replaced by a new one whenever the peer transport still holds data after
+    the write, and reused otherwise.
+
+    Reading is paused while the peer transport holds more than `high_water`
+    bytes and resumed when it drains below `low_water`. EOF is forwarded as
+    half-close, the connection is closed after both directions finished.
+    """
+
+    def __init__(
+        self,
+        peer=None,
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        high_water=DEFAULT_HIGH_WATER,
+        low_water=DEFAULT_LOW_WATER,
+    ):
+        self._peer = peer
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._high_water = high_water
+        self._low_water = low_water
+        self._transport = None
+        self._eof_received = False
+        self._eof_sent = False
+        self._pending = None
+        self._close_callback = None
+        self.bytes_received = 0
+
+    def connection_made(self, transport):
+        self._transport = transport
+        transport.set_write_buffer_limits(self._high_water, self._low_water)
+
+    def get_buffer(self, sizehint):
+        return self._view
+
+    def buffer_updated(self, nbytes):
+        self.data_received(self._view[:nbytes])
+        if self._peer and self._peer.get_write_buffer_size():
+            # Queued data may still reference the buffer
+            self._buffer = bytearray(len(self._buffer))
+            self._view = memoryview(self._buffer)
+
+    def data_received(self, data):
+        self.bytes_received += len(data)
+        if self._peer:
+            self._peer.write(data)
+            return
+        # Idle pooled connection, keep data sent by server first (such as
+        # greeting) until attached to a client
+        if self._pending is None:
+            self._pending = bytearray()
+        self._pending += data
+        if len(self._pending) >= len(self._buffer):
+            self.pause_reading()
+
+    def eof_received(self):
+        self._eof_received = True
+        if not self._peer:
+            return False
+        self._peer.write_eof()
+        # Keep transport open to send data of the other direction
+        return not self._eof_sent
+
+    def is_healthy(self):
+        return (
+            self._transport is not None
+            and not self._transport.is_closing()
+            and not self._eof_received
+        )
+
+    def attach(self, peer):
+        self._peer = peer
+        if self._pending:
+            peer.write(self._pending)
+            self._pending = None
+            self.resume_reading()
+
+    def connection_lost(self, exc):
+        self._transport = None
+        if self._peer:
+            self._peer.close()
+        if self._close_callback:
+            self._close_callback()
+            self._close_callback = None
+
+    def set_close_callback(self, callback):
+        self._close_callback = callback
+
+    def pause_writing(self):
+        if self._peer:
+            self._peer.pause_reading()
+
+    def resume_writing(self):
+        if self._peer:
+            self._peer.resume_reading()
+
+    def pause_reading(self):
+        if self._transport:
+            self._transport.pause_reading()
+
+    def resume_reading(self):
+        if self._transport:
+            self._transport.resume_reading()
+
+    def write(self, data):
+        if self._transport:
+            self._transport.write(data)
+
+    def get_write_buffer_size(self):
+        if self._transport:
+            return self._transport.get_write_buffer_size()
+        return 0
+
+    def write_eof(self):
+        if not self._transport or self._eof_sent:
+            return
+        self._eof_sent = True
+        if self._eof_received or not self._transport.can_write_eof():
+            self._transport.close()
+        else:
+            self._transport.write_eof()
+
+    def close(self):
+        if self._transport:
+            self._transport.close()
+
+    def abort(self):
+        if self._transport:
+            self._transport.abort()
+
+    def buffered_bytes(self):
+        """Bytes buffered to write to this side"""
+        size = len(self._pending) if self._pending else 0
+        return size + self.get_write_buffer_size()
+
+
+class ClientRelayProtocol(RelayProtocol):
+    """Accepted side of a relayed connection
+
+    Reading is paused until the upstream connection is established.
+    """
+
+    def __init__(
+        self,
+        upstream,
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        high_water=DEFAULT_HIGH_WATER,
+        low_water=DEFAULT_LOW_WATER,
+        metrics=None,
+        labels=(),
+        limiter=None,
+    ):
+        super(ClientRelayProtocol, self).__init__(
+            None, buffer_size, high_water, low_water
+        )
+        self._upstream = upstream
+        self._metrics = metrics
+        self._labels = labels
+        self._limiter = limiter
+        self._start_time = None
+
+    def connection_made(self, transport):
+        super(ClientRelayProtocol, self).connection_made(transport)
+        if self._limiter and not self._limiter.accept(self):
+            transport.abort()
+            return
+        transport.pause_reading()
+        self._start_time = time.time()
+        if self._metrics:
+            self._metrics.connection_opened(self, self._labels)
+        asyncio.ensure_future(self.connect_upstream())
+
+    def connection_lost(self, exc):
+        super(ClientRelayProtocol, self).connection_lost(exc)
+        if self._start_time is None:
+            # Rejected by limiter
+            return
+        if self._limiter:
+            self._limiter.release(self)
+        if self._metrics:
+            self._metrics.connection_closed(self, time.time() - self._start_time)
+
+    @property
+    def client_address(self):
+        if self._transport:
+            return self._transport.get_extra_info("peername")
+        return None
+
+    def relayed_bytes(self):
+        """Bytes received from client and from upstream"""
+        return self.bytes_received, self._peer.bytes_received if self._peer else 0
+
+    def buffered_bytes(self):
+        size = super(ClientRelayProtocol, self).buffered_bytes()
+        if self._peer:
+            size += self._peer.buffered_bytes()
+        return size
+
+    async def connect_upstream(self):
+        time0 = time.time()
+        try:
+            peer = await self._upstream.acquire(self)
+        except OSError as e:
+            utils.logger.warning(
+                "[%s] Connect to %s failed: %s"
+                % (self.__class__.__name__, self._upstream.address, e)
+            )
+            if self._metrics:
+                self._metrics.connection_failed(self._labels)
+            self.close()
+            return
+
+        if self._metrics:
+            self._metrics.upstream_connected(time.time() - time0, self._labels)
+        if not self._transport:
+            # Client closed during connecting
+            peer.close()
+            return
+        self._peer = peer
+        self._transport.resume_reading()
+
+
+class UpstreamConnector(object):
+    """Create upstream connections of a forwarded port"""
+
+    def __init__(
+        self,
+        host,
+        port,
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        high_water=DEFAULT_HIGH_WATER,
+        low_water=DEFAULT_LOW_WATER,
+    ):
+        self._host = host
+        self._port = port
+        self._buffer_size = buffer_size
+        self._high_water = high_water
+        self._low_water = low_water
+
+    @property
+    def address(self):
+        return "%s:%d" % (self._host, self._port)
+
+    def create_protocol(self, peer=None):
+        return RelayProtocol(peer, self._buffer_size, self._high_water, self._low_water)
+
+    async def connect(self, peer=None):
+        loop = asyncio.get_event_loop()
+        _, protocol = await loop.create_connection(
+            lambda: self.create_protocol(peer), self._host, self._port
+        )
+        return protocol
+
+    async def acquire(self, peer):
+        return await self.connect(peer)
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class UpstreamPool(UpstreamConnector):
+    """Keep pre-established upstream connections
+
+    Pool target size starts at `min_size`, grows on every miss up to
+    `max_size` and shrinks back when idle connections expire.
+    """
+
+    retry_interval = 1
+
+    def __init__(
+        self,
+        host,
+        port,
+        min_size=1,
+        max_size=8,
+        idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        high_water=DEFAULT_HIGH_WATER,
+        low_water=DEFAULT_LOW_WATER,
+    ):
+        super(UpstreamPool, self).__init__(
+            host, port, buffer_size, high_water, low_water
+        )
+        if min_size > max_size:
+            raise ValueError(
+                "Pool min size %d is greater than max size %d" % (min_size, max_size)
+            )
+        self._min_size = min_size
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._target = min_size
+        self._idle = collections.deque()
+        self._connecting = 0
+        self._retry_time = 0
+        self._timer = None
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        self._last_stats = None
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "idle": len(self._idle),
+            "connecting": self._connecting,
+            "target": self._target,
+        }
+
+    async def acquire(self, peer):
+        while self._idle:
+            protocol, _ = self._idle.pop()
+            if protocol.is_healthy():
+                self.hits += 1
+                protocol.attach(peer)
+                self._fill()
+                return protocol
+            protocol.close()
+        self.misses += 1
+        self._target = min(self._target + 1, self._max_size)
+        self._fill()
+        return await self.connect(peer)
+
+    def _fill(self):
+        if self._closed or time.time() < self._retry_time:
+            return
+        count = self._target - len(self._idle) - self._connecting
+        for _ in range(count):
+            self._connecting += 1
+            utils.safe_ensure_future(self._add_connection())
+
+    async def _add_connection(self):
+        try:
+            protocol = await self.connect()
+        except OSError as e:
+            utils.logger.debug(
+                "[%s] Create connection to %s failed: %s"
+                % (self.__class__.__name__, self.address, e)
+            )
+            self._retry_time = time.time() + self.retry_interval
+            return
+        finally:
+            self._connecting -= 1
+        if self._closed:
+            protocol.close()
+        else:
+            self._idle.appendleft((protocol, time.time()))
+
+    def _on_timer(self):
+        now = time.time()
+        expired = 0
+        while self._idle and (
+            now - self._idle[-1][1] >= self._idle_timeout
+            or not self._idle[-1][0].is_healthy()
+        ):
+            protocol, _ = self._idle.pop()
+            protocol.close()
+            expired += 1
+        if expired:
+            self._target = max(self._target - expired, self._min_size)
+        self._fill()
+        stats = (self.hits, self.misses)
+        if stats != self._last_stats:
+            self._last_stats = stats
+            utils.logger.debug(
+                "[%s] %s hits=%d misses=%d idle=%d"
+                % (
+                    self.__class__.__name__,
+                    self.address,
+                    self.hits,
+                    self.misses,
+                    len(self._idle),
+                )
+            )
+        self._schedule_timer()
+
+    def _schedule_timer(self):
+        loop = asyncio.get_event_loop()
+        self._timer = loop.call_later(
+            min(self._idle_timeout, self.retry_interval * 10), self._on_timer
+        )
+
+    def start(self):
+        self._fill()
+        self._schedule_timer()
+
+    def close(self):
+        self._closed = True
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        while self._idle:
+            protocol, _ = self._idle.pop()
+            protocol.close()
+
+
+class Backend(object):
+    """Upstream backend with passive health state"""
+
+    def __init__(self, connector):
+        self.connector = connector
+        self.active = 0
+        self.failures = 0
+        self.ejected_until = 0
+
+    @property
+    def address(self):
+        return self.connector.address
+
+    def is_available(self, now):
+        return self.ejected_until <= now
+
+
+class BalancedUpstream(object):
+    """Spread connections of a forwarded port over several backends
+
+    Backends failing to connect `max_failures` times in a row are ejected for
+    `fail_cooldown` seconds, connections are retried on the next backend.
+    """
+
+    virtual_nodes = 100
+
+    def __init__(
+        self,
+        connectors,
+        policy="round-robin",
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        max_failures=DEFAULT_MAX_FAILURES,
+        fail_cooldown=DEFAULT_FAIL_COOLDOWN,
+    ):
+        if policy not in BALANCE_POLICIES:
+            raise ValueError("Invalid balance policy %s" % policy)
+        if not connectors:
+            raise ValueError("No backend specified")
+        self._backends = [Backend(it) for it in connectors]
+        self._policy = policy
+        self._connect_timeout = connect_timeout
+        self._max_failures = max_failures
+        self._fail_cooldown = fail_cooldown
+        self._index = 0
+        self._ring = []
+        if policy == "hash":
+            for index, backend in enumerate(self._backends):
+                for i in range(self.virtual_nodes):
+                    key = self._hash("%s#%d" % (backend.address, i))
+                    self._ring.append((key, index))
+            self._ring.sort()
+
+    @property
+    def address(self):
+        return ",".join(backend.address for backend in self._backends)
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+    def _select(self, peer):
+        """Return backends in the order to try"""
+        count = len(self._backends)
+        if self._policy == "hash":
+            address = peer.client_address
+            key = self._hash(address[0] if address else "")
+            start = bisect.bisect_left(self._ring, (key, 0))
+            order = []
+            for i in range(len(self._ring)):
+                index = self._ring[(start + i) % len(self._ring)][1]
+                if index not in order:
+                    order.append(index)
+                    if len(order) == count:
+                        break
+        else:
+            order = [(self._index + i) % count for i in range(count)]
+            if self._policy == "least-connections":
+                order.sort(key=lambda index: self._backends[index].active)
+        now = time.time()
+        order = [
+            index for index in order if self._backends[index].is_available(now)
+        ] or order
+        if self._policy != "hash":
+            # Next selection starts after the chosen backend
+            self._index = (order[0] + 1) % count
+        # Ejected backends are tried only if all backends are ejected
+        return [self._backends[index] for index in order]
+
+    def _on_failure(self, backend, error):
+        backend.failures += 1
+        utils.logger.warning(
+            "[%s] Connect to backend %s failed: %s"
+            % (self.__class__.__name__, backend.address, error or "timeout")
+        )
+        if backend.failures >= self._max_failures:
+            backend.ejected_until = time.time() + self._fail_cooldown
+            utils.logger.warning(
+                "[%s] Eject backend %s for %ds"
+                % (self.__class__.__name__, backend.address, self._fail_cooldown)
+            )
+
+    def _release(self, backend):
+        backend.active -= 1
+
+    async def acquire(self, peer):
+        for backend in self._select(peer):
+            try:
+                protocol = await asyncio.wait_for(
+                    backend.connector.acquire(peer), self._connect_timeout
+                )
+            except (OSError, asyncio.TimeoutError) as e:
+                self._on_failure(backend, str(e))
+                continue
+            backend.failures = 0
+            backend.ejected_until = 0
+            backend.active += 1
+            protocol.set_close_callback(lambda: self._release(backend))
+            return protocol
+        raise OSError("No backend of %s available" % self.address)
+
+    def stats(self):
+        now = time.time()
+        result = []
+        for backend in self._backends:
+            item = {
+                "address": backend.address,
+                "active": backend.active,
+                "failures": backend.failures,
+                "ejected": not backend.is_available(now),
+            }
+            if isinstance(backend.connector, UpstreamPool):
+                item["pool"] = backend.connector.stats()
+            result.append(item)
+        return result
+
+    def start(self):
+        for backend in self._backends:
+            backend.connector.start()
+
+    def close(self):
+        for backend in self._backends:
+            backend.connector.close()
+
+
+class StreamConnection(object):
+    """Relayed connection of stream engine"""
+
+    def __init__(self, writer):
+        self._writers = [writer]
+        self.counter = [0, 0]
+
+    @property
+    def client_address(self):
+        return self._writers[0].get_extra_info("peername")
+
+    def add_writer(self, writer):
+        self._writers.append(writer)
+
+    def relayed_bytes(self):
+        return tuple(self.counter)
+
+    def buffered_bytes(self):
+        return sum(it.transport.get_write_buffer_size() for it in self._writers)
+
+    def abort(self):
+        for it in self._writers:
+            it.transport.abort()
+
+
+class ConnectionLimiter(object):
+    """Enforce connection limits of forwarders
+
+    New connections exceeding `max_connections` or `max_connections_per_ip`
+    are rejected immediately. Connections without traffic for
+    `idle_timeout` seconds or alive for more than `max_lifetime` seconds are
+    aborted. Traffic is detected by comparing relayed bytes periodically, so
+    the relay path is not touched.
+    """
+
+    check_interval = 1
+
+    def __init__(
+        self,
+        idle_timeout=0,
+        max_lifetime=0,
+        max_connections=0,
+        max_connections_per_ip=0,
+    ):
+        self._idle_timeout = idle_timeout
+        self._max_lifetime = max_lifetime
+        self._max_connections = max_connections
+        self._max_connections_per_ip = max_connections_per_ip
+        # connection => [ip, start time, last active time, relayed bytes]
+        self._connections = {}
+        self._ip_connections = collections.Counter()
+        self._timer = None
+        self.rejected = 0
+
+    def accept(self, connection):
+        address = connection.client_address
+        ip = address[0] if address else None
+        if self._max_connections and len(self._connections) >= self._max_connections:
+            return self._reject(ip, "max connections %d" % self._max_connections)
+        if (
+            self._max_connections_per_ip
+            and self._ip_connections[ip] >= self._max_connections_per_ip
+        ):
+            return self._reject(
+                ip, "max connections per ip %d" % self._max_connections_per_ip
+            )
+        now = time.time()
+        self._connections[connection] = [ip, now, now, 0]
+        self._ip_connections[ip] += 1
+        if (self._idle_timeout or self._max_lifetime) and not self._timer:
+            loop = asyncio.get_event_loop()
+            self._timer = loop.call_later(self.check_interval, self._on_timer)
+        return True
+
+    def _reject(self, ip, reason):
+        self.rejected += 1
+        utils.logger.debug(
+            "[%s] Reject connection from %s: %s" % (self.__class__.__name__, ip, reason)
+        )
+        return False
+
+    def release(self, connection):
+        item = self._connections.pop(connection, None)
+        if not item:
+            return
+        ip = item[0]
+        self._ip_connections[ip] -= 1
+        if not self._ip_connections[ip]:
+            del self._ip_connections[ip]
+
+    def _on_timer(self):
+        now = time.time()
+        for connection, item in list(self._connections.items()):
+            relayed_bytes = sum(connection.relayed_bytes())
+            if relayed_bytes != item[3]:
+                item[2] = now
+                item[3] = relayed_bytes
+            if self._max_lifetime and now - item[1] >= self._max_lifetime:
+                reason = "max lifetime"
+            elif self._idle_timeout and now - item[2] >= self._idle_timeout:
+                reason = "idle timeout"
+            else:
+                continue
+            utils.logger.info(
+                "[%s] Abort connection from %s: %s"
+                % (self.__class__.__name__, item[0], reason)
+            )
+            self.release(connection)
+            connection.abort()
+        self._timer = None
+        if self._connections:
+            loop = asyncio.get_event_loop()
+            self._timer = loop.call_later(self.check_interval, self._on_timer)
+
+    def stats(self):
+        buffered = [it.buffered_bytes() for it in self._connections]
+        return {
+            "active": len(self._connections),
+            "sources": len(self._ip_connections),
+            "rejected": self.rejected,
+            "buffered_bytes": sum(buffered),
+            "max_buffered_bytes": max(buffered) if buffered else 0,
+        }
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+
+class ForwardMetrics(object):
+    """Connection and traffic metrics of port forwarders
+
+    Relayed bytes are counted by the protocols and only collected into the
+    counters when metrics are rendered or connections are closed, so the
+    relay path is not slowed down.
+    """
+
+    def __init__(self, registry):
+        labelnames = ("port",)
+        self.connections_opened = registry.register(
+            metrics.Counter(
+                "ezwsl_forward_connections_opened_total",
+                "Accepted client connections",
+                labelnames,
+            )
+        )
+        self.connections_closed = registry.register(
+            metrics.Counter(
+                "ezwsl_forward_connections_closed_total",
+                "Closed client connections",
+                labelnames,
+            )
+        )
+        self.connections_failed = registry.register(
+            metrics.Counter(
+                "ezwsl_forward_connections_failed_total",
+                "Client connections failed to connect upstream",
+                labelnames,
+            )
+        )
+        self.connections_active = registry.register(
+            metrics.Gauge(
+                "ezwsl_forward_connections_active",
+                "Client connections currently open",
+                labelnames,
+            )
+        )
+        self.bytes_received = registry.register(
+            metrics.Counter(
+                "ezwsl_forward_received_bytes_total",
+                "Bytes received from clients",
+                labelnames,
+            )
+        )
+        self.bytes_sent = registry.register(
+            metrics.Counter(
+                "ezwsl_forward_sent_bytes_total",
+                "Bytes received from upstream and sent to clients",
+                labelnames,
+            )
+        )
+        self.upstream_connect_seconds = registry.register(
+            metrics.Histogram(
+                "ezwsl_forward_upstream_connect_seconds",
+                "Time to get an upstream connection",
+                labelnames,
+            )
+        )
+        self.relay_duration_seconds = registry.register(
+            metrics.Histogram(
+                "ezwsl_forward_relay_duration_seconds",
+                "Lifetime of client connections",
+                labelnames,
+            )
+        )
+        # protocol => [labels, reported received bytes, reported sent bytes]
+        self._connections = {}
+        registry.add_collector(self.collect)
+
+    def connection_opened(self, protocol, labels):
+        self.connections_opened.inc(labels=labels)
+        self.connections_active.inc(labels=labels)
+        if protocol:
+            self._connections[protocol] = [labels, 0, 0]
+
+    def connection_failed(self, labels):
+        self.connections_failed.inc(labels=labels)
+
+    def upstream_connected(self, seconds, labels):
+        self.upstream_connect_seconds.observe(seconds, labels)
+
+    def add_bytes(self, received, sent, labels):
+        self.bytes_received.inc(received, labels)
+        self.bytes_sent.inc(sent, labels)
+
+    def _collect_bytes(self, protocol, item):
+        received, sent = protocol.relayed_bytes()
+        self.add_bytes(received - item[1], sent - item[2], item[0])
+        item[1] = received
+        item[2] = sent
+
+    def connection_closed(self, protocol, duration, labels=None):
+        if protocol:
+            item = self._connections.pop(protocol, None)
+            if not item:
+                return
+            self._collect_bytes(protocol, item)
+            labels = item[0]
+        self.connections_closed.inc(labels=labels)
+        self.connections_active.dec(labels=labels)
+        self.relay_duration_seconds.observe(duration, labels)
+
+    def collect(self):
+        for protocol, item in self._connections.items():
+            self._collect_bytes(protocol, item)
+
 
 class PortForwarder(object):
-    def __init__(self, address, port):
+    def __init__(
+        self,
+        address,
+        port,
+        engine="protocol",
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        high_water=DEFAULT_HIGH_WATER,
+        low_water=DEFAULT_LOW_WATER,
+        pool_min=0,
+        pool_max=8,
+        pool_idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+        metrics=None,
+        backends=None,
+        balance="round-robin",
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        max_failures=DEFAULT_MAX_FAILURES,
+        fail_cooldown=DEFAULT_FAIL_COOLDOWN,
+        limiter=None,
+    ):
+        if engine not in ENGINES:
+            raise ValueError("Invalid forward engine %s" % engine)
+        if low_water > high_water:
+            raise ValueError(
+                "Low water %d is greater than high water %d" % (low_water, high_water)
+            )
+        if pool_min and engine != "protocol":
+            raise ValueError("Upstream pool requires protocol engine")
+        if backends and engine != "protocol":
+            raise ValueError("Upstream backends requires protocol engine")
         self._address = address
         self._port = port
+        self._engine = engine
+        self._buffer_size = buffer_size
+        self._high_water = high_water
+        self._low_water = low_water
+        self._metrics = metrics
+        self._labels = (str(port),)
+        self._limiter = limiter
 
-    async def handle_connection(self, reader, writer):
-        up_reader, up_writer = await asyncio.open_connection("127.0.0.1", self._port)
-        tasks = [None, None]
+        def create_connector(host, port):
+            if pool_min:
+                return UpstreamPool(
+                    host,
+                    port,
+                    pool_min,
+                    max(pool_min, pool_max),
+                    pool_idle_timeout,
+                    buffer_size,
+                    high_water,
+                    low_water,
+                )
+            return UpstreamConnector(host, port, buffer_size, high_water, low_water)
+
+        if backends:
+            self._upstream = BalancedUpstream(
+                [create_connector(host, port) for host, port in backends],
+                balance,
+                connect_timeout,
+                max_failures,
+                fail_cooldown,
+            )
+        else:
+            self._upstream = create_connector("127.0.0.1", port)
+        self._server = None
+
+    @property
+    def engine(self):
+        return self._engine
+
+    @property
+    def upstream(self):
+        return self._upstream
+
+    async def _pump(self, reader, writer, counter, index):
         while True:
-            if tasks[0] is None:
-                tasks[0] = asyncio.ensure_future(reader.read(4096))
-            if tasks[1] is None:
-                tasks[1] = asyncio.ensure_future(up_reader.read(4096))
-            done_tasks, _ = await asyncio.wait(
-                tasks, return_when=asyncio.FIRST_COMPLETED
-            )
-            assert len(done_tasks) > 0
-            for task in done_tasks:
-                buffer = task.result()
-                print(buffer)
-                if not buffer:
-                    writer.close()
-                    up_writer.close()
-                    return
-                if task == tasks[0]:
-                    up_writer.write(buffer)
-                    tasks[0] = None
-                else:
-                    writer.write(buffer)
-                    tasks[1] = None
+            buffer = await reader.read(self._buffer_size)
+            if not buffer:
+                break
+            counter[index] += len(buffer)
+            writer.write(buffer)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+
+    async def handle_connection(self, reader, writer):
+        connection = StreamConnection(writer)
+        if self._limiter and not self._limiter.accept(connection):
+            writer.transport.abort()
+            return
+        try:
+            await self._relay(reader, writer, connection)
+        finally:
+            if self._limiter:
+                self._limiter.release(connection)
+
+    async def _relay(self, reader, writer, connection):
+        time0 = time.time()
+        if self._metrics:
+            self._metrics.connection_opened(None, self._labels)
+        try:
+            up_reader, up_writer = await asyncio.open_connection(
+                "127.0.0.1", self._port
+            )
+        except OSError as e:
+            utils.logger.warning(
+                "[%s] Connect to 127.0.0.1:%d failed: %s"
+                % (self.__class__.__name__, self._port, e)
+            )
+            writer.close()
+            if self._metrics:
+                self._metrics.connection_failed(self._labels)
+                self._metrics.connection_closed(None, time.time() - time0, self._labels)
+            return
+
+        if self._metrics:
+            self._metrics.upstream_connected(time.time() - time0, self._labels)
+        connection.add_writer(up_writer)
+        for it in (writer, up_writer):
+            it.transport.set_write_buffer_limits(self._high_water, self._low_water)
+        counter = connection.counter
+        try:
+            await asyncio.gather(
+                self._pump(reader, up_writer, counter, 0),
+                self._pump(up_reader, writer, counter, 1),
+            )
+        except (ConnectionError, OSError) as e:
+            utils.logger.info(
+                "[%s] Connection on port %d closed: %s"
+                % (self.__class__.__name__, self._port, e)
+            )
+        finally:
+            writer.close()
+            up_writer.close()
+            if self._metrics:
+                self._metrics.add_bytes(counter[0], counter[1], self._labels)
+                self._metrics.connection_closed(None, time.time() - time0, self._labels)
+
+    def create_protocol(self):
+        return ClientRelayProtocol(
+            self._upstream,
+            self._buffer_size,
+            self._high_water,
+            self._low_water,
+            self._metrics,
+            self._labels,
+            self._limiter,
+        )
+
+    async def serve(self, sock=None):
+        """Start listening, use `sock` instead of binding if specified"""
+        if sock:
+            address = {"sock": sock}
+        else:
+            address = {"host": self._address, "port": self._port}
+        if self._engine == "stream":
+            self._server = await asyncio.start_server(self.handle_connection, **address)
+        else:
+            loop = asyncio.get_event_loop()
+            self._server = await loop.create_server(self.create_protocol, **address)
+            self._upstream.start()
+        return self._server
 
     def start(self):
-        coro = asyncio.start_server(self.handle_connection, self._address, self._port)
-        utils.safe_ensure_future(coro)
+        utils.safe_ensure_future(self.serve())
+
+    def close(self):
+        if self._server:
+            self._server.close()
+            self._server = None
+        self._upstream.close()
+
+
+class UdpSession(asyncio.DatagramProtocol):
+    """Upstream socket of a udp client"""
+
+    max_pending = 16
+
+    def __init__(self, forwarder, client_address):
+        self._forwarder = forwarder
+        self._client_address = client_address
+        self._transport = None
+        self._pending = []
+        self._closed = False
+        self.last_active = time.time()
+
+    def connection_made(self, transport):
+        if self._closed:
+            # Evicted during creating upstream socket
+            transport.close()
+            return
+        self._transport = transport
+        for data in self._pending:
+            transport.sendto(data)
+        self._pending = None
+
+    def datagram_received(self, data, addr):
+        self.last_active = time.time()
+        self._forwarder.send_to_client(data, self._client_address)
+
+    def error_received(self, exc):
+        utils.logger.debug(
+            "[%s] Upstream of %s:%d error: %s"
+            % ((self.__class__.__name__,) + self._client_address[:2] + (exc,))
+        )
+
+    def send(self, data):
+        self.last_active = time.time()
+        if self._transport:
+            self._transport.sendto(data)
+        elif self._pending is not None and len(self._pending) < self.max_pending:
+            # Upstream socket is creating
+            self._pending.append(data)
+
+    def close(self):
+        self._closed = True
+        if self._transport:
+            self._transport.close()
+            self._transport = None
+        self._pending = None
+
+
+class UdpForwarder(asyncio.DatagramProtocol):
+    """Forward udp datagrams to 127.0.0.1 with the same port
+
+    Every client address gets its own upstream socket, sessions idle for more
+    than `idle_timeout` seconds are closed, and the least recently active
+    session is evicted when `max_sessions` is reached.
+    """
+
+    def __init__(
+        self,
+        address,
+        port,
+        idle_timeout=DEFAULT_UDP_IDLE_TIMEOUT,
+        max_sessions=DEFAULT_UDP_MAX_SESSIONS,
+    ):
+        self._address = address
+        self._port = port
+        self._idle_timeout = idle_timeout
+        self._max_sessions = max_sessions
+        self._sessions = collections.OrderedDict()
+        self._transport = None
+        self._timer = None
+
+    @property
+    def engine(self):
+        return "udp"
+
+    @property
+    def sessions(self):
+        return len(self._sessions)
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        session = self._sessions.get(addr)
+        if session:
+            self._sessions.move_to_end(addr)
+        else:
+            while len(self._sessions) >= self._max_sessions:
+                _, oldest = self._sessions.popitem(False)
+                oldest.close()
+            session = self._sessions[addr] = UdpSession(self, addr)
+            utils.safe_ensure_future(self._connect_upstream(addr, session))
+        session.send(data)
+
+    def send_to_client(self, data, addr):
+        if self._transport:
+            self._transport.sendto(data, addr)
+
+    async def _connect_upstream(self, addr, session):
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.create_datagram_endpoint(
+                lambda: session, remote_addr=("127.0.0.1", self._port)
+            )
+        except OSError as e:
+            utils.logger.warning(
+                "[%s] Create upstream socket to 127.0.0.1:%d failed: %s"
+                % (self.__class__.__name__, self._port, e)
+            )
+            if self._sessions.get(addr) is session:
+                self._sessions.pop(addr)
+            session.close()
+
+    def _on_timer(self):
+        deadline = time.time() - self._idle_timeout
+        for addr, session in list(self._sessions.items()):
+            if session.last_active < deadline:
+                self._sessions.pop(addr).close()
+        loop = asyncio.get_event_loop()
+        self._timer = loop.call_later(max(self._idle_timeout / 2, 1), self._on_timer)
+
+    async def serve(self):
+        loop = asyncio.get_event_loop()
+        await loop.create_datagram_endpoint(
+            lambda: self, local_addr=(self._address, self._port)
+        )
+        self._timer = loop.call_later(max(self._idle_timeout / 2, 1), self._on_timer)
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._transport:
+            self._transport.close()
+            self._transport = None
+        while self._sessions:
+            _, session = self._sessions.popitem()
+            session.close()
@@ -0,0 +1,130 @@
+# -*- coding: UTF-8 -*-
+
+"""Plan nat rules of forwarded ports
+
+Rules are kept in dedicated chains, jumped to from OUTPUT and POSTROUTING.
+The ruleset is read once with `iptables-save`, and all changes are applied
+atomically with one `iptables-restore --noflush` call, which replaces the
+content of the declared chains only.
+
+A forward is a tuple of (local_port, remote_address, remote_port, protocol).
+"""
+
+import collections
+
+OUTPUT_CHAIN = "EZWSL_OUTPUT"
+POSTROUTING_CHAIN = "EZWSL_POSTROUTING"
+
+OUTPUT_JUMP = "-m addrtype --src-type LOCAL --dst-type LOCAL -j %s" % OUTPUT_CHAIN
+POSTROUTING_JUMP = "-j %s" % POSTROUTING_CHAIN
+MASQUERADE_RULE = "-m addrtype --src-type LOCAL --dst-type UNICAST -j MASQUERADE"
+
+
+def parse_ruleset(text):
+    """Parse output of iptables-save
+
+    :return: dict of table => OrderedDict of chain => list of rules, a rule is
+             the arguments after `-A <chain>`
+    """
+    tables = {}
+    chains = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("*"):
+            chains = tables.setdefault(line[1:], collections.OrderedDict())
+        elif chains is None:
+            continue
+        elif line.startswith(":"):
+            chains.setdefault(line[1:].split()[0], [])
+        elif line.startswith("-A "):
+            items = line.split(" ", 2)
+            chains.setdefault(items[1], []).append(items[2] if len(items) > 2 else "")
+    return tables
+
+
+def dnat_rule(forward):
+    local_port, remote_address, remote_port, protocol = forward
+    return "-p %s -m %s --dport %d -j DNAT --to-destination %s:%d" % (
+        protocol,
+        protocol,
+        local_port,
+        remote_address,
+        remote_port,
+    )
+
+
+def parse_forward(rule):
+    """Get forward of a DNAT rule, None if it is not a DNAT rule"""
+    args = rule.split()
+    options = {}
+    for index, arg in enumerate(args[:-1]):
+        if arg in ("-p", "--dport", "-j", "--to-destination"):
+            options[arg] = args[index + 1]
+    if options.get("-j") != "DNAT" or "-p" not in options:
+        return None
+    try:
+        local_port = int(options["--dport"])
+        remote_address, remote_port = options["--to-destination"].rsplit(":", 1)
+        remote_port = int(remote_port)
+    except (KeyError, ValueError):
+        return None
+    return local_port, remote_address, remote_port, options["-p"]
+
+
+def plan(ruleset, add=(), remove=()):
+    """Plan changes of nat rules
+
+    Rules created by old versions, which are appended to OUTPUT and
+    POSTROUTING directly, are removed as well.
+
+    :param ruleset: result of `parse_ruleset`
+    :param add: forwards to add
+    :param remove: forwards to remove
+    :return: input of `iptables-restore --noflush`, None if nothing to change
+    """
+    nat = ruleset.get("nat", {})
+    add = [tuple(it) for it in add]
+    remove = [tuple(it) for it in remove]
+    forwards = []
+    for rule in nat.get(OUTPUT_CHAIN, []):
+        forward = parse_forward(rule)
+        if forward and forward not in remove and forward not in forwards:
+            forwards.append(forward)
+    for forward in add:
+        if forward not in forwards:
+            forwards.append(forward)
+
+    declarations = []
+    rules = []
+    output_rules = [dnat_rule(it) for it in forwards]
+    if nat.get(OUTPUT_CHAIN) != output_rules:
+        declarations.append(":%s - [0:0]" % OUTPUT_CHAIN)
+        rules.extend("-A %s %s" % (OUTPUT_CHAIN, it) for it in output_rules)
+    if nat.get(POSTROUTING_CHAIN) != [MASQUERADE_RULE]:
+        declarations.append(":%s - [0:0]" % POSTROUTING_CHAIN)
+        rules.append("-A %s %s" % (POSTROUTING_CHAIN, MASQUERADE_RULE))
+    if OUTPUT_JUMP not in nat.get("OUTPUT", []):
+        rules.append("-A OUTPUT %s" % OUTPUT_JUMP)
+    if POSTROUTING_JUMP not in nat.get("POSTROUTING", []):
+        rules.append("-A POSTROUTING %s" % POSTROUTING_JUMP)
+
+    # Legacy rules
+    for rule in nat.get("OUTPUT", []):
+        if parse_forward(rule) in add + remove:
+            rules.append("-D OUTPUT %s" % rule)
+    for rule in nat.get("POSTROUTING", []):
+        if rule == MASQUERADE_RULE:
+            rules.append("-D POSTROUTING %s" % rule)
+
+    if not declarations and not rules:
+        return None
+    return "\n".join(["*nat"] + declarations + rules + ["COMMIT", ""])
+
+
+def restore_cmdline(script):
+    """Shell cmdline feeding script to `iptables-restore --noflush`"""
+    return "sh -c \"printf '%s' | iptables-restore --noflush\"" % script.replace(
+        "\n", "\\n"
+    )
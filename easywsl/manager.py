@@ -0,0 +1,408 @@
+# -*- coding: UTF-8 -*-
+
+"""Manage forwarded ports at runtime
+"""
+
+import asyncio
+import binascii
+import collections
+import hmac
+import json
+import os
+import socket
+
+from . import firewall
+from . import forward
+from . import metrics
+from . import utils
+from . import worker
+
+DEFAULT_CONTROL_PORT = 17878
+DEFAULT_SETUP_CONCURRENCY = 8
+
+
+class ForwardManager(object):
+    """Own all port forwarders of the forwarding service
+
+    :param address: address to listen on
+    :param wsl: WSL instance used to create nat rules, None to skip
+    :param options: PortForwarder keyword arguments used for every port
+    :param workers: number of worker processes, forwards can not be changed
+                    at runtime with multiple workers
+    :param metrics_port: port of metrics endpoint, 0 to disable, each worker
+                         serves its own metrics on `metrics_port + index`
+    :param udp_options: UdpForwarder keyword arguments used for every udp port
+    :param backends: dict of port => list of (host, port) upstream backends,
+                     ports not in it are forwarded to 127.0.0.1
+    :param limits: ConnectionLimiter keyword arguments shared by all tcp
+                   ports, each worker enforces them separately
+    :param setup_concurrency: max ports set up at the same time on start
+    """
+
+    def __init__(
+        self,
+        address,
+        wsl=None,
+        options=None,
+        workers=1,
+        metrics_port=0,
+        udp_options=None,
+        backends=None,
+        limits=None,
+        setup_concurrency=DEFAULT_SETUP_CONCURRENCY,
+    ):
+        self._address = address
+        self._wsl = wsl
+        self._options = options or {}
+        self._udp_options = udp_options or {}
+        self._backends = backends or {}
+        self._workers = workers
+        self._metrics_port = metrics_port
+        self._metrics = None
+        self._limits = limits or {}
+        self._setup_concurrency = setup_concurrency
+        self._limiter = None
+        if any(self._limits.values()):
+            self._limiter = forward.ConnectionLimiter(**self._limits)
+        # (port, protocol) => forwarder
+        self._forwarders = {}
+        self._supervisor = None
+
+    async def _start_port(self, semaphore, port, protocol):
+        async with semaphore:
+            await firewall.ensure_rules([port], protocol)
+            if self._workers > 1 and protocol == "tcp":
+                # Listened by workers
+                return
+            await self.add(port, protocol, setup=False)
+
+    async def start(self, ports, udp_ports=()):
+        """Forward ports concurrently
+
+        Firewall rules and listeners of all ports are set up concurrently,
+        then nat rules are created in one batch. Failure of a port does not
+        stop others.
+
+        :return: OrderedDict of (port, protocol) => error message, None if
+                 succeeded
+        """
+        if self._workers <= 1 and self._metrics_port:
+            registry = metrics.Registry()
+            self._metrics = forward.ForwardMetrics(registry)
+            await metrics.MetricsServer(registry, self._metrics_port).serve()
+
+        keys = [(port, "tcp") for port in ports]
+        keys += [(port, "udp") for port in udp_ports]
+        keys = list(collections.OrderedDict.fromkeys(keys))
+        for protocol, protocol_ports in (("tcp", ports), ("udp", udp_ports)):
+            try:
+                # Create missing rules in one batch, rules of failed ports
+                # are retried and reported separately
+                await firewall.ensure_rules(protocol_ports, protocol)
+            except RuntimeError as e:
+                utils.logger.warning(
+                    "[%s] Add firewall rules failed: %s" % (self.__class__.__name__, e)
+                )
+        semaphore = asyncio.Semaphore(self._setup_concurrency)
+        results = await asyncio.gather(
+            *[self._start_port(semaphore, port, protocol) for port, protocol in keys],
+            return_exceptions=True
+        )
+        report = collections.OrderedDict()
+        for key, result in zip(keys, results):
+            report[key] = str(result) if isinstance(result, Exception) else None
+
+        if self._workers > 1:
+            forwards = []
+            for port, protocol in keys:
+                if protocol != "tcp" or report[(port, protocol)]:
+                    continue
+                if not utils.is_port_listening(port, self._address):
+                    forwards.append(
+                        dict(
+                            self._options,
+                            address=self._address,
+                            port=port,
+                            backends=self._backends.get(port),
+                        )
+                    )
+                self._forwarders[(port, protocol)] = None
+            if forwards:
+                utils.logger.info("Start %d forwarding workers" % self._workers)
+                self._supervisor = worker.WorkerSupervisor(
+                    forwards, self._workers, self._metrics_port, self._limits
+                )
+                self._supervisor.start()
+
+        succeeded = [key for key in keys if not report[key]]
+        if self._wsl and succeeded:
+            # Create nat rules of all ports in one batch
+            try:
+                await self._wsl.update_forward_ports(
+                    add=[
+                        (port, self._address, port, protocol)
+                        for port, protocol in succeeded
+                    ]
+                )
+            except RuntimeError as e:
+                for key in succeeded:
+                    report[key] = "Create nat rule failed: %s" % e
+
+        for (port, protocol), error in report.items():
+            if error:
+                utils.logger.warning(
+                    "[%s] Setup port %d/%s failed: %s"
+                    % (self.__class__.__name__, port, protocol, error)
+                )
+        utils.logger.info(
+            "[%s] %d of %d ports are forwarded"
+            % (
+                self.__class__.__name__,
+                len([it for it in report.values() if not it]),
+                len(report),
+            )
+        )
+        return report
+
+    async def _setup_port(self, port, protocol="tcp"):
+        await firewall.ensure_rules([port], protocol)
+        if self._wsl:
+            await self._wsl.forward_local_port(port, port, self._address, protocol)
+
+    def _create_forwarder(self, port, protocol, backends=None):
+        if protocol == "udp":
+            return forward.UdpForwarder(self._address, port, **self._udp_options)
+        return forward.PortForwarder(
+            self._address,
+            port,
+            metrics=self._metrics,
+            backends=backends or self._backends.get(port),
+            limiter=self._limiter,
+            **self._options
+        )
+
+    async def add(self, port, protocol="tcp", backends=None, setup=True):
+        """Forward port
+
+        :param setup: create firewall and nat rules of the port, False if the
+                      caller creates them
+        """
+        if protocol not in ("tcp", "udp"):
+            raise RuntimeError("Invalid protocol %s" % protocol)
+        if self._supervisor and protocol == "tcp":
+            raise RuntimeError("Can not add tcp port with multiple workers")
+        if (port, protocol) in self._forwarders:
+            raise RuntimeError("Port %d/%s is already forwarded" % (port, protocol))
+        if backends:
+            if protocol != "tcp":
+                raise RuntimeError("Backends are only supported by tcp ports")
+            backends = [tuple(it) for it in backends]
+        forwarder = None
+        try:
+            if not utils.is_port_listening(port, self._address, protocol):
+                # Listen on wsl address
+                utils.logger.info(
+                    "Forwarding localhost port %d/%s to %s:%d"
+                    % (port, protocol, self._address, port)
+                )
+                forwarder = self._create_forwarder(port, protocol, backends)
+                await forwarder.serve()
+            if setup:
+                await self._setup_port(port, protocol)
+        except (Exception, asyncio.CancelledError):
+            # Keep no state of the port, so that adding it can be retried
+            if forwarder:
+                forwarder.close()
+            raise
+        # Registered after listening and setup succeeded
+        if backends:
+            self._backends[port] = backends
+        self._forwarders[(port, protocol)] = forwarder
+
+    async def remove(self, port, protocol="tcp"):
+        if self._supervisor and protocol == "tcp":
+            raise RuntimeError("Can not remove tcp port with multiple workers")
+        if (port, protocol) not in self._forwarders:
+            raise RuntimeError("Port %d/%s is not forwarded" % (port, protocol))
+        forwarder = self._forwarders.pop((port, protocol))
+        if protocol == "tcp":
+            self._backends.pop(port, None)
+        if forwarder:
+            # Stop listening only, established connections are kept
+            forwarder.close()
+        utils.logger.info("Stop forwarding port %d/%s" % (port, protocol))
+        if self._wsl:
+            await self._wsl.remove_forward_local_port(
+                port, port, self._address, protocol
+            )
+
+    def list(self):
+        result = []
+        for port, protocol in sorted(self._forwarders):
+            item = {"port": port, "protocol": protocol, "address": self._address}
+            forwarder = self._forwarders[(port, protocol)]
+            if forwarder:
+                item["engine"] = forwarder.engine
+                if isinstance(forwarder, forward.UdpForwarder):
+                    item["sessions"] = forwarder.sessions
+                elif isinstance(forwarder.upstream, forward.BalancedUpstream):
+                    item["backends"] = forwarder.upstream.stats()
+                elif isinstance(forwarder.upstream, forward.UpstreamPool):
+                    item["pool"] = forwarder.upstream.stats()
+            elif self._supervisor and protocol == "tcp":
+                item["engine"] = self._options.get("engine", "protocol")
+                item["workers"] = self._workers
+            result.append(item)
+        return result
+
+    def stats(self):
+        """Connection stats of tcp ports, None if not limited or not available"""
+        if self._limiter and not self._supervisor:
+            return self._limiter.stats()
+        return None
+
+
+def get_control_file_path():
+    root = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    return os.path.join(root, "easywsl", "control.json")
+
+
+def load_control_file(path=None):
+    """Get port and token of the running control server
+
+    :return: dict with port and token
+    """
+    path = path or get_control_file_path()
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        raise RuntimeError(
+            "Control api of forwarding service not found, start it with --control-port"
+        )
+
+
+class ControlServer(object):
+    """Serve json line requests to change forwards of a ForwardManager
+
+    Every request must carry the token written to the control file, which is
+    only readable by the current user, so other local users and web pages
+    sending requests to the port can not change forwards. Connections are
+    closed on the first invalid request.
+
+    :param control_path: path of file to save port and token
+    """
+
+    def __init__(self, manager, port=DEFAULT_CONTROL_PORT, control_path=None):
+        self._manager = manager
+        self._port = port
+        self._control_path = control_path or get_control_file_path()
+        self._token = binascii.hexlify(os.urandom(32)).decode()
+        self._server = None
+
+    def _save_control_file(self):
+        os.makedirs(os.path.dirname(self._control_path), exist_ok=True)
+        if os.path.isfile(self._control_path):
+            os.remove(self._control_path)
+        fd = os.open(self._control_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as fp:
+            json.dump({"port": self._port, "token": self._token}, fp)
+
+    def _check_request(self, line):
+        """Parse request line
+
+        :return: request dict, None if request is invalid
+        """
+        # Reject http requests such as cross origin posts of browsers
+        if not line.startswith(b"{"):
+            return None
+        try:
+            request = json.loads(line.decode())
+        except ValueError:
+            return None
+        if not isinstance(request, dict) or not hmac.compare_digest(
+            str(request.get("token", "")), self._token
+        ):
+            return None
+        return request
+
+    async def handle_request(self, request):
+        command = request.get("command")
+        if command == "add":
+            await self._manager.add(
+                int(request["port"]),
+                request.get("protocol", "tcp"),
+                request.get("backends"),
+            )
+        elif command == "remove":
+            await self._manager.remove(
+                int(request["port"]), request.get("protocol", "tcp")
+            )
+        elif command == "ls":
+            return self._manager.list()
+        elif command == "stats":
+            return self._manager.stats()
+        else:
+            raise RuntimeError("Unknown command %s" % command)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = self._check_request(line)
+                if request is None:
+                    utils.logger.warning(
+                        "[%s] Invalid request from %s, close connection"
+                        % (
+                            self.__class__.__name__,
+                            writer.get_extra_info("peername"),
+                        )
+                    )
+                    break
+                try:
+                    result = await self.handle_request(request)
+                except Exception as e:
+                    utils.logger.warning(
+                        "[%s] Handle request failed: %s" % (self.__class__.__name__, e)
+                    )
+                    response = {"error": str(e)}
+                else:
+                    response = {"result": result}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self._server = await asyncio.start_server(
+            self.handle_connection, "127.0.0.1", self._port
+        )
+        self._save_control_file()
+        utils.logger.info(
+            "[%s] Listening on 127.0.0.1:%d" % (self.__class__.__name__, self._port)
+        )
+        return self._server
+
+
+def send_command(command, control_port=None, control_path=None, **kwargs):
+    """Send command to the control server of a running forwarding service
+
+    :param control_port: port of control server, default is the port saved
+                         in control file
+    """
+    control = load_control_file(control_path)
+    request = dict(kwargs, command=command, token=control["token"])
+    with socket.create_connection(
+        ("127.0.0.1", control_port or control["port"])
+    ) as sock:
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as fp:
+            line = fp.readline()
+    if not line:
+        raise RuntimeError("Forwarding service closed connection")
+    response = json.loads(line.decode())
+    if "error" in response:
+        raise RuntimeError(response["error"])
+    return response["result"]
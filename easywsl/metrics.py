@@ -0,0 +1,205 @@
+# -*- coding: UTF-8 -*-
+
+"""Metrics in prometheus text format
+"""
+
+import asyncio
+import bisect
+
+from . import utils
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1,
+    5,
+    10,
+    60,
+    300,
+    float("inf"),
+)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def format_labels(labelnames, labels, extra=None):
+    items = list(zip(labelnames, labels))
+    if extra:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in items
+    )
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self._name = name
+        self._documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._values = {}
+
+    @property
+    def name(self):
+        return self._name
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self._name, self._documentation),
+            "# TYPE %s %s" % (self._name, self.type),
+        ]
+        for labels in sorted(self._values):
+            lines.extend(self.render_sample(labels, self._values[labels]))
+        return "\n".join(lines)
+
+    def render_sample(self, labels, value):
+        return [
+            "%s%s %s"
+            % (
+                self._name,
+                format_labels(self._labelnames, labels),
+                format_value(value),
+            )
+        ]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, value=1, labels=()):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+    def inc(self, value=1, labels=()):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def dec(self, value=1, labels=()):
+        self.inc(-value, labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        if buckets[-1] != float("inf"):
+            buckets = tuple(buckets) + (float("inf"),)
+        self._buckets = buckets
+
+    def observe(self, value, labels=()):
+        sample = self._values.get(labels)
+        if sample is None:
+            # bucket counts, sum, count
+            sample = self._values[labels] = [[0] * len(self._buckets), 0, 0]
+        sample[0][bisect.bisect_left(self._buckets, value)] += 1
+        sample[1] += value
+        sample[2] += 1
+
+    def render_sample(self, labels, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self._buckets, counts):
+            cumulative += bucket_count
+            lines.append(
+                "%s_bucket%s %d"
+                % (
+                    self._name,
+                    format_labels(
+                        self._labelnames, labels, ("le", format_value(bound))
+                    ),
+                    cumulative,
+                )
+            )
+        labels = format_labels(self._labelnames, labels)
+        lines.append("%s_sum%s %s" % (self._name, labels, format_value(total)))
+        lines.append("%s_count%s %d" % (self._name, labels, count))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """Add a callback called before rendering to update metrics"""
+        self._collectors.append(collector)
+
+    def render(self):
+        for collector in self._collectors:
+            collector()
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+class MetricsServer(object):
+    """Expose metrics of a registry on http://127.0.0.1:<port>/metrics"""
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, registry, port, address="127.0.0.1"):
+        self._registry = registry
+        self._address = address
+        self._port = port
+        self._server = None
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while True:
+                line = await reader.readline()
+                if not line or line in (b"\r\n", b"\n"):
+                    break
+            items = request_line.decode("latin-1").split()
+            if len(items) < 2 or items[0] != "GET":
+                status, body = "405 Method Not Allowed", b""
+            elif items[1].split("?")[0] != "/metrics":
+                status, body = "404 Not Found", b""
+            else:
+                status, body = "200 OK", self._registry.render().encode()
+            writer.write(
+                (
+                    "HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"
+                    % (status, self.content_type, len(body))
+                ).encode()
+                + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self._server = await asyncio.start_server(
+            self.handle_connection, self._address, self._port
+        )
+        utils.logger.info(
+            "[%s] Serving metrics on http://%s:%d/metrics"
+            % (self.__class__.__name__, self._address, self._port)
+        )
+        return self._server
@@ -0,0 +1,176 @@
+# -*- coding: UTF-8 -*-
+
+"""Seekable file object of remote file
+
+Reads are served by HTTP Range requests in blocks, recently used blocks are
+cached. Sequential reads double the read-ahead up to `max_readahead` so
+streaming a large member takes few requests, while random reads such as the
+zip central directory only fetch the blocks they touch.
+"""
+
+import collections
+import http.client
+import io
+import time
+import urllib.request
+
+from . import downloader
+from . import utils
+
+DEFAULT_BLOCK_SIZE = 256 * 1024
+DEFAULT_MAX_READAHEAD = 16 * 1024 * 1024
+DEFAULT_CACHE_SIZE = 32 * 1024 * 1024
+
+
+def is_remote_path(path):
+    return isinstance(path, str) and path.split("://")[0] in ("http", "https")
+
+
+class RemoteFile(io.RawIOBase):
+    """Readonly seekable file of url, the server must support range requests
+
+    :param block_size: bytes of each cached block
+    :param max_readahead: max bytes fetched by one request on sequential reads
+    :param cache_size: max bytes of cached blocks
+    """
+
+    def __init__(
+        self,
+        url,
+        block_size=DEFAULT_BLOCK_SIZE,
+        max_readahead=DEFAULT_MAX_READAHEAD,
+        cache_size=DEFAULT_CACHE_SIZE,
+        timeout=downloader.DEFAULT_TIMEOUT,
+    ):
+        super(RemoteFile, self).__init__()
+        self._url = url
+        self._block_size = block_size
+        self._max_readahead_blocks = max(max_readahead // block_size, 1)
+        self._max_blocks = max(cache_size // block_size, self._max_readahead_blocks)
+        self._timeout = timeout
+        self._opener = downloader.build_opener()
+        self._blocks = collections.OrderedDict()
+        self._readahead_blocks = 1
+        self._last_block = None
+        self._position = 0
+        self._requests = 0
+        self._fetched = 0
+        self._location, self._size = self._probe()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def requests(self):
+        """Count of range requests sent"""
+        return self._requests
+
+    @property
+    def fetched(self):
+        """Bytes fetched from server"""
+        return self._fetched
+
+    def _open(self, url, start, end):
+        request = urllib.request.Request(
+            url, headers={"Range": "bytes=%d-%d" % (start, end)}
+        )
+        return self._opener.open(request, timeout=self._timeout)
+
+    def _probe(self):
+        with self._open(self._url, 0, 0) as response:
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            if response.status != 206 or not total.isdigit():
+                raise RuntimeError("Range request of %s not supported" % self._url)
+            return response.geturl(), int(total)
+
+    def _fetch(self, start, end):
+        retries = 0
+        while True:
+            try:
+                with self._open(self._location, start, end) as response:
+                    if response.status != 206:
+                        raise RuntimeError(
+                            "Range request of %s not supported" % self._url
+                        )
+                    data = response.read()
+                if len(data) != end - start + 1:
+                    raise ConnectionError("Connection closed by server")
+                self._requests += 1
+                self._fetched += len(data)
+                return data
+            except (OSError, http.client.HTTPException) as e:
+                retries += 1
+                if retries > downloader.MAX_RETRIES:
+                    raise
+                utils.logger.warning(
+                    "[%s] Fetch range %d-%d of %s failed: %s, retry %d"
+                    % (self.__class__.__name__, start, end, self._url, e, retries)
+                )
+                time.sleep(min(2**retries, 30))
+
+    def _get_block(self, index):
+        if self._last_block is not None and index == self._last_block + 1:
+            self._readahead_blocks = min(
+                self._readahead_blocks * 2, self._max_readahead_blocks
+            )
+        elif index != self._last_block:
+            self._readahead_blocks = 1
+        self._last_block = index
+        block = self._blocks.get(index)
+        if block is not None:
+            self._blocks.move_to_end(index)
+            return block
+        count = 1
+        while (
+            count < self._readahead_blocks
+            and (index + count) * self._block_size < self._size
+            and index + count not in self._blocks
+        ):
+            count += 1
+        start = index * self._block_size
+        end = min(start + count * self._block_size, self._size) - 1
+        data = self._fetch(start, end)
+        for i in range(count):
+            self._blocks[index + i] = data[
+                i * self._block_size : (i + 1) * self._block_size
+            ]
+            while len(self._blocks) > self._max_blocks:
+                self._blocks.popitem(last=False)
+        return self._blocks[index]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("Negative seek position %d" % offset)
+        self._position = offset
+        return offset
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast("B")
+        size = min(len(view), self._size - self._position)
+        offset = 0
+        while offset < size:
+            index, block_offset = divmod(self._position, self._block_size)
+            block = self._get_block(index)
+            length = min(len(block) - block_offset, size - offset)
+            view[offset : offset + length] = block[block_offset : block_offset + length]
+            offset += length
+            self._position += length
+        return max(size, 0)
+
+    def close(self):
+        self._blocks.clear()
+        super(RemoteFile, self).close()
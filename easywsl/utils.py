@@ -4,23 +4,40 @@
 """
 
 import asyncio
+import codecs
+import collections
 import ctypes
 import json
 import logging
 import os
+import signal
 import socket
 import sys
 import time
 import shutil
 import urllib.request
 
-import win32com.client
-import win32gui
+try:
+    import win32com.client
+    import win32gui
+except ImportError:
+    # Only available on windows, forwarder can still be used elsewhere
+    win32com = win32gui = None
 
+from . import facts
 
 logger = logging.getLogger("easywsl")
 
 
+def init_logger():
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter("[%(asctime)s][%(levelname)s]%(message)s")
+    handler.setFormatter(formatter)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = 0
+    logger.addHandler(handler)
+
+
 version_map = {
     "20348": "21H2",
     "19045": "22H2",
@@ -41,6 +58,7 @@ def get_windows_release(build_num):
     raise NotImplementedError(build_num)
 
 
+@facts.fact("system_info", facts.DAY)
 def get_system_info():
     result = {}
     wmi = win32com.client.GetObject("winmgmts:")
@@ -51,6 +69,7 @@ def get_system_info():
     return result
 
 
+@facts.fact("wsl_adapter_address")
 def get_wsl_adapter_address():
     wmi = win32com.client.GetObject("winmgmts:")
     for interface in wmi.InstancesOf("Win32_NetworkAdapterConfiguration"):
@@ -62,34 +81,12 @@ def get_wsl_adapter_address():
     return None
 
 
-async def is_port_allowed_by_firewall(port):
-    _, stdout, _ = await run_command(
-        'netsh advfirewall firewall show rule dir=in status=enabled name="EasyWSL %d"'
-        % port
-    )
-    for line in stdout.splitlines():
-        if str(port) in line:
-            return True
-    return False
-
-
-async def add_firewall_rule(port):
-    if not ctypes.windll.shell32.IsUserAnAdmin():
-        raise RuntimeError("Add firewall rule needs run as administrator")
-    await run_command(
-        'netsh advfirewall firewall add rule name= "EasyWSL %d" dir=in action=allow protocol=TCP localport=%d'
-        % (port, port)
-    )
-
-
-def ensure_add_firewall_rule(port):
-    if not run_coroutine(is_port_allowed_by_firewall(port)):
-        run_coroutine(add_firewall_rule(port))
-
-
-def is_port_listening(port, addr="127.0.0.1"):
+def is_port_listening(port, addr="127.0.0.1", protocol="tcp"):
     try:
-        s = socket.socket()
+        if protocol == "udp":
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            s = socket.socket()
         s.bind((addr, port))
     except:
         return True
@@ -108,130 +105,418 @@ def safe_ensure_future(coro):
     asyncio.ensure_future(_wrap_func())
 
 
-async def run_command(cmdline, env=None, write_to_stdout=False):
-    if write_to_stdout:
-        print("\n\x1b[1;33m$ %s\x1b[0;0m\n" % cmdline)
-
-    proc = await asyncio.create_subprocess_shell(
-        cmdline,
-        stdin=asyncio.subprocess.PIPE,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-        env=env,
-    )
-    tasks = [None, None]
-    stdout = stderr = ""
-    while True:
-        if tasks[0] is None:
-            tasks[0] = asyncio.ensure_future(proc.stdout.read(8192))
-        if tasks[1] is None:
-            tasks[1] = asyncio.ensure_future(proc.stderr.read(8192))
-        done_tasks, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-
-        for task in done_tasks:
-            result = task.result()
-            for encoding in ("utf8", "gbk", "utf16"):
-                try:
-                    result = result.decode(encoding)
-                except UnicodeDecodeError:
-                    pass
-                else:
-                    result = result.replace('\x00', '')
-                    break
-            else:
-                raise RuntimeError("Unknown encoding: %r" % result)
-
-            for line in result.splitlines():
-                if not line:
-                    continue
-
-                if task == tasks[0]:
-                    if write_to_stdout:
-                        sys.stdout.write(line + "\n")
-                    stdout += line + "\n"
-                else:
-                    if write_to_stdout:
-                        sys.stderr.write("\x1b[1;31m%s\x1b[0;0m\n" % line)
-                    stderr += line + "\n"
-
-            if task == tasks[0]:
-                tasks[0] = None
-            else:
-                tasks[1] = None
-
-        if proc.returncode is not None:
-            break
-    return proc.returncode, stdout, stderr
+def decode_output(data):
+    """Decode output of windows and linux commands"""
+    for encoding in ("utf8", "gbk", "utf16"):
+        try:
+            result = data.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+        else:
+            return result.replace("\x00", "")
+    raise RuntimeError("Unknown encoding: %r" % data)
 
 
-def run_coroutine(coro):
+def detect_encoding(data):
+    """Detect encoding of command output from the first chunk"""
+    if data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf16"
+    if len(data) >= 2 and data[1::2].count(0) > len(data) // 4:
+        # Output of wsl.exe is utf16
+        return "utf-16-le"
+    try:
+        codecs.getincrementaldecoder("utf8")().decode(data)
+    except UnicodeDecodeError:
+        return "gbk"
+    return "utf8"
+
+
+class LineDecoder(object):
+    """Decode chunks of a stream to lines
+
+    Encoding is detected once from the first chunk, and chunks are decoded
+    incrementally, so multibyte characters split across chunks are kept.
+    """
+
+    def __init__(self):
+        self._decoder = None
+        self._parts = []
+
+    def _split(self, text, final=False):
+        text = text.replace("\x00", "")
+        if "\n" not in text and "\r" not in text and not final:
+            self._parts.append(text)
+            return []
+        if self._parts:
+            self._parts.append(text)
+            text = "".join(self._parts)
+            self._parts = []
+        lines = text.splitlines(True)
+        if lines and not final and not lines[-1].endswith("\n"):
+            # Incomplete line, or \r may be followed by \n
+            self._parts.append(lines.pop())
+        return [it.rstrip("\r\n") for it in lines]
+
+    def feed(self, data):
+        """Decode chunk and return list of complete lines"""
+        if self._decoder is None:
+            encoding = detect_encoding(data)
+            self._decoder = codecs.getincrementaldecoder(encoding)("replace")
+        return self._split(self._decoder.decode(data))
+
+    def flush(self):
+        """Return remaining lines at end of stream"""
+        text = self._decoder.decode(b"", True) if self._decoder else ""
+        return self._split(text, True)
+
+
+class CommandTimeoutError(RuntimeError):
+    pass
+
+
+# Timeout in seconds of every command, None means unlimited
+default_command_timeout = None
+# Time all commands must finish before, None means unlimited
+_deadline = None
+
+
+def set_deadline(seconds):
+    """Make all commands finish in `seconds` from now, None to disable"""
+    global _deadline
+    _deadline = time.time() + seconds if seconds else None
+
+
+def get_command_timeout(timeout=None):
+    """Timeout of a command limited by the deadline, None if unlimited
+
+    :param timeout: timeout of the command, None to use
+                    `default_command_timeout`
+    """
+    if timeout is None:
+        timeout = default_command_timeout
+    if _deadline is not None:
+        remaining = max(_deadline - time.time(), 0)
+        timeout = remaining if timeout is None else min(timeout, remaining)
+    return timeout
+
+
+async def kill_process_tree(pid):
+    """Kill process and its children, process must be started in a new
+    session on linux"""
+    if sys.platform == "win32":
+        proc = await asyncio.create_subprocess_exec(
+            "taskkill",
+            "/F",
+            "/T",
+            "/PID",
+            str(pid),
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        await proc.wait()
+    else:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+class CommandStream(object):
+    """Async iterator of output lines of a command
+
+    Items are tuples of (name, line), name is stdout or stderr. `returncode`
+    is set after all lines are consumed. Output is read until both pipes
+    are closed, or at most `drain_timeout` seconds after the process exited,
+    because pipes may be inherited by daemons started by it, which may keep
+    writing to them.
+
+    The whole process tree is killed when the command times out or the
+    iterating task is cancelled, output written by then is still drained for
+    at most `final_drain_timeout` seconds.
+
+    :param timeout: seconds the command must finish in, see
+                    `get_command_timeout`
+    """
+
+    chunk_size = 65536
+    drain_timeout = 1
+    final_drain_timeout = 0.05
+
+    def __init__(self, cmdline, env=None, timeout=None):
+        self._cmdline = cmdline
+        self._env = env
+        self._timeout = get_command_timeout(timeout)
+        self._deadline = None
+        # Time to stop reading output after the process exited
+        self._exit_deadline = None
+        self._timed_out = False
+        self._proc = None
+        self._lines = collections.deque()
+        # name => read task, None if closed
+        self._tasks = {}
+        self._decoders = {}
+        self.returncode = None
+
+    def __aiter__(self):
+        return self
+
+    async def _start(self):
+        if self._timeout is not None:
+            self._deadline = time.time() + self._timeout
+        self._proc = await asyncio.create_subprocess_shell(
+            self._cmdline,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=self._env,
+            start_new_session=True,
+        )
+        for name in ("stdout", "stderr"):
+            self._tasks[name] = self._read(name)
+            self._decoders[name] = LineDecoder()
+
+    def _read(self, name):
+        stream = getattr(self._proc, name)
+        return asyncio.ensure_future(stream.read(self.chunk_size))
+
+    def _feed(self, name, data):
+        decoder = self._decoders[name]
+        if data:
+            lines = decoder.feed(data)
+        else:
+            self._tasks[name] = None
+            lines = decoder.flush()
+        self._lines.extend((name, it) for it in lines)
+
+    async def _drain(self):
+        """Read output buffered or written in `final_drain_timeout` seconds,
+        then stop reading"""
+        deadline = time.time() + self.final_drain_timeout
+        for name in list(self._tasks):
+            while self._tasks[name]:
+                task = self._tasks[name]
+                # Keep waiting on the pending read, a new read can not start
+                # before it finishes
+                await asyncio.wait([task], timeout=max(deadline - time.time(), 0))
+                if not task.done():
+                    task.cancel()
+                    await asyncio.wait([task])
+                if task.cancelled():
+                    data = b""
+                else:
+                    data = task.result()
+                if data:
+                    self._feed(name, data)
+                    if time.time() < deadline:
+                        self._tasks[name] = self._read(name)
+                        continue
+                self._feed(name, b"")
+
+    async def _close(self):
+        """Close pipes, which may be kept open by daemons started by the
+        process, and wait for the process exit"""
+        # Process has no public method to close its pipes
+        transport = self._proc._transport
+        for fd in (1, 2):
+            pipe = transport.get_pipe_transport(fd)
+            if pipe:
+                pipe.close()
+        await self._proc.wait()
+        transport.close()
+        self.returncode = self._proc.returncode
+
+    async def kill(self):
+        if self._proc and self._proc.returncode is None:
+            await kill_process_tree(self._proc.pid)
+
+    async def _next(self):
+        while not self._lines:
+            tasks = [it for it in self._tasks.values() if it]
+            if not tasks:
+                await self._close()
+                if self._timed_out:
+                    # Raised after drained output is consumed
+                    raise CommandTimeoutError(
+                        "Run command %s timeout after %ss"
+                        % (self._cmdline, self._timeout)
+                    )
+                raise StopAsyncIteration
+            now = time.time()
+            if self._exit_deadline is None and self._proc.returncode is not None:
+                self._exit_deadline = now + self.drain_timeout
+            if self._deadline is not None and now >= self._deadline:
+                self._timed_out = True
+                await self.kill()
+                await self._drain()
+                continue
+            if self._exit_deadline is not None and now >= self._exit_deadline:
+                await self._drain()
+                continue
+            timeout = self.drain_timeout
+            for deadline in (self._deadline, self._exit_deadline):
+                if deadline is not None:
+                    timeout = min(timeout, deadline - now)
+            done, _ = await asyncio.wait(
+                tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            for name, task in list(self._tasks.items()):
+                if task in done:
+                    data = task.result()
+                    if data:
+                        self._tasks[name] = self._read(name)
+                    self._feed(name, data)
+        return self._lines.popleft()
+
+    async def __anext__(self):
+        if self._proc is None:
+            await self._start()
+        try:
+            return await self._next()
+        except asyncio.CancelledError:
+            await self.kill()
+            await self._drain()
+            await self._close()
+            raise
+
+
+def stream_command(cmdline, env=None, timeout=None):
+    """Run command and iterate (name, line) of its output with `async for`"""
+    return CommandStream(cmdline, env, timeout)
+
+
+class OutputCapture(object):
+    """Keep output lines of a command
+
+    :param max_lines: lines kept per stream, older lines are dropped, 0 to
+                      keep all lines
+    """
+
+    def __init__(self, max_lines=0):
+        self._lines = {
+            "stdout": collections.deque(maxlen=max_lines or None),
+            "stderr": collections.deque(maxlen=max_lines or None),
+        }
+        self.dropped = 0
+
+    def add(self, name, line):
+        lines = self._lines[name]
+        if len(lines) == lines.maxlen:
+            self.dropped += 1
+        lines.append(line)
+
+    def get_text(self, name):
+        lines = self._lines[name]
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+class ConsoleRenderer(object):
+    """Write output lines to console in batches
+
+    Lines are buffered and written at most once per `interval` seconds, or
+    when `max_pending_lines` lines are buffered, consecutive lines of the
+    same stream are written with one call.
+    """
+
+    interval = 0.1
+    max_pending_lines = 1000
+
+    def __init__(self, stdout=None, stderr=None):
+        self._streams = {
+            "stdout": stdout or sys.stdout,
+            "stderr": stderr or sys.stderr,
+        }
+        # [name, [text, ...]]
+        self._pending = []
+        self._pending_lines = 0
+        self._last_flush_time = 0
+        self._timer = None
+
+    def write(self, name, line):
+        if name == "stderr":
+            line = "\x1b[1;31m%s\x1b[0;0m" % line
+        if self._pending and self._pending[-1][0] == name:
+            self._pending[-1][1].append(line)
+        else:
+            self._pending.append([name, [line]])
+        self._pending_lines += 1
+        if (
+            self._pending_lines >= self.max_pending_lines
+            or time.time() - self._last_flush_time >= self.interval
+        ):
+            self.flush()
+        elif not self._timer:
+            loop = asyncio.get_event_loop()
+            self._timer = loop.call_later(self.interval, self.flush)
+
+    def flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        for name, lines in self._pending:
+            lines.append("")
+            self._streams[name].write("\n".join(lines))
+        for stream in set(self._streams.values()):
+            stream.flush()
+        self._pending = []
+        self._pending_lines = 0
+        self._last_flush_time = time.time()
+
+
+async def run_command(
+    cmdline,
+    env=None,
+    write_to_stdout=False,
+    max_lines=0,
+    timeout=None,
+):
+    """Run command and return (returncode, stdout, stderr)
+
+    CommandTimeoutError is raised if the command does not finish in time,
+    see `get_command_timeout`.
+
+    :param max_lines: last lines of stdout and stderr returned, 0 for all
+                      lines
+    """
+    if write_to_stdout:
+        print("\n\x1b[1;33m$ %s\x1b[0;0m\n" % cmdline)
+        renderer = ConsoleRenderer()
+    capture = OutputCapture(max_lines)
+    stream = stream_command(cmdline, env, timeout)
+    try:
+        async for name, line in stream:
+            if not line:
+                continue
+            if write_to_stdout:
+                renderer.write(name, line)
+            capture.add(name, line)
+    finally:
+        if write_to_stdout:
+            renderer.flush()
+    return stream.returncode, capture.get_text("stdout"), capture.get_text("stderr")
+
+
+def run_coroutine(coro, timeout=None):
+    """Run coroutine until complete, it is cancelled on timeout or ctrl+c so
+    that running commands are killed"""
     loop = asyncio.get_event_loop()
-    return loop.run_until_complete(coro)
-
-
-def sync_run_command(cmdline, write_to_stdout=False):
-    return run_coroutine(run_command(cmdline, write_to_stdout=write_to_stdout))
-
+    if timeout is not None:
+        coro = asyncio.wait_for(coro, timeout)
+    task = asyncio.ensure_future(coro)
+    try:
+        return loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except (asyncio.CancelledError, Exception):
+            pass
+        raise
 
-def download(url, save_path):
-    proxies = {}
-    http_proxy = os.environ.get("http_proxy")
-    if http_proxy:
-        proxies["http"] = http_proxy
-    https_proxy = os.environ.get("https_proxy")
-    if https_proxy:
-        proxies["https"] = https_proxy
-    if proxies:
-        proxy_handler = urllib.request.ProxyHandler(proxies)
-        opener = urllib.request.build_opener(proxy_handler)
-        urllib.request.install_opener(opener)
 
-    time0 = time.time()
-    with open(save_path, "wb") as fp:
-        with urllib.request.urlopen(url) as response:
-            read_size = 0
-            total_size = response.headers["Content-Length"]
-            if total_size:
-                total_size = int(total_size)
-                sys.stdout.write("0%% 0/%d 0B/s" % total_size)
-                sys.stdout.flush()
-
-            while not total_size or read_size < total_size:
-                buffer = response.read(64 * 1024)
-                if not buffer:
-                    break
-                fp.write(buffer)
-                read_size += len(buffer)
-                speed = read_size / (time.time() - time0)
-                unit = "B/s"
-                if speed > 1024:
-                    speed /= 1024
-                    unit = "KB/s"
-                if speed > 1024:
-                    speed /= 1024
-                    unit = "MB/s"
-                if total_size:
-                    sys.stdout.write(
-                        "\r%.2f%% %d/%d %.2f%s"
-                        % (
-                            (read_size / total_size) * 100,
-                            read_size,
-                            total_size,
-                            speed,
-                            unit,
-                        )
-                    )
-                else:
-                    sys.stdout.write(
-                        "\r%d %.2f%s"
-                        % (
-                            read_size,
-                            speed,
-                            unit,
-                        )
-                    )
-                sys.stdout.flush()
-            sys.stdout.write("\n")
+def sync_run_command(cmdline, write_to_stdout=False, timeout=None):
+    return run_coroutine(
+        run_command(cmdline, write_to_stdout=write_to_stdout, timeout=timeout)
+    )
 
 
 def enable_ansi_code():
@@ -283,8 +568,10 @@ def install_ttf(ttf_path):
         r'reg add "HKLM\SOFTWARE\Microsoft\Windows NT\CurrentVersion\Fonts" /v "FontName (TrueType)" /t REG_SZ /d "%s" /f'
         % os.path.basename(ttf_path)
     )
+    facts.invalidate("installed_fonts")
 
 
+@facts.fact("installed_fonts", facts.HOUR)
 def get_installed_fonts():
     def callback(font, tm, fonttype, names):
         names.append(font.lfFaceName)
@@ -0,0 +1,178 @@
+# -*- coding: UTF-8 -*-
+
+"""Run port forwarders in multiple worker processes
+"""
+
+import asyncio
+import multiprocessing
+import socket
+import sys
+import time
+
+from . import forward
+from . import metrics
+from . import utils
+
+
+def can_reuse_port():
+    return sys.platform != "win32" and hasattr(socket, "SO_REUSEPORT")
+
+
+def create_listen_socket(address, port, reuse_port=False, backlog=1024):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if sys.platform != "win32":
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((address, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def worker_main(index, forwards, conn, metrics_port=0, limits=None):
+    """Entry of worker process
+
+    :param forwards: list of PortForwarder keyword arguments
+    :param conn: pipe to receive shared sockets from supervisor, None means
+                 listening sockets are created with SO_REUSEPORT
+    :param metrics_port: serve metrics of this worker on `metrics_port + index`
+    :param limits: ConnectionLimiter keyword arguments of this worker
+    """
+    if sys.platform == "win32":
+        loop = asyncio.ProactorEventLoop()
+    else:
+        loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    utils.init_logger()
+
+    if conn is None:
+        socks = [
+            create_listen_socket(it["address"], it["port"], True) for it in forwards
+        ]
+    else:
+        socks = [socket.fromshare(it) for it in conn.recv()]
+        conn.close()
+
+    forward_metrics = None
+    if metrics_port:
+        registry = metrics.Registry()
+        forward_metrics = forward.ForwardMetrics(registry)
+        server = metrics.MetricsServer(registry, metrics_port + index)
+        loop.run_until_complete(server.serve())
+
+    limiter = None
+    if limits and any(limits.values()):
+        limiter = forward.ConnectionLimiter(**limits)
+
+    for options, sock in zip(forwards, socks):
+        forwarder = forward.PortForwarder(
+            metrics=forward_metrics, limiter=limiter, **options
+        )
+        loop.run_until_complete(forwarder.serve(sock))
+    utils.logger.info(
+        "[Worker-%d] Serving %d forwards in process %d"
+        % (index, len(forwards), multiprocessing.current_process().pid)
+    )
+    loop.run_forever()
+
+
+class WorkerSupervisor(object):
+    """Start worker processes sharing the listening sockets and restart dead ones"""
+
+    check_interval = 1
+    min_uptime = 5
+    max_restart_delay = 30
+
+    def __init__(self, forwards, workers, metrics_port=0, limits=None):
+        self._forwards = forwards
+        self._workers = workers
+        self._metrics_port = metrics_port
+        self._limits = limits
+        self._reuse_port = can_reuse_port()
+        self._socks = []
+        self._processes = [None] * workers
+        self._start_times = [0] * workers
+        self._restart_delays = [0] * workers
+        self._restart_times = [0] * workers
+        self._timer = None
+
+    def _spawn(self, index):
+        if self._reuse_port:
+            conn = child_conn = None
+        else:
+            conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=worker_main,
+            args=(
+                index,
+                self._forwards,
+                child_conn,
+                self._metrics_port,
+                self._limits,
+            ),
+            name="ezwsl-worker-%d" % index,
+            daemon=True,
+        )
+        process.start()
+        if conn:
+            conn.send([sock.share(process.pid) for sock in self._socks])
+            conn.close()
+            child_conn.close()
+        self._processes[index] = process
+        self._start_times[index] = time.time()
+
+    def _check(self):
+        now = time.time()
+        for index, process in enumerate(self._processes):
+            if process.is_alive() or now < self._restart_times[index]:
+                continue
+            if not self._restart_times[index]:
+                if now - self._start_times[index] < self.min_uptime:
+                    # Keep crashing, restart with exponential backoff
+                    self._restart_delays[index] = min(
+                        max(self._restart_delays[index] * 2, 1),
+                        self.max_restart_delay,
+                    )
+                else:
+                    self._restart_delays[index] = 0
+                utils.logger.warning(
+                    "[%s] Worker %d exited with code %s, restart in %ds"
+                    % (
+                        self.__class__.__name__,
+                        index,
+                        process.exitcode,
+                        self._restart_delays[index],
+                    )
+                )
+                self._restart_times[index] = now + self._restart_delays[index]
+                if self._restart_delays[index]:
+                    continue
+            self._restart_times[index] = 0
+            self._spawn(index)
+        loop = asyncio.get_event_loop()
+        self._timer = loop.call_later(self.check_interval, self._check)
+
+    def start(self):
+        if not self._reuse_port:
+            self._socks = [
+                create_listen_socket(it["address"], it["port"]) for it in self._forwards
+            ]
+        for index in range(self._workers):
+            self._spawn(index)
+        loop = asyncio.get_event_loop()
+        self._timer = loop.call_later(self.check_interval, self._check)
+
+    def stop(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        for process in self._processes:
+            if process and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process:
+                process.join()
+        for sock in self._socks:
+            sock.close()
+        self._socks = []
@@ -6,8 +6,11 @@
 
 import asyncio
 import os
+import shlex
 import sys
+import uuid
 
+from . import iptables
 from . import utils
 
 
@@ -24,12 +27,215 @@ class StreamReader(object):
         return await self._stream.readline()
 
 
+class WSLSession(object):
+    """Long-lived shell process running commands one by one
+
+    Every command runs in a subshell with stdin redirected from /dev/null,
+    followed by a sentinel line carrying the exit code on stdout and a
+    sentinel line on stderr, so outputs of sequential commands are separated
+    without starting a new process per command.
+
+    :param command: argument list to start the shell, such as
+                    ["wsl.exe", "-d", "Ubuntu", "sh"], or ["sh"] on linux
+    :param password: password of sudo, the shell (last argument of command)
+                     is started with `sudo -S` if specified. The password
+                     is only written after sudo prompts for it, so it is
+                     never run as a command if sudo does not ask for it.
+    """
+
+    stream_limit = 16 * 1024 * 1024
+
+    def __init__(self, command, password=None):
+        self._command = command
+        self._password = password
+        self._proc = None
+        self._lock = None
+        self._token = uuid.uuid4().hex
+        self._seq = 0
+
+    def _get_start_command(self):
+        if self._password is None:
+            return self._command
+        shell = self._command[-1]
+        return self._command[:-1] + [
+            "sudo",
+            "-k",
+            "-S",
+            "-p",
+            "__EZWSL_%s_PROMPT__" % self._token,
+            shell,
+            "-c",
+            "echo __EZWSL_%s_READY__ >&2; exec %s" % (self._token, shell),
+        ]
+
+    async def _authenticate(self):
+        """Write password when sudo prompts, until the shell is ready"""
+        prompt = ("__EZWSL_%s_PROMPT__" % self._token).encode()
+        ready = ("__EZWSL_%s_READY__\n" % self._token).encode()
+        output = b""
+        prompts = 0
+        while ready not in output:
+            data = await self._proc.stderr.read(4096)
+            if not data:
+                raise RuntimeError(
+                    "Start sudo shell failed: %s"
+                    % utils.decode_output(output.replace(prompt, b"")).strip()
+                )
+            output += data
+            if output.count(prompt) > prompts:
+                prompts += 1
+                if prompts > 1:
+                    raise RuntimeError("Sudo authentication failed")
+                self._proc.stdin.write(self._password.encode() + b"\n")
+                await self._proc.stdin.drain()
+        # Nothing follows the marker, the shell only writes output of commands
+
+    @property
+    def alive(self):
+        return self._proc is not None and self._proc.returncode is None
+
+    async def start(self):
+        self._proc = await asyncio.create_subprocess_exec(
+            *self._get_start_command(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=self.stream_limit,
+            start_new_session=True
+        )
+        if self._password is not None:
+            try:
+                await self._authenticate()
+            except (RuntimeError, ConnectionError):
+                await self.kill()
+                raise
+        # Wait for the shell ready
+        return_code, _, stderr = await self._run("true")
+        if return_code:
+            self.close()
+            raise RuntimeError(
+                "Start shell session %s failed: %s" % (" ".join(self._command), stderr)
+            )
+
+    async def _run(self, cmdline, env=None):
+        self._seq += 1
+        sentinel = "__EZWSL_%s_%d__" % (self._token, self._seq)
+        exports = "".join(
+            "export %s=%s; " % (key, shlex.quote(value))
+            for key, value in (env or {}).items()
+        )
+        script = "(%seval %s) </dev/null\n" % (exports, shlex.quote(cmdline))
+        script += "printf '\\n%s %%d\\n' $?\n" % sentinel
+        script += "printf '\\n%s\\n' >&2\n" % sentinel
+        stdout_marker = ("\n%s " % sentinel).encode()
+        stderr_marker = ("\n%s\n" % sentinel).encode()
+        try:
+            self._proc.stdin.write(script.encode())
+            await self._proc.stdin.drain()
+            stdout, stderr = await asyncio.gather(
+                self._proc.stdout.readuntil(stdout_marker),
+                self._proc.stderr.readuntil(stderr_marker),
+            )
+            return_code = int(await self._proc.stdout.readline())
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ConnectionError,
+            ValueError,
+        ) as e:
+            self.close()
+            raise RuntimeError(
+                "Shell session %s broken: %s"
+                % (" ".join(self._command), e.__class__.__name__)
+            )
+        return (
+            return_code,
+            utils.decode_output(stdout[: -len(stdout_marker)]),
+            utils.decode_output(stderr[: -len(stderr_marker)]),
+        )
+
+    async def run(self, cmdline, env=None, timeout=None):
+        """Run cmdline and return (return_code, stdout, stderr)
+
+        The session is killed if the command times out or is cancelled, see
+        `utils.get_command_timeout`.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        timeout = utils.get_command_timeout(timeout)
+        async with self._lock:
+            try:
+                if not self.alive:
+                    await asyncio.wait_for(self.start(), timeout)
+                return await asyncio.wait_for(self._run(cmdline, env), timeout)
+            except asyncio.TimeoutError:
+                await self.kill()
+                raise utils.CommandTimeoutError(
+                    "Run command %s timeout after %ss" % (cmdline, timeout)
+                )
+            except asyncio.CancelledError:
+                await self.kill()
+                raise
+
+    async def kill(self):
+        proc, self._proc = self._proc, None
+        if proc and proc.returncode is None:
+            await utils.kill_process_tree(proc.pid)
+
+    def close(self):
+        if self.alive:
+            # Shell exits after reading EOF
+            self._proc.stdin.close()
+        self._proc = None
+
+
+class WSLSessionPool(object):
+    """Run commands concurrently on at most `size` shell sessions"""
+
+    def __init__(self, command, password=None, size=1):
+        self._command = command
+        self._password = password
+        self._size = size
+        self._sessions = []
+        self._idle_sessions = []
+        self._semaphore = None
+
+    async def run(self, cmdline, env=None, timeout=None):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._size)
+        async with self._semaphore:
+            if self._idle_sessions:
+                session = self._idle_sessions.pop()
+            else:
+                session = WSLSession(self._command, self._password)
+                self._sessions.append(session)
+            try:
+                return await session.run(cmdline, env, timeout)
+            finally:
+                # Broken session is restarted by next command
+                self._idle_sessions.append(session)
+
+    def close(self):
+        for session in self._sessions:
+            session.close()
+        self._sessions = []
+        self._idle_sessions = []
+
+
 class WSL(object):
     wsl_path = "C:\Windows\\system32\\wsl.exe"
 
-    def __init__(self, password=None, distribution=None):
+    def __init__(self, password=None, distribution=None, session_size=1):
+        """
+        :param session_size: max shell sessions kept open to run commands,
+                             0 to start a new wsl.exe for every command
+        """
         self._password = password
         self._distribution = distribution
+        self._session_size = session_size
+        # root => WSLSessionPool
+        self._session_pools = {}
+        self._route_localnet_enabled = False
 
     @staticmethod
     def check():
@@ -59,7 +265,32 @@ class WSL(object):
 
         return await utils.run_command(cmdline, env or None, write_to_stdout)
 
+    def _get_session_pool(self, root):
+        if root not in self._session_pools:
+            command = [self.__class__.wsl_path]
+            if self._distribution:
+                command += ["-d", self._distribution]
+            password = None
+            if root:
+                if not self._password:
+                    raise RuntimeError("Password not specified")
+                password = self._password
+            command.append("sh")
+            self._session_pools[root] = WSLSessionPool(
+                command, password, self._session_size
+            )
+        return self._session_pools[root]
+
     async def run_shell_cmd(self, cmdline, root=False, env=None, write_to_stdout=False):
+        if self._session_size and not write_to_stdout:
+            pool = self._get_session_pool(root)
+            return_code, stdout, stderr = await pool.run(cmdline, env)
+            if return_code:
+                raise RuntimeError(
+                    "Run cmdline %s failed: [%d] %s" % (cmdline, return_code, stderr)
+                )
+            return stdout
+
         if "\n" in cmdline:
             cmdline = """sh -c 'echo "%s" ^| sh' """ % cmdline.replace(
                 "\\", "\\\\"
@@ -73,6 +304,11 @@ class WSL(object):
             )
         return stdout
 
+    def close(self):
+        for pool in self._session_pools.values():
+            pool.close()
+        self._session_pools = {}
+
     async def check_iptables_rule(self, rule, table=None):
         cmdline = "iptables"
         if table:
@@ -89,32 +325,47 @@ class WSL(object):
             cmdline += " -t %s" % table
         await self.run_shell_cmd(cmdline, True)
 
-    async def forward_local_port(
-        self, local_port, remote_port, remote_address="127.0.0.1"
-    ):
-        if await self.check_iptables_rule(
-            "LOCAL tcp dpt:%d to:%s:%d" % (local_port, remote_address, remote_port),
-            "nat",
-        ):
+    async def _enable_route_localnet(self):
+        if self._route_localnet_enabled:
+            return
+        cmdline = (
+            'sh -c "[ $(cat /proc/sys/net/ipv4/conf/all/route_localnet) != 0 ]'
+            ' || sysctl -w net.ipv4.conf.eth0.route_localnet=1"'
+        )
+        await self.run_shell_cmd(cmdline, True)
+        self._route_localnet_enabled = True
+
+    async def update_forward_ports(self, add=(), remove=()):
+        """Add and remove nat rules of forwards in one iptables-restore call
+
+        :param add: list of (local_port, remote_address, remote_port, protocol)
+        :param remove: list of (local_port, remote_address, remote_port, protocol)
+        """
+        result = await self.run_shell_cmd("iptables-save -t nat", True)
+        script = iptables.plan(iptables.parse_ruleset(result), add, remove)
+        if script:
             utils.logger.info(
-                "[%s] NAT rule from localhost:%d to %s:%d exist"
-                % (self.__class__.__name__, local_port, remote_address, remote_port)
+                "[%s] Update iptables nat rules: %d added, %d removed"
+                % (self.__class__.__name__, len(add), len(remove))
             )
-            return
+            await self.run_shell_cmd(iptables.restore_cmdline(script), True)
+        else:
+            utils.logger.info(
+                "[%s] iptables nat rules are up to date" % self.__class__.__name__
+            )
+        if add:
+            await self._enable_route_localnet()
 
-        utils.logger.info(
-            "[%s] Create iptables nat rules: %d => %d"
-            % (self.__class__.__name__, local_port, remote_port)
+    async def forward_local_port(
+        self, local_port, remote_port, remote_address="127.0.0.1", protocol="tcp"
+    ):
+        await self.update_forward_ports(
+            add=[(local_port, remote_address, remote_port, protocol)]
         )
-        cmdline = (
-            "iptables -t nat -A OUTPUT -m addrtype --src-type LOCAL --dst-type LOCAL -p tcp --dport %d -j DNAT --to-destination %s:%d"
-            % (local_port, remote_address, remote_port)
+
+    async def remove_forward_local_port(
+        self, local_port, remote_port, remote_address="127.0.0.1", protocol="tcp"
+    ):
+        await self.update_forward_ports(
+            remove=[(local_port, remote_address, remote_port, protocol)]
         )
-        await self.run_shell_cmd(cmdline, True)
-        cmdline = "iptables -t nat -A POSTROUTING -m addrtype --src-type LOCAL --dst-type UNICAST -j MASQUERADE"
-        await self.run_shell_cmd(cmdline, True)
-        cmdline = "cat /proc/sys/net/ipv4/conf/all/route_localnet"
-        result = await self.run_shell_cmd(cmdline)
-        if int(result.strip()) == 0:
-            cmdline = "sysctl -w net.ipv4.conf.eth0.route_localnet=1"
-            await self.run_shell_cmd(cmdline, True)
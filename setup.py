@@ -16,7 +16,7 @@ with open('requirements.txt') as fp:
 def find_packages():
     packages = []
     for pkg in setuptools.find_packages():
-        if not pkg.startswith('test'):
+        if not pkg.startswith('test') and not pkg.startswith('benchmarks'):
             print(pkg)
             packages.append(pkg)
     return packages
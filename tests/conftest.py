@@ -0,0 +1,22 @@
+# -*- coding: UTF-8 -*-
+
+import pytest
+
+from benchmarks import download
+
+
+@pytest.fixture
+def range_server():
+    """Factory of local http servers of data, with Range support by default"""
+    servers = []
+
+    def create(data, support_range=True):
+        server = download.RangeServer(data, support_range=support_range)
+        server.start()
+        servers.append(server)
+        return server
+
+    yield create
+    for server in servers:
+        server.shutdown()
+        server.server_close()
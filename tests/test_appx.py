@@ -0,0 +1,147 @@
+# -*- coding: UTF-8 -*-
+
+import io
+import os
+import zipfile
+
+import pytest
+
+from easywsl import appx
+
+BUNDLE_MANIFEST = """<?xml version="1.0" encoding="utf-8"?>
+<Bundle xmlns="http://schemas.microsoft.com/appx/2013/bundle">
+  <Packages>
+    <Package Type="resource" FileName="Ubuntu_scale-100.appx" />
+    <Package Type="application" Architecture="x64" FileName="Ubuntu_x64.appx" />
+    <Package Type="application" Architecture="arm64" FileName="Ubuntu_ARM64.appx" />
+  </Packages>
+</Bundle>
+"""
+
+PACKAGE_MANIFEST = """<?xml version="1.0" encoding="utf-8"?>
+<Package xmlns="http://schemas.microsoft.com/appx/manifest/foundation/windows10">
+  <Applications>
+    <Application Id="ubuntu" Executable="%s" />
+  </Applications>
+</Package>
+"""
+
+
+def create_package(architecture, executable="ubuntu.exe", extra=()):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(appx.PACKAGE_MANIFEST, PACKAGE_MANIFEST % executable)
+        zf.writestr(executable.replace("\\", "/"), "launcher %s" % architecture)
+        zf.writestr("install.tar.gz", "rootfs %s" % architecture)
+        zf.writestr("Assets/logo.png", "logo")
+        for name in extra:
+            zf.writestr(name, "extra")
+    return buffer.getvalue()
+
+
+def create_bundle(path, manifest=True, compress_type=zipfile.ZIP_STORED):
+    with zipfile.ZipFile(str(path), "w") as zf:
+        if manifest:
+            zf.writestr(appx.BUNDLE_MANIFEST, BUNDLE_MANIFEST)
+        zf.writestr("Ubuntu_scale-100.appx", "resources")
+        for architecture, name in (("x64", "x64"), ("arm64", "ARM64")):
+            zf.writestr(
+                "Ubuntu_%s.appx" % name,
+                create_package(architecture),
+                compress_type=compress_type,
+            )
+    return str(path)
+
+
+def read_file(path):
+    with open(path) as fp:
+        return fp.read()
+
+
+def test_get_architecture():
+    assert appx.get_architecture("AMD64") == "x64"
+    assert appx.get_architecture("aarch64") == "arm64"
+    assert appx.get_architecture("riscv64") == "riscv64"
+
+
+def test_select_package(tmp_path):
+    path = create_bundle(tmp_path / "bundle.appxbundle")
+    with zipfile.ZipFile(path) as zf:
+        assert appx.select_package(zf, "x64") == "Ubuntu_x64.appx"
+        assert appx.select_package(zf, "arm64") == "Ubuntu_ARM64.appx"
+        with pytest.raises(RuntimeError, match="No x86 package"):
+            appx.select_package(zf, "x86")
+
+
+def test_select_package_without_manifest(tmp_path):
+    path = create_bundle(tmp_path / "bundle.appxbundle", manifest=False)
+    with zipfile.ZipFile(path) as zf:
+        assert appx.select_package(zf, "x64") == "Ubuntu_x64.appx"
+
+
+def test_get_save_path(tmp_path):
+    install_path = str(tmp_path / "install")
+    assert appx.get_save_path(install_path, "rootfs/install.tar.gz") == os.path.join(
+        install_path, "rootfs", "install.tar.gz"
+    )
+    # Members can not be written outside install_path
+    for name, expected in [
+        ("../evil.exe", "evil.exe"),
+        ("a/../../evil.exe", os.path.join("a", "evil.exe")),
+        ("/evil.exe", "evil.exe"),
+        ("./a//evil.exe", os.path.join("a", "evil.exe")),
+    ]:
+        save_path = appx.get_save_path(install_path, name)
+        assert save_path == os.path.join(install_path, expected)
+    with pytest.raises(RuntimeError, match="Invalid member name"):
+        appx.get_save_path(install_path, "../..")
+
+
+@pytest.mark.parametrize(
+    "compress_type",
+    [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED],
+    ids=["stored", "deflated"],
+)
+@pytest.mark.parametrize("architecture", ["x64", "arm64"])
+def test_extract_bundle(tmp_path, architecture, compress_type):
+    path = create_bundle(tmp_path / "bundle.appxbundle", compress_type=compress_type)
+    install_path = str(tmp_path / "install")
+    launcher = appx.extract_image(path, install_path, architecture)
+    assert launcher == os.path.join(install_path, "ubuntu.exe")
+    assert sorted(os.listdir(install_path)) == [
+        appx.PACKAGE_MANIFEST,
+        "install.tar.gz",
+        "ubuntu.exe",
+    ]
+    assert read_file(launcher) == "launcher %s" % architecture
+    assert read_file(os.path.join(install_path, "install.tar.gz")) == (
+        "rootfs %s" % architecture
+    )
+
+
+def test_extract_package(tmp_path):
+    path = tmp_path / "package.appx"
+    # Launcher in a sub directory is extracted beside rootfs
+    path.write_bytes(create_package("x64", executable="bin\\ubuntu.exe"))
+    install_path = str(tmp_path / "install")
+    launcher = appx.extract_image(str(path), install_path, "arm64")
+    assert launcher == os.path.join(install_path, "ubuntu.exe")
+    assert read_file(launcher) == "launcher x64"
+
+
+def test_extract_package_outside_member(tmp_path):
+    path = tmp_path / "package.appx"
+    path.write_bytes(create_package("x64", executable="..\\..\\ubuntu.exe"))
+    install_path = str(tmp_path / "install")
+    launcher = appx.extract_image(str(path), install_path)
+    assert launcher == os.path.join(install_path, "ubuntu.exe")
+    assert not os.path.exists(str(tmp_path / "ubuntu.exe"))
+
+
+def test_extract_remote_bundle(tmp_path, range_server):
+    path = create_bundle(tmp_path / "bundle.appxbundle")
+    with open(path, "rb") as fp:
+        server = range_server(fp.read())
+    install_path = str(tmp_path / "install")
+    launcher = appx.extract_image(server.url, install_path, "arm64")
+    assert read_file(launcher) == "launcher arm64"
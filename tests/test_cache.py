@@ -0,0 +1,89 @@
+# -*- coding: UTF-8 -*-
+
+import hashlib
+import os
+
+import pytest
+
+from easywsl import cache
+from easywsl import downloader
+
+SIZE = downloader.DIGEST_BLOCK_SIZE * 2 + 1000
+
+
+@pytest.fixture
+def data():
+    return os.urandom(SIZE)
+
+
+def test_content_digest_independent_of_segments(tmp_path, range_server, data):
+    server = range_server(data)
+    digests = [
+        downloader.download(
+            server.url, str(tmp_path / ("%d.img" % it)), it, progress=False
+        )
+        for it in (1, 3)
+    ]
+    stream_server = range_server(data, support_range=False)
+    digests.append(
+        downloader.download(
+            stream_server.url, str(tmp_path / "stream.img"), progress=False
+        )
+    )
+    expected = downloader.hash_file(str(tmp_path / "1.img"))
+    assert digests == [expected] * 3
+    # Plain sha256 is only computed if expected
+    assert list(expected) == [downloader.CONTENT_DIGEST]
+
+
+def test_expected_sha256(tmp_path, range_server, data):
+    server = range_server(data)
+    sha256 = hashlib.sha256(data).hexdigest()
+    digests = downloader.download(
+        server.url, str(tmp_path / "a.img"), 3, False, expected={"sha256": sha256}
+    )
+    assert digests["sha256"] == sha256
+    with pytest.raises(downloader.DigestMismatchError):
+        downloader.download(
+            server.url, str(tmp_path / "b.img"), 3, False, expected={"sha256": "0" * 64}
+        )
+    assert not os.path.exists(str(tmp_path / "b.img.part"))
+
+
+def test_fetch_cached(tmp_path, range_server, data):
+    server = range_server(data)
+    image_cache = cache.ImageCache(str(tmp_path / "cache"))
+    path = image_cache.fetch(server.url)
+    assert (
+        os.path.basename(path) == downloader.hash_file(path)[downloader.CONTENT_DIGEST]
+    )
+    assert "sha256" not in image_cache.lookup(server.url)
+    server.data = os.urandom(SIZE)
+    # Cached image is used until the remote file changes
+    assert image_cache.fetch(server.url, revalidate=False) == path
+    assert image_cache.fetch(server.url) != path
+
+
+def test_fetch_expected_sha256(tmp_path, range_server, data):
+    server = range_server(data)
+    image_cache = cache.ImageCache(str(tmp_path / "cache"))
+    path = image_cache.fetch(server.url)
+    expected = {"sha256": hashlib.sha256(data).hexdigest()}
+    # Cached image is hashed to record its sha256
+    assert image_cache.fetch(server.url, expected=expected) == path
+    assert image_cache.lookup(server.url)["sha256"] == expected["sha256"]
+    assert image_cache.lookup(server.url, {"sha256": "0" * 64}) is None
+
+
+def test_fetch_verify_corrupted(tmp_path, range_server, data):
+    server = range_server(data)
+    image_cache = cache.ImageCache(str(tmp_path / "cache"))
+    path = image_cache.fetch(server.url)
+    with open(path, "r+b") as fp:
+        fp.seek(SIZE // 2)
+        fp.write(b"corrupted")
+    # Trusted by content address unless asked to verify
+    assert image_cache.fetch(server.url) == path
+    assert image_cache.fetch(server.url, verify=True) == path
+    with open(path, "rb") as fp:
+        assert fp.read() == data
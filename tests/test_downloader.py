@@ -0,0 +1,151 @@
+# -*- coding: UTF-8 -*-
+
+import hashlib
+import os
+
+import pytest
+
+from easywsl import downloader
+
+BLOCK_SIZE = downloader.DIGEST_BLOCK_SIZE
+SIZE = BLOCK_SIZE * 3 + 1000
+
+
+@pytest.fixture
+def data():
+    return os.urandom(SIZE)
+
+
+def create_partial(url, save_path, data, done):
+    """Leave part and state files of a download interrupted after `done`
+    bytes of the first segment"""
+    partial = downloader.Downloader(url, save_path, 2, progress=False)
+    partial._info, _ = partial._probe()
+    partial._plan()
+    segment = partial._segments[0]
+    with open(partial._part_path, "r+b") as fp:
+        fp.write(data[:done])
+    segment.done = done
+    segment.hasher.update(data[:done])
+    partial._save_state()
+
+
+def read_file(path):
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+def test_plan_segments(tmp_path, range_server, data):
+    server = range_server(data)
+    for segments, expected in [
+        (1, [(0, SIZE - 1)]),
+        (2, [(0, BLOCK_SIZE * 2 - 1), (BLOCK_SIZE * 2, SIZE - 1)]),
+        (
+            4,
+            [
+                (0, BLOCK_SIZE - 1),
+                (BLOCK_SIZE, BLOCK_SIZE * 2 - 1),
+                (BLOCK_SIZE * 2, BLOCK_SIZE * 3 - 1),
+                (BLOCK_SIZE * 3, SIZE - 1),
+            ],
+        ),
+        # Not more segments than blocks
+        (
+            8,
+            [
+                (it * BLOCK_SIZE, min((it + 1) * BLOCK_SIZE, SIZE) - 1)
+                for it in range(4)
+            ],
+        ),
+    ]:
+        instance = downloader.Downloader(
+            server.url, str(tmp_path / "image.appx"), segments, progress=False
+        )
+        instance._info, _ = instance._probe()
+        instance._plan()
+        assert [(it.start, it.end) for it in instance._segments] == expected
+        assert os.path.getsize(str(tmp_path / "image.appx.part")) == SIZE
+
+
+def test_download_segments(tmp_path, range_server, data):
+    server = range_server(data)
+    save_path = str(tmp_path / "image.appx")
+    instance = downloader.Downloader(server.url, save_path, 3, progress=False)
+    instance.download()
+    assert read_file(save_path) == data
+    assert instance.downloaded == SIZE
+    assert instance.info["size"] == SIZE
+    assert instance.info["etag"] == server.etag
+    assert instance.digests == downloader.hash_file(save_path)
+    assert os.listdir(str(tmp_path)) == ["image.appx"]
+
+
+def test_download_small_file(tmp_path, range_server):
+    for data in (b"", b"small"):
+        server = range_server(data)
+        save_path = str(tmp_path / ("%d.appx" % len(data)))
+        digests = downloader.download(server.url, save_path, progress=False)
+        assert read_file(save_path) == data
+        assert digests == downloader.hash_file(save_path)
+
+
+def test_resume(tmp_path, range_server, data):
+    server = range_server(data)
+    save_path = str(tmp_path / "image.appx")
+    done = BLOCK_SIZE + 1000
+    create_partial(server.url, save_path, data, done)
+    # Change the content but not the etag, bytes already downloaded are kept
+    etag = server.etag
+    server.data = os.urandom(SIZE)
+    server.etag = etag
+    instance = downloader.Downloader(server.url, save_path, 2, progress=False)
+    instance.download()
+    assert read_file(save_path) == data[:done] + server.data[done:]
+    assert instance.digests == downloader.hash_file(save_path)
+    assert not os.path.exists(save_path + ".part.json")
+
+
+def test_resume_changed_file(tmp_path, range_server, data):
+    server = range_server(data)
+    save_path = str(tmp_path / "image.appx")
+    create_partial(server.url, save_path, data, BLOCK_SIZE + 1000)
+    server.data = os.urandom(SIZE)
+    digests = downloader.download(server.url, save_path, 2, progress=False)
+    # Downloaded from beginning since etag changed
+    assert read_file(save_path) == server.data
+    assert digests == downloader.hash_file(save_path)
+
+
+def test_resume_expected_sha256(tmp_path, range_server, data):
+    server = range_server(data)
+    save_path = str(tmp_path / "image.appx")
+    create_partial(server.url, save_path, data, BLOCK_SIZE + 1000)
+    expected = {"sha256": hashlib.sha256(data).hexdigest(), "size": SIZE}
+    digests = downloader.download(server.url, save_path, 2, False, expected)
+    # Bytes downloaded before are hashed from part file
+    assert digests["sha256"] == expected["sha256"]
+    with pytest.raises(downloader.DigestMismatchError, match="Size"):
+        downloader.download(
+            server.url, save_path, 2, False, expected={"size": SIZE + 1}
+        )
+
+
+def test_range_not_supported(tmp_path, range_server, data):
+    server = range_server(data, support_range=False)
+    save_path = str(tmp_path / "image.appx")
+    instance = downloader.Downloader(server.url, save_path, 4, progress=False)
+    instance.download()
+    assert read_file(save_path) == data
+    assert instance.info["size"] == SIZE
+    assert instance.digests == downloader.hash_file(save_path)
+
+
+def test_is_modified(range_server, data):
+    server = range_server(data)
+    assert not downloader.is_modified(server.url, etag=server.etag)
+    assert downloader.is_modified(server.url, etag='"changed"')
+    # Nothing to revalidate
+    assert downloader.is_modified(server.url)
+    etag = server.etag
+    server.data = os.urandom(100)
+    assert downloader.is_modified(server.url, etag=etag)
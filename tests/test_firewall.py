@@ -0,0 +1,185 @@
+# -*- coding: UTF-8 -*-
+
+from easywsl import firewall
+
+ENGLISH_RULES = """
+Rule Name:                            EasyWSL 80
+----------------------------------------------------------------------
+Enabled:                              Yes
+Direction:                            In
+Profiles:                             Domain,Private,Public
+Grouping:
+LocalIP:                              Any
+RemoteIP:                             Any
+Protocol:                             TCP
+LocalPort:                            80
+RemotePort:                           Any
+Edge traversal:                       No
+Action:                               Allow
+
+Rule Name:                            EasyWSL 8000-8010,9000
+----------------------------------------------------------------------
+Enabled:                              Yes
+Direction:                            In
+Profiles:                             Domain,Private,Public
+Grouping:
+LocalIP:                              Any
+RemoteIP:                             Any
+Protocol:                             TCP
+LocalPort:                            8000-8010,9000
+RemotePort:                           Any
+Edge traversal:                       No
+Action:                               Allow
+
+Rule Name:                            EasyWSL UDP 53
+----------------------------------------------------------------------
+Enabled:                              Yes
+Direction:                            In
+Profiles:                             Domain,Private,Public
+Grouping:
+LocalIP:                              Any
+RemoteIP:                             Any
+Protocol:                             UDP
+LocalPort:                            53
+RemotePort:                           Any
+Edge traversal:                       No
+Action:                               Allow
+
+Rule Name:                            EasyWSL 443
+----------------------------------------------------------------------
+Enabled:                              No
+Direction:                            In
+Profiles:                             Domain,Private,Public
+Grouping:
+LocalIP:                              Any
+RemoteIP:                             Any
+Protocol:                             TCP
+LocalPort:                            443
+RemotePort:                           Any
+Edge traversal:                       No
+Action:                               Allow
+
+Rule Name:                            Remote Desktop - User Mode (TCP-In)
+----------------------------------------------------------------------
+Enabled:                              Yes
+Direction:                            In
+Profiles:                             Domain,Private,Public
+Grouping:                             Remote Desktop
+LocalIP:                              Any
+RemoteIP:                             Any
+Protocol:                             TCP
+LocalPort:                            3389
+RemotePort:                           Any
+Edge traversal:                       No
+Action:                               Allow
+Ok.
+"""
+
+CHINESE_RULES = """
+规则名称:                             EasyWSL 80
+----------------------------------------------------------------------
+已启用:                               是
+方向:                                 入
+配置文件:                             域,专用,公用
+分组:
+本地 IP:                              任何
+远程 IP:                              任何
+协议:                                 TCP
+本地端口:                             80
+远程端口:                             任何
+边缘遍历:                             否
+操作:                                 允许
+
+规则名称：                            EasyWSL 3000-3002
+----------------------------------------------------------------------
+已启用：                              是
+方向：                                入
+协议：                                TCP
+本地端口：                            3000-3002
+操作：                                允许
+
+规则名称:                             EasyWSL 22
+----------------------------------------------------------------------
+已启用:                               是
+方向:                                 入
+协议:                                 TCP
+本地端口:                             22
+操作:                                 阻止
+确定。
+"""
+
+
+def test_parse_english_rules():
+    rules = firewall.parse_rules(ENGLISH_RULES)
+    assert len(rules) == 5
+    assert rules[0] == {
+        "name": "EasyWSL 80",
+        "enabled": "Yes",
+        "direction": "In",
+        "protocol": "TCP",
+        "local_port": "80",
+        "action": "Allow",
+    }
+    assert rules[1]["local_port"] == "8000-8010,9000"
+    assert rules[4]["name"] == "Remote Desktop - User Mode (TCP-In)"
+
+
+def test_parse_chinese_rules():
+    rules = firewall.parse_rules(CHINESE_RULES)
+    assert [it["name"] for it in rules] == [
+        "EasyWSL 80",
+        "EasyWSL 3000-3002",
+        "EasyWSL 22",
+    ]
+    assert rules[0]["enabled"] == "是"
+    assert rules[1]["local_port"] == "3000-3002"
+    assert rules[2]["action"] == "阻止"
+
+
+def test_parse_ports():
+    assert firewall.parse_ports("80,8000-8010") == [(80, 80), (8000, 8010)]
+    assert firewall.parse_ports("Any") == [(0, 65535)]
+    assert firewall.parse_ports("RPC") == []
+
+
+def test_format_ports():
+    assert firewall.format_ports([8001, 80, 8000, 8002, 80]) == "80,8000-8002"
+
+
+def test_rule_index_english():
+    index = firewall.FirewallRuleIndex(firewall.parse_rules(ENGLISH_RULES))
+    assert len(index) == 4
+    assert index.find(80) == "EasyWSL 80"
+    assert index.find(8005) == "EasyWSL 8000-8010,9000"
+    assert index.find(9000) == "EasyWSL 8000-8010,9000"
+    assert index.find(8011) is None
+    assert index.find(53, "udp") == "EasyWSL UDP 53"
+    assert index.find(53) is None
+    # Disabled rule
+    assert index.find(443) is None
+    # Rule not created by EasyWSL
+    assert index.find(3389) is None
+
+
+def test_rule_index_chinese():
+    index = firewall.FirewallRuleIndex(firewall.parse_rules(CHINESE_RULES))
+    assert index.find(80) == "EasyWSL 80"
+    assert index.find(3001) == "EasyWSL 3000-3002"
+    # Block rule
+    assert index.find(22) is None
+
+
+def test_rule_index_add():
+    index = firewall.FirewallRuleIndex()
+    index.add(
+        {
+            "name": firewall.get_rule_name("5000-5001"),
+            "enabled": "Yes",
+            "direction": "In",
+            "protocol": "TCP",
+            "local_port": "5000-5001",
+            "action": "Allow",
+        }
+    )
+    assert index.find(5001) == "EasyWSL 5000-5001"
+    assert index.find(5002) is None
@@ -0,0 +1,148 @@
+# -*- coding: UTF-8 -*-
+
+from easywsl import iptables
+
+LEGACY_RULESET = """# Generated by iptables-save v1.8.4 on Sat Oct 17 10:00:00 2026
+*nat
+:PREROUTING ACCEPT [0:0]
+:INPUT ACCEPT [0:0]
+:OUTPUT ACCEPT [12:912]
+:POSTROUTING ACCEPT [12:912]
+-A OUTPUT -p tcp -m tcp --dport 80 -j DNAT --to-destination 172.20.0.1:80
+-A OUTPUT -p tcp -m tcp --dport 3306 -j DNAT --to-destination 172.20.0.1:3306
+-A POSTROUTING -m addrtype --src-type LOCAL --dst-type UNICAST -j MASQUERADE
+COMMIT
+# Completed on Sat Oct 17 10:00:00 2026
+# Generated by iptables-save v1.8.4 on Sat Oct 17 10:00:00 2026
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+COMMIT
+# Completed on Sat Oct 17 10:00:00 2026
+"""
+
+RULESET = """# Generated by iptables-save v1.8.4 on Sat Oct 17 10:00:00 2026
+*nat
+:PREROUTING ACCEPT [0:0]
+:INPUT ACCEPT [0:0]
+:OUTPUT ACCEPT [12:912]
+:POSTROUTING ACCEPT [12:912]
+:EZWSL_OUTPUT - [0:0]
+:EZWSL_POSTROUTING - [0:0]
+-A OUTPUT -m addrtype --src-type LOCAL --dst-type LOCAL -j EZWSL_OUTPUT
+-A POSTROUTING -j EZWSL_POSTROUTING
+-A EZWSL_OUTPUT -p tcp -m tcp --dport 80 -j DNAT --to-destination 172.20.0.1:80
+-A EZWSL_OUTPUT -p udp -m udp --dport 53 -j DNAT --to-destination 172.20.0.1:53
+-A EZWSL_POSTROUTING -m addrtype --src-type LOCAL --dst-type UNICAST -j MASQUERADE
+COMMIT
+# Completed on Sat Oct 17 10:00:00 2026
+"""
+
+HTTP = (80, "172.20.0.1", 80, "tcp")
+DNS = (53, "172.20.0.1", 53, "udp")
+MYSQL = (3306, "172.20.0.1", 3306, "tcp")
+
+
+def test_parse_ruleset():
+    tables = iptables.parse_ruleset(RULESET)
+    assert sorted(tables) == ["nat"]
+    nat = tables["nat"]
+    assert list(nat) == [
+        "PREROUTING",
+        "INPUT",
+        "OUTPUT",
+        "POSTROUTING",
+        "EZWSL_OUTPUT",
+        "EZWSL_POSTROUTING",
+    ]
+    assert nat["PREROUTING"] == []
+    assert nat["OUTPUT"] == [iptables.OUTPUT_JUMP]
+    assert nat["EZWSL_OUTPUT"] == [iptables.dnat_rule(HTTP), iptables.dnat_rule(DNS)]
+    assert nat["EZWSL_POSTROUTING"] == [iptables.MASQUERADE_RULE]
+
+
+def test_parse_forward():
+    assert iptables.parse_forward(iptables.dnat_rule(DNS)) == DNS
+    assert iptables.parse_forward(iptables.MASQUERADE_RULE) is None
+    assert iptables.parse_forward("-p tcp -j DNAT --to-destination bad") is None
+
+
+def test_plan_empty_ruleset():
+    script = iptables.plan(iptables.parse_ruleset(""), add=[HTTP])
+    assert script.splitlines() == [
+        "*nat",
+        ":EZWSL_OUTPUT - [0:0]",
+        ":EZWSL_POSTROUTING - [0:0]",
+        "-A EZWSL_OUTPUT %s" % iptables.dnat_rule(HTTP),
+        "-A EZWSL_POSTROUTING %s" % iptables.MASQUERADE_RULE,
+        "-A OUTPUT %s" % iptables.OUTPUT_JUMP,
+        "-A POSTROUTING %s" % iptables.POSTROUTING_JUMP,
+        "COMMIT",
+    ]
+
+
+def test_plan_unchanged():
+    ruleset = iptables.parse_ruleset(RULESET)
+    assert iptables.plan(ruleset) is None
+    assert iptables.plan(ruleset, add=[HTTP, DNS]) is None
+    assert iptables.plan(ruleset, remove=[MYSQL]) is None
+
+
+def test_plan_idempotent():
+    """Applying a plan and planning the same changes again changes nothing"""
+    ruleset = iptables.parse_ruleset(RULESET)
+    script = iptables.plan(ruleset, add=[MYSQL])
+    assert script.splitlines() == [
+        "*nat",
+        ":EZWSL_OUTPUT - [0:0]",
+        "-A EZWSL_OUTPUT %s" % iptables.dnat_rule(HTTP),
+        "-A EZWSL_OUTPUT %s" % iptables.dnat_rule(DNS),
+        "-A EZWSL_OUTPUT %s" % iptables.dnat_rule(MYSQL),
+        "COMMIT",
+    ]
+    ruleset["nat"]["EZWSL_OUTPUT"].append(iptables.dnat_rule(MYSQL))
+    assert iptables.plan(ruleset, add=[MYSQL]) is None
+
+
+def test_plan_remove():
+    ruleset = iptables.parse_ruleset(RULESET)
+    script = iptables.plan(ruleset, remove=[HTTP])
+    assert script.splitlines() == [
+        "*nat",
+        ":EZWSL_OUTPUT - [0:0]",
+        "-A EZWSL_OUTPUT %s" % iptables.dnat_rule(DNS),
+        "COMMIT",
+    ]
+
+
+def test_plan_legacy_rules():
+    ruleset = iptables.parse_ruleset(LEGACY_RULESET)
+    script = iptables.plan(ruleset, add=[HTTP])
+    lines = script.splitlines()
+    assert "-A EZWSL_OUTPUT %s" % iptables.dnat_rule(HTTP) in lines
+    assert "-A OUTPUT %s" % iptables.OUTPUT_JUMP in lines
+    assert "-A POSTROUTING %s" % iptables.POSTROUTING_JUMP in lines
+    # Legacy rules of planned forwards and masquerade are deleted
+    assert (
+        "-D OUTPUT -p tcp -m tcp --dport 80 -j DNAT --to-destination 172.20.0.1:80"
+        in lines
+    )
+    assert "-D POSTROUTING %s" % iptables.MASQUERADE_RULE in lines
+    # Legacy rules of other forwards are kept
+    assert not [it for it in lines if "--dport 3306" in it]
+
+
+def test_plan_remove_legacy_rule():
+    ruleset = iptables.parse_ruleset(LEGACY_RULESET)
+    lines = iptables.plan(ruleset, remove=[MYSQL]).splitlines()
+    assert (
+        "-D OUTPUT -p tcp -m tcp --dport 3306 -j DNAT --to-destination 172.20.0.1:3306"
+        in lines
+    )
+    assert not [it for it in lines if it.startswith("-A EZWSL_OUTPUT")]
+
+
+def test_restore_cmdline():
+    cmdline = iptables.restore_cmdline("*nat\nCOMMIT\n")
+    assert cmdline == "sh -c \"printf '*nat\\nCOMMIT\\n' | iptables-restore --noflush\""
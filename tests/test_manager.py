@@ -0,0 +1,71 @@
+# -*- coding: UTF-8 -*-
+
+import asyncio
+import socket
+
+import pytest
+
+from easywsl import firewall
+from easywsl import manager
+from easywsl import utils
+
+
+class FakeWSL(object):
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.forwards = []
+
+    async def forward_local_port(self, local_port, remote_port, address, protocol):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("Create nat rule failed")
+        self.forwards.append((local_port, address, remote_port, protocol))
+
+    async def remove_forward_local_port(
+        self, local_port, remote_port, address, protocol
+    ):
+        self.forwards.remove((local_port, address, remote_port, protocol))
+
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@pytest.fixture(autouse=True)
+def no_firewall(monkeypatch):
+    async def ensure_rules(ports, protocol="tcp"):
+        return []
+
+    monkeypatch.setattr(firewall, "ensure_rules", ensure_rules)
+
+
+def test_add_retry_after_setup_failed():
+    port = get_free_port()
+    wsl = FakeWSL(failures=1)
+    forward_manager = manager.ForwardManager("127.0.0.1", wsl)
+
+    async def main():
+        with pytest.raises(RuntimeError, match="Create nat rule failed"):
+            await forward_manager.add(port, backends=[("127.0.0.1", 1)])
+        # Listener is closed and the port is not registered
+        assert not utils.is_port_listening(port, "127.0.0.1")
+        assert forward_manager.list() == []
+        await forward_manager.add(port)
+        items = forward_manager.list()
+        forwards = list(wsl.forwards)
+        await forward_manager.remove(port)
+        return items, forwards
+
+    loop = asyncio.new_event_loop()
+    try:
+        items, forwards = loop.run_until_complete(main())
+    finally:
+        loop.close()
+    assert [(it["port"], it["protocol"]) for it in items] == [(port, "tcp")]
+    # Backends of the failed add are not kept
+    assert "backends" not in items[0]
+    assert forwards == [(port, "127.0.0.1", port, "tcp")]
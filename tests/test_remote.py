@@ -0,0 +1,86 @@
+# -*- coding: UTF-8 -*-
+
+import io
+import os
+import zipfile
+
+import pytest
+
+from easywsl import remote
+
+BLOCK_SIZE = 1024
+
+
+@pytest.fixture
+def data():
+    return os.urandom(BLOCK_SIZE * 10 + 100)
+
+
+def test_is_remote_path():
+    assert remote.is_remote_path("https://aka.ms/wsl-ubuntu-1804")
+    assert not remote.is_remote_path("C:\\ubuntu.appx")
+    assert not remote.is_remote_path(None)
+
+
+def test_seek_and_read(range_server, data):
+    server = range_server(data)
+    with remote.RemoteFile(server.url, block_size=BLOCK_SIZE) as fileobj:
+        assert fileobj.size == len(data)
+        assert fileobj.read(10) == data[:10]
+        assert fileobj.seek(BLOCK_SIZE * 5 - 3) == BLOCK_SIZE * 5 - 3
+        # Read across blocks
+        assert fileobj.read(6) == data[BLOCK_SIZE * 5 - 3 : BLOCK_SIZE * 5 + 3]
+        assert fileobj.tell() == BLOCK_SIZE * 5 + 3
+        fileobj.seek(-100, io.SEEK_CUR)
+        assert fileobj.read(100) == data[BLOCK_SIZE * 5 - 97 : BLOCK_SIZE * 5 + 3]
+        fileobj.seek(-50, io.SEEK_END)
+        assert fileobj.read() == data[-50:]
+        with pytest.raises(ValueError):
+            fileobj.seek(-1)
+        fileobj.seek(0)
+        assert fileobj.read() == data
+
+
+def test_read_past_end(range_server, data):
+    server = range_server(data)
+    with remote.RemoteFile(server.url, block_size=BLOCK_SIZE) as fileobj:
+        fileobj.seek(len(data) - 10)
+        assert fileobj.read(100) == data[-10:]
+        assert fileobj.read(100) == b""
+        fileobj.seek(len(data) + 100)
+        assert fileobj.read(100) == b""
+        assert fileobj.tell() == len(data) + 100
+        requests = fileobj.requests
+    # Reads past end are not sent to server
+    assert requests == 1
+
+
+def test_cached_blocks(range_server, data):
+    server = range_server(data)
+    with remote.RemoteFile(server.url, block_size=BLOCK_SIZE) as fileobj:
+        assert fileobj.read() == data
+        requests = fileobj.requests
+        # Sequential reads fetch more blocks by each request
+        assert requests < len(data) // BLOCK_SIZE
+        assert fileobj.fetched == len(data)
+        fileobj.seek(BLOCK_SIZE * 3)
+        assert fileobj.read(BLOCK_SIZE) == data[BLOCK_SIZE * 3 : BLOCK_SIZE * 4]
+        assert fileobj.requests == requests
+
+
+def test_read_zip(range_server):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        zf.writestr("a.txt", b"a" * 5000)
+        zf.writestr("b.txt", b"b" * 5000, zipfile.ZIP_DEFLATED)
+    server = range_server(buffer.getvalue())
+    with remote.RemoteFile(server.url, block_size=BLOCK_SIZE) as fileobj:
+        with zipfile.ZipFile(fileobj) as zf:
+            assert zf.read("b.txt") == b"b" * 5000
+            assert zf.read("a.txt") == b"a" * 5000
+
+
+def test_range_not_supported(range_server, data):
+    server = range_server(data, support_range=False)
+    with pytest.raises(RuntimeError, match="Range request of .* not supported"):
+        remote.RemoteFile(server.url, block_size=BLOCK_SIZE)
@@ -0,0 +1,86 @@
+# -*- coding: UTF-8 -*-
+
+import asyncio
+import gc
+import shutil
+import sys
+import time
+
+import pytest
+
+from easywsl import utils
+
+pytestmark = [
+    pytest.mark.skipif(
+        sys.platform == "win32" or not shutil.which("sh"), reason="sh not found"
+    ),
+    # Pipes left open are reported when collected after the loop is closed
+    pytest.mark.filterwarnings("error::pytest.PytestUnraisableExceptionWarning"),
+]
+
+# Writes to the inherited stdout for 5 seconds after the command exited
+BACKGROUND_WRITER = (
+    "(i=0; while [ $i -lt 50 ]; do echo x; i=$((i+1)); sleep 0.1; done) & "
+    "echo started; exit 3"
+)
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+        gc.collect()
+
+
+def test_run_command():
+    result = run(utils.run_command("echo out; echo err >&2; exit 2"))
+    assert result == (2, "out\n", "err\n")
+
+
+def test_run_command_background_writer():
+    time0 = time.time()
+    return_code, stdout, stderr = run(utils.run_command(BACKGROUND_WRITER))
+    elapsed = time.time() - time0
+    assert return_code == 3
+    assert stdout.startswith("started\n")
+    assert stderr == ""
+    assert elapsed < utils.CommandStream.drain_timeout * 2 + 1
+
+
+def test_stream_command_timeout():
+    async def main():
+        lines = []
+        with pytest.raises(utils.CommandTimeoutError):
+            async for name, line in utils.stream_command(
+                "echo before; sleep 10; echo after", timeout=0.5
+            ):
+                lines.append((name, line))
+        return lines
+
+    time0 = time.time()
+    # Output written before the timeout is kept
+    assert run(main()) == [("stdout", "before")]
+    assert time.time() - time0 < 2
+
+
+def test_run_command_cancel():
+    async def main():
+        task = asyncio.ensure_future(utils.run_command("echo started; sleep 10"))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    time0 = time.time()
+    run(main())
+    assert time.time() - time0 < 2
+
+
+def test_run_command_max_lines(capsys):
+    cmdline = "i=0; while [ $i -lt 1500 ]; do echo $i; i=$((i+1)); done"
+    _, stdout, _ = run(utils.run_command(cmdline, write_to_stdout=True))
+    assert stdout.splitlines() == [str(it) for it in range(1500)]
+    _, stdout, _ = run(utils.run_command(cmdline, max_lines=10))
+    assert stdout.splitlines() == [str(it) for it in range(1490, 1500)]
@@ -0,0 +1,157 @@
+# -*- coding: UTF-8 -*-
+
+import asyncio
+import gc
+import os
+import shutil
+import sys
+
+import pytest
+
+from easywsl import wsl
+
+pytestmark = pytest.mark.skipif(
+    sys.platform == "win32" or not shutil.which("sh"), reason="sh not found"
+)
+
+# Prompts with the -p argument and execs the command after a correct password,
+# or execs it directly if NOPASSWD is set
+FAKE_SUDO = """#!/bin/sh
+while [ "$1" != "${1#-}" ]; do
+    if [ "$1" = "-p" ]; then
+        shift
+        prompt=$1
+    fi
+    shift
+done
+if [ -z "$NOPASSWD" ]; then
+    printf '%s' "$prompt" >&2
+    read password
+    while [ "$password" != "secret" ]; do
+        echo "Sorry, try again." >&2
+        printf '%s' "$prompt" >&2
+        read password || exit 1
+    done
+fi
+exec "$@"
+"""
+
+
+@pytest.fixture(scope="module")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    # Reap shells closed or killed by tests before closing the loop
+    loop.run_until_complete(asyncio.sleep(0.5))
+    gc.collect()
+    loop.close()
+
+
+@pytest.fixture
+def fake_sudo(tmp_path, monkeypatch):
+    path = tmp_path / "sudo"
+    path.write_text(FAKE_SUDO)
+    path.chmod(0o755)
+    monkeypatch.setenv("PATH", "%s%s%s" % (tmp_path, os.pathsep, os.environ["PATH"]))
+    return tmp_path
+
+
+def test_session_run(loop):
+    async def main():
+        session = wsl.WSLSession(["sh"])
+        try:
+            first = await session.run("echo hello; echo error >&2")
+            second = await session.run("exit 3")
+            third = await session.run("printf 'no newline'")
+            return first, second, third
+        finally:
+            session.close()
+
+    first, second, third = loop.run_until_complete(main())
+    assert first == (0, "hello\n", "error\n")
+    assert second == (3, "", "")
+    assert third == (0, "no newline", "")
+
+
+def test_session_env_and_isolation(loop):
+    async def main():
+        session = wsl.WSLSession(["sh"])
+        try:
+            first = await session.run('echo "$NAME"', env={"NAME": "a b'c"})
+            # Commands run in subshells, exports and cd do not leak
+            await session.run("cd /; export LEAK=1")
+            second = await session.run('echo "[$NAME$LEAK]"; pwd')
+            return first, second
+        finally:
+            session.close()
+
+    first, second = loop.run_until_complete(main())
+    assert first == (0, "a b'c\n", "")
+    assert second == (0, "[]\n%s\n" % os.getcwd(), "")
+
+
+def test_session_restart(loop):
+    async def main():
+        session = wsl.WSLSession(["sh"])
+        try:
+            await session.run("true")
+            await session.kill()
+            assert not session.alive
+            return await session.run("echo restarted")
+        finally:
+            session.close()
+
+    assert loop.run_until_complete(main()) == (0, "restarted\n", "")
+
+
+def test_session_timeout(loop):
+    async def main():
+        session = wsl.WSLSession(["sh"])
+        try:
+            with pytest.raises(wsl.utils.CommandTimeoutError):
+                await session.run("sleep 10", timeout=0.5)
+            assert not session.alive
+            return await session.run("echo ok")
+        finally:
+            session.close()
+
+    assert loop.run_until_complete(main()) == (0, "ok\n", "")
+
+
+def test_session_sudo(loop, fake_sudo):
+    async def main():
+        session = wsl.WSLSession(["sh"], password="secret")
+        try:
+            return await session.run("echo ok")
+        finally:
+            session.close()
+
+    assert loop.run_until_complete(main()) == (0, "ok\n", "")
+
+
+def test_session_sudo_nopasswd(loop, fake_sudo, monkeypatch):
+    monkeypatch.setenv("NOPASSWD", "1")
+    marker = fake_sudo / "executed"
+
+    async def main():
+        session = wsl.WSLSession(["sh"], password="touch %s" % marker)
+        try:
+            return await session.run("echo ok")
+        finally:
+            session.close()
+
+    assert loop.run_until_complete(main()) == (0, "ok\n", "")
+    # Password is not written to the shell when sudo does not prompt
+    assert not marker.exists()
+
+
+def test_session_sudo_wrong_password(loop, fake_sudo):
+    async def main():
+        session = wsl.WSLSession(["sh"], password="wrong")
+        try:
+            await session.run("echo ok", timeout=10)
+        finally:
+            session.close()
+
+    with pytest.raises(RuntimeError, match="Sudo authentication failed"):
+        loop.run_until_complete(main())